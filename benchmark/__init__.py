@@ -0,0 +1,3 @@
+"""
+Synthetic networks and benchmarks for the preprocessing and query hot paths, see run_benchmarks.py.
+"""
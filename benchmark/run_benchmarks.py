@@ -0,0 +1,245 @@
+"""
+Benchmarks the preprocessing and query hot paths on a synthetic network and writes the timings as JSON.
+Usage (from the repository root):
+    python -m benchmark.run_benchmarks --stops 2000 --sources 20 --output bench.json
+    python -m benchmark.run_benchmarks --stops 2000 --sources 20 --output new.json --baseline bench.json
+With --baseline the medians are compared and the exit status is 1 if any benchmark got slower than --max-regression allows.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+from time import perf_counter, strftime
+
+import numpy as np
+
+import function_file
+import query_func
+from function_file import encode_network, initialize_from_desti_onemany, onetomany_rtbtr, route_timetable, trip_transfer_table
+from pattern_store import pattern_edges, write_pattern_store
+from query_func import arrivaltme_query, build_query_graph, build_timetable_index, multicriteria_dij, pareto_onetomany, prepare_query_network
+
+from .synthetic_network import synthetic_network
+
+MAX_TRANSFER = 4
+FOLDER = "benchmark"
+
+
+def summarize(durations, errors=0):
+    '''
+    Args:
+        durations (list): seconds per call.
+        errors (int): number of calls that raised.
+    Returns:
+        summary (dict): number of calls, total, mean, median and 95th percentile in seconds, number of errors.
+    '''
+    if not durations:
+        return {"n": 0, "errors": errors}
+    durations = np.array(durations)
+    return {"n": len(durations), "total_s": float(durations.sum()), "mean_s": float(durations.mean()),
+            "median_s": float(np.median(durations)), "p95_s": float(np.percentile(durations, 95)), "errors": errors}
+
+
+def _timed(function, durations):
+    '''
+    Wraps function so that the duration of every call is appended to durations.
+    '''
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            durations.append(perf_counter() - start)
+    return wrapper
+
+
+def bench_preprocessing(network, source_LIST):
+    '''
+    Times onetomany_rtbtr per source. enqueue_range and _print_tbtr_journey_otm are timed inside the same runs by
+    temporarily wrapping them in function_file, so their numbers come from real search states. An exception raised by a search
+    is not caught, so a broken engine fails the run instead of reporting faster timings.
+    Args:
+        network (tuple): output of synthetic_network.
+        source_LIST (list): stop ids to run.
+    Returns:
+        results (dict): summaries keyed by benchmark name.
+        patterns (dict): transfer patterns of every source. Format {SOURCE: pattern_dag}.
+    '''
+    stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict, trip_transfer_dict = network
+    stoptimes_dict, footpath_dict, trip_transfer_dict, departures_dict, trip_route_idx, route_trip_offset, day_start = encode_network(stoptimes_dict, footpath_dict, trip_transfer_dict)
+    start = perf_counter()
+    L = initialize_from_desti_onemany(routes_by_stop_dict, stops_dict, list(routes_by_stop_dict.keys()), footpath_dict, idx_by_route_stop_dict)
+    setup = perf_counter() - start
+    trip_transfers = trip_transfer_table(trip_transfer_dict, trip_route_idx, stops_dict)
+    route_times = route_timetable(stoptimes_dict)
+    durations = {"onetomany_rtbtr": [], "enqueue_range": [], "_print_tbtr_journey_otm": []}
+    originals = {name: getattr(function_file, name) for name in ("enqueue_range", "_print_tbtr_journey_otm")}
+    patterns = {}
+    try:
+        for name, function in originals.items():
+            setattr(function_file, name, _timed(function, durations[name]))
+        for SOURCE in source_LIST:
+            start = perf_counter()
+            patterns[SOURCE] = onetomany_rtbtr(SOURCE, list(routes_by_stop_dict.keys()), departures_dict, MAX_TRANSFER, 0, 0, 1, routes_by_stop_dict,
+                                               stops_dict, stoptimes_dict, footpath_dict, idx_by_route_stop_dict, trip_transfers,
+                                               trip_route_idx, route_trip_offset, L, route_times)
+            durations["onetomany_rtbtr"].append(perf_counter() - start)
+    finally:
+        for name, function in originals.items():
+            setattr(function_file, name, function)
+    results = {"initialize_from_desti_onemany": summarize([setup]), "onetomany_rtbtr": summarize(durations["onetomany_rtbtr"]),
+               "enqueue_range": summarize(durations["enqueue_range"]), "_print_tbtr_journey_otm": summarize(durations["_print_tbtr_journey_otm"])}
+    return results, patterns
+
+
+def bench_queries(network, patterns, num_queries, seed):
+    '''
+    Times build_query_graph (cold and cached), arrivaltme_query, multicriteria_dij and pareto_onetomany to all stops on a pattern
+    store built from patterns.
+    The store is written to a temporary directory laid out like the one build_query_graph reads.
+    Args:
+        network (tuple): output of synthetic_network.
+        patterns (dict): Format {SOURCE: pattern_dag}.
+        num_queries (int): number of random OD queries.
+        seed (int): random seed for the queries.
+    Returns:
+        results (dict): summaries keyed by benchmark name.
+    '''
+    stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict, trip_transfer_dict = network
+    query_network = prepare_query_network(stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict)
+    footpath_dict = query_network["footpath_dict"]
+    start = perf_counter()
+    timetable_index = build_timetable_index(query_network["stoptimes_dict"], query_network["routesindx_by_stop_dict"])
+    results = {"build_timetable_index": summarize([perf_counter() - start])}
+    rnd = random.Random(seed)
+    source_LIST = sorted(patterns)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.makedirs(f"{workdir}/gdrive/MyDrive/transfer_pattern")
+        write_pattern_store(f"{workdir}/gdrive/MyDrive/transfer_pattern/{FOLDER}.tpstore", ((SOURCE, pattern_edges(patterns[SOURCE])) for SOURCE in source_LIST))
+        os.chdir(workdir)
+        try:
+            for name in ("build_query_graph_cold", "build_query_graph_cached"):
+                if name.endswith("cold"):
+                    query_func._query_graph_cache.clear()
+                    query_func._query_graph_cache_stats["bytes"] = 0
+                durations = []
+                for SOURCE in source_LIST:
+                    start = perf_counter()
+                    build_query_graph(SOURCE, FOLDER)
+                    durations.append(perf_counter() - start)
+                results[name] = summarize(durations)
+
+            edge_list = [(SOURCE, q, j) for SOURCE in source_LIST for q, successors in build_query_graph(SOURCE, FOLDER).items() for j in successors]
+            durations, errors = [], 0
+            for SOURCE, q, j in rnd.sample(edge_list, min(len(edge_list), num_queries * 10)):
+                deptime = rnd.randint(5 * 3600, 10 * 3600)
+                start = perf_counter()
+                try:
+                    arrivaltme_query(q, j, deptime, timetable_index)
+                except ValueError:
+                    errors = errors + 1    # no trip after deptime, still a complete lookup
+                durations.append(perf_counter() - start)
+            results["arrivaltme_query"] = summarize(durations)
+
+            destination_LIST = sorted(routes_by_stop_dict)
+            od_list = [(rnd.choice(source_LIST), rnd.choice(destination_LIST), rnd.randint(5 * 3600, 10 * 3600)) for _ in range(num_queries)] if source_LIST else []
+            for GOAL_DIRECTED in (0, 1):
+                durations = []
+                for SOURCE, DESTINATION, D_TIME in od_list:
+                    start = perf_counter()
+                    multicriteria_dij(SOURCE, D_TIME, DESTINATION, footpath_dict, FOLDER, timetable_index, GOAL_DIRECTED)
+                    durations.append(perf_counter() - start)
+                results[f"multicriteria_dij_goal{GOAL_DIRECTED}"] = summarize(durations)
+            durations = []
+            for SOURCE in source_LIST:
+                start = perf_counter()
+                pareto_onetomany(SOURCE, rnd.randint(5 * 3600, 10 * 3600), destination_LIST, footpath_dict, FOLDER, timetable_index, 1)
+                durations.append(perf_counter() - start)
+            results["pareto_onetomany_all_stops"] = summarize(durations)
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def compare(results, baseline, max_regression):
+    '''
+    Compares the medians of two benchmark runs.
+    Args:
+        results (dict): "results" of the current run.
+        baseline (dict): "results" of the saved run.
+        max_regression (float): allowed relative slowdown, e.g. 0.1 for 10 %.
+    Returns:
+        regressions (list): names of the benchmarks that got slower than allowed.
+    '''
+    regressions = []
+    print(f"    {'benchmark':<34}{'baseline':>12}{'current':>12}{'ratio':>8}")
+    for name, summary in results.items():
+        if "median_s" not in summary or "median_s" not in baseline.get(name, {}):
+            continue
+        ratio = summary["median_s"] / baseline[name]["median_s"] if baseline[name]["median_s"] else float("inf")
+        flag = ""
+        if ratio > 1 + max_regression:
+            regressions.append(name)
+            flag = "  slower"
+        print(f"    {name:<34}{baseline[name]['median_s'] * 1000:>10.3f}ms{summary['median_s'] * 1000:>10.3f}ms{ratio:>8.2f}{flag}")
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark preprocessing and query hot paths on a synthetic network.")
+    parser.add_argument("--stops", type=int, default=2000, help="number of stops of the synthetic network")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the network and of the sampled sources and queries")
+    parser.add_argument("--trips-per-route", type=int, default=12)
+    parser.add_argument("--sources", type=int, default=20, help="number of sources to preprocess")
+    parser.add_argument("--queries", type=int, default=200, help="number of OD queries")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.1, help="allowed relative slowdown of a median")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    network = synthetic_network(args.stops, seed=args.seed, trips_per_route=args.trips_per_route)
+    generation = perf_counter() - start
+    stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict, trip_transfer_dict = network
+    source_LIST = random.Random(args.seed).sample(sorted(routes_by_stop_dict), min(args.sources, len(routes_by_stop_dict)))
+    print(f"    Network: {len(routes_by_stop_dict)} stops, {len(stops_dict)} routes, generated in {round(generation, 2)} s")
+
+    results, patterns = bench_preprocessing(network, source_LIST)
+    results.update(bench_queries(network, patterns, args.queries, args.seed))
+    report = {"meta": {"stops": len(routes_by_stop_dict), "routes": len(stops_dict), "trips": len(trip_transfer_dict),
+                       "trip_transfers": sum(len(transfers) for stop_transfers in trip_transfer_dict.values() for transfers in stop_transfers.values()),
+                       "seed": args.seed, "sources": len(source_LIST), "queries": args.queries, "commit": _git_commit(),
+                       "python": platform.python_version(), "date": strftime("%Y-%m-%d %H:%M:%S")},
+              "results": results}
+    with open(args.output, "w") as fp:
+        json.dump(report, fp, indent=2)
+    for name, summary in results.items():
+        if "median_s" in summary:
+            print(f"    {name:<34} n={summary['n']:<7} median={summary['median_s'] * 1000:.3f}ms  p95={summary['p95_s'] * 1000:.3f}ms  errors={summary['errors']}")
+    print(f"    Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        if baseline["meta"]["stops"] != report["meta"]["stops"] or baseline["meta"]["seed"] != report["meta"]["seed"]:
+            print("    Warning: the baseline was run on a different network")
+        regressions = compare(results, baseline["results"], args.max_regression)
+        if regressions:
+            print(f"    Slower than baseline: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Deterministic synthetic transit networks in the format returned by read_testcase, for benchmarking without GTFS data.
+Stops lie on a square grid, routes are random walks over the grid without repeated stops, footpaths join some neighbouring
+stops and trips of a route run at a fixed headway with identical running times (so trips never overtake each other).
+"""
+import random
+from bisect import bisect_left
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+GRID_MOVES = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+
+def _route_walk(rnd, side, num_stops, length):
+    '''
+    Random walk over the grid that prefers to keep its direction. Returns the visited stop ids.
+    '''
+    stop = rnd.randrange(num_stops)
+    x, y = stop % side, stop // side
+    direction = rnd.choice(GRID_MOVES)
+    route, visited = [stop], {stop}
+    while len(route) < length:
+        moves = [direction] * 3 + list(GRID_MOVES)
+        rnd.shuffle(moves)
+        for dx, dy in moves:
+            nx, ny = x + dx, y + dy
+            candidate = ny * side + nx
+            if 0 <= nx < side and 0 <= ny < side and candidate < num_stops and candidate not in visited:
+                break
+        else:
+            break
+        direction, x, y = (dx, dy), nx, ny
+        route.append(candidate)
+        visited.add(candidate)
+    return route
+
+
+def synthetic_network(num_stops, seed=0, route_length=(8, 25), routes_per_stop=2, trips_per_route=12, footpath_share=0.3):
+    '''
+    Generates a synthetic network.
+    Args:
+        num_stops (int): number of grid stops (stops no route visits are left out, like in read_testcase).
+        seed (int): random seed. The same arguments always give the same network.
+        route_length (tuple): smallest and largest number of stops of a route.
+        routes_per_stop (int): average number of routes serving a stop, sets the number of routes.
+        trips_per_route (int): number of trips of every route.
+        footpath_share (float): share of neighbouring stop pairs joined by a footpath.
+    Returns:
+        stops_dict (dict): Format {route_id: [ids of stops in the route]}.
+        stoptimes_dict (dict): Format {route_id: [[trip_1], [trip_2]]} where trip_1 = [(stop id, arrival time as pandas.Timestamp)].
+        footpath_dict (dict): Format {from_stop_id: [(to_stop_id, footpath duration as pandas.Timedelta)]}.
+        routes_by_stop_dict (dict): Format {stop_id: [id of routes passing through stop]}.
+        idx_by_route_stop_dict (dict): Format {(route id, stop id): stop index in route}.
+        trip_transfer_dict (nested dict): keys: id of trip we are transferring from ("route_tid"), value: {stop number: list of tuples
+        of form (id of trip we are transferring to, stop number)}
+    '''
+    rnd = random.Random(seed)
+    side = int(np.ceil(np.sqrt(num_stops)))
+    num_routes = max(1, num_stops * routes_per_stop // ((route_length[0] + route_length[1]) // 2))
+    stops_dict, running_times, first_departures, headways = {}, {}, {}, {}
+    for route in range(num_routes):
+        route_stops = _route_walk(rnd, side, num_stops, rnd.randint(*route_length))
+        if len(route_stops) < 2:
+            continue
+        stops_dict[route] = route_stops
+        running_times[route] = np.cumsum([0] + [rnd.randint(90, 240) for _ in range(len(route_stops) - 1)])
+        first_departures[route] = rnd.randint(5 * 3600, 8 * 3600)
+        headways[route] = rnd.randint(5, 30) * 60
+
+    routes_by_stop_dict, idx_by_route_stop_dict = defaultdict(list), {}
+    for route, route_stops in stops_dict.items():
+        for stop_idx, stop in enumerate(route_stops):
+            routes_by_stop_dict[stop].append(route)
+            idx_by_route_stop_dict[(route, stop)] = stop_idx
+    routes_by_stop_dict = dict(routes_by_stop_dict)
+
+    footpath_seconds = defaultdict(list)
+    for stop in sorted(routes_by_stop_dict):
+        x, y = stop % side, stop // side
+        for neighbour in (stop + 1 if x + 1 < side else None, stop + side):
+            if neighbour in routes_by_stop_dict and rnd.random() < footpath_share:
+                duration = rnd.randint(120, 300)
+                footpath_seconds[stop].append((neighbour, duration))
+                footpath_seconds[neighbour].append((stop, duration))
+
+    # Arrival seconds of every trip, times[route][stop_idx] lists one value per trip in trip order.
+    times = {route: [[int(first_departures[route] + headways[route] * tid + running) for tid in range(trips_per_route)]
+                     for running in running_times[route]] for route in stops_dict}
+    trip_transfer_dict = {}
+    for route, route_stops in stops_dict.items():
+        for tid in range(trips_per_route):
+            stop_transfers = {0: []}
+            for stop_idx in range(1, len(route_stops)):
+                arrival = times[route][stop_idx][tid]
+                transfers = []
+                for to_stop, walk in [(route_stops[stop_idx], 0)] + footpath_seconds.get(route_stops[stop_idx], []):
+                    for to_route in routes_by_stop_dict[to_stop]:
+                        to_stop_idx = idx_by_route_stop_dict[(to_route, to_stop)]
+                        if to_route == route or to_stop_idx == len(stops_dict[to_route]) - 1:
+                            continue
+                        to_tid = bisect_left(times[to_route][to_stop_idx], arrival + walk)
+                        if to_tid < trips_per_route:
+                            transfers.append((f"{to_route}_{to_tid}", to_stop_idx))
+                stop_transfers[stop_idx] = transfers
+            trip_transfer_dict[f"{route}_{tid}"] = stop_transfers
+
+    day_start = pd.Timestamp("2019-11-06")
+    stoptimes_dict = {}
+    for route, route_stops in stops_dict.items():
+        seconds = np.array(times[route], dtype=np.int64).T    # trips x stops
+        timestamps = pd.to_datetime(seconds.ravel(), unit="s", origin=day_start).tolist()
+        stoptimes_dict[route] = [list(zip(route_stops, timestamps[tid * len(route_stops): (tid + 1) * len(route_stops)])) for tid in range(trips_per_route)]
+    footpath_dict = {stop: [(to_stop, pd.Timedelta(seconds=duration)) for to_stop, duration in connections] for stop, connections in footpath_seconds.items()}
+    return stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict, trip_transfer_dict
@@ -1,6 +1,119 @@
 from collections import defaultdict
+from time import perf_counter
 
-import pandas as pd
+import numpy as np
+
+from pattern_store import add_pattern, close_pattern_sink, new_pattern_sink
+
+INF_TIME = 2 ** 31 - 1  # int32 sentinel for "not reached", times are seconds since service-day start.
+
+
+def encode_network(stoptimes_dict, footpath_dict, trip_transfer_dict):
+    '''
+    Converts the dicts returned by read_testcase into the compact representation used by rTBTR. Trips are
+    renumbered as dense integers (trips of a route are contiguous and in the same order as stoptimes_dict[route_id]),
+    arrival times become seconds since the start of the service day and footpath durations become seconds.
+    Args:
+        stoptimes_dict (dict): preprocessed dict. Format {route_id: [[trip_1], [trip_2]]} where trip_1 = [(stop id, arrival time)].
+        footpath_dict (dict): preprocessed dict. Format {from_stop_id: [(to_stop_id, footpath_time)]}.
+        trip_transfer_dict (nested dict): keys: id of trip we are transferring from ("route_tid"), value: {stop number: list of tuples
+        of form (id of trip we are transferring to, stop number)}
+    Returns:
+        stoptimes_dict (dict): Format {route_id: [[trip_1], [trip_2]]} where trip_1 = [(stop id, arrival seconds)].
+        footpath_dict (dict): Format {from_stop_id: [(to_stop_id, footpath seconds)]}.
+        trip_transfer_dict (nested dict): Same as input with integer trip ids.
+        departures_dict (dict): all departures from a stop. Format {stop_id: [(trip, departure seconds, stop index)]}.
+        trip_route_idx (list): route and position of every trip. Format trip_route_idx[trip] = (route_id, trip index in route).
+        route_trip_offset (dict): first trip of every route. Format {route_id: trip}.
+        day_start (pandas.datetime): timestamp corresponding to 0 seconds.
+    '''
+    day_start = min(trips[0][0][1] for trips in stoptimes_dict.values() if trips).normalize()
+    trip_route_idx, route_trip_offset, trip_name_dict = [], {}, {}
+    stoptimes_dict_int, departures_dict = {}, defaultdict(list)
+    for route in sorted(stoptimes_dict.keys()):
+        route_trip_offset[route] = len(trip_route_idx)
+        trips = []
+        for tid_idx, trip in enumerate(stoptimes_dict[route]):
+            trip_int = len(trip_route_idx)
+            trip_route_idx.append((route, tid_idx))
+            trip_name_dict[f"{route}_{tid_idx}"] = trip_int
+            trip = [(stop, int((arrival - day_start).total_seconds())) for stop, arrival in trip]
+            for stop_idx, (stop, arrival) in enumerate(trip):
+                departures_dict[stop].append((trip_int, arrival, stop_idx))
+            trips.append(trip)
+        stoptimes_dict_int[route] = trips
+    footpath_dict_int = {from_stop: [(to_stop, int(foot_time.total_seconds())) for to_stop, foot_time in connections]
+                         for from_stop, connections in footpath_dict.items()}
+    trip_transfer_dict_int = {trip_name_dict[from_trip]: {stop_idx: [(trip_name_dict[to_trip], to_stop_idx) for to_trip, to_stop_idx in transfers]
+                                                         for stop_idx, transfers in stop_transfers.items()}
+                              for from_trip, stop_transfers in trip_transfer_dict.items()}
+    return stoptimes_dict_int, footpath_dict_int, trip_transfer_dict_int, dict(departures_dict), trip_route_idx, route_trip_offset, day_start
+
+
+def trip_transfer_table(trip_transfer_dict, trip_route_idx, stops_dict):
+    '''
+    Stores the trip transfers of encode_network as flat arrays (the layout of the network snapshot), so forked workers share
+    them instead of each touching a nested dict of tuples. Slot trip_slot_start[trip] + stop index stands for a stop of a trip,
+    its transfers are transfer_trip/transfer_stop_idx[transfer_start[slot]: transfer_start[slot + 1]] in trip_transfer_dict order.
+    Args:
+        trip_transfer_dict (nested dict): Format {trip: {stop index: [(trip, stop index)]}} with the integer trips of encode_network.
+        trip_route_idx (list): route and position of every trip. Format trip_route_idx[trip] = (route_id, trip index in route).
+        stops_dict (dict): preprocessed dict. Format {route_id: [ids of stops in the route]}.
+    Returns:
+        trip_transfers (dict): Format {"trip_slot_start": int64, "transfer_start": int64, "transfer_trip": int32, "transfer_stop_idx": int32,
+            "trip_has_transfers": uint8} numpy arrays.
+    '''
+    trip_slot_start = np.zeros(len(trip_route_idx) + 1, dtype=np.int64)
+    trip_slot_start[1:] = np.cumsum([len(stops_dict[route]) for route, _ in trip_route_idx])
+    trip_has_transfers = np.zeros(len(trip_route_idx), dtype=np.uint8)
+    transfer_count = np.zeros(trip_slot_start[-1], dtype=np.int64)
+    transfer_trip, transfer_stop_idx = [], []
+    for trip, stop_transfers in sorted(trip_transfer_dict.items()):
+        trip_has_transfers[trip] = 1
+        for stop_idx, transfers in sorted(stop_transfers.items()):
+            transfer_count[trip_slot_start[trip] + stop_idx] = len(transfers)
+            for to_trip, to_stop_idx in transfers:
+                transfer_trip.append(to_trip)
+                transfer_stop_idx.append(to_stop_idx)
+    return {"trip_slot_start": trip_slot_start, "transfer_start": np.concatenate([[0], np.cumsum(transfer_count)]),
+            "transfer_trip": np.asarray(transfer_trip, dtype=np.int32), "transfer_stop_idx": np.asarray(transfer_stop_idx, dtype=np.int32),
+            "trip_has_transfers": trip_has_transfers}
+
+
+def local_trip_transfers(trip_transfers, trip_route_idx, stops_dict, hubs):
+    '''
+    Trip transfers of the local searches of a hub based run (Bast et al.): the transfers boarding a trip at a hub are left out, so a
+    local search never continues past the first hub of a journey. Journeys beyond it are covered by the global patterns of the hub.
+    Args:
+        trip_transfers (dict): as returned by trip_transfer_table.
+        trip_route_idx (list): route and position of every trip. Format trip_route_idx[trip] = (route_id, trip index in route).
+        stops_dict (dict): preprocessed dict. Format {route_id: [ids of stops in the route]}.
+        hubs (set): stop ids of the hubs.
+    Returns:
+        trip_transfers (dict): the remaining transfers in the layout of trip_transfer_table.
+    '''
+    route_stop_start, flat_stops = {}, []
+    for route, route_stops in stops_dict.items():
+        route_stop_start[route] = len(flat_stops)
+        flat_stops.extend(route_stops)
+    trip_stop_start = np.array([route_stop_start[route] for route, _ in trip_route_idx], dtype=np.int64)
+    transfer_trip, transfer_stop_idx = np.asarray(trip_transfers["transfer_trip"]), np.asarray(trip_transfers["transfer_stop_idx"])
+    board_stop = np.array(flat_stops, dtype=np.int64)[trip_stop_start[transfer_trip] + transfer_stop_idx]
+    keep = ~np.isin(board_stop, np.fromiter(hubs, dtype=np.int64, count=len(hubs)))
+    # The transfers kept before every old boundary give the new boundaries.
+    kept_before = np.concatenate([[0], np.cumsum(keep)])
+    transfer_start = kept_before[np.asarray(trip_transfers["transfer_start"])]
+    trip_bounds = transfer_start[np.asarray(trip_transfers["trip_slot_start"])]
+    return {"trip_slot_start": trip_transfers["trip_slot_start"], "transfer_start": transfer_start, "transfer_trip": transfer_trip[keep],
+            "transfer_stop_idx": transfer_stop_idx[keep],
+            "trip_has_transfers": (np.asarray(trip_transfers["trip_has_transfers"]) & (trip_bounds[1:] > trip_bounds[:-1])).astype(np.uint8)}
+
+
+def seconds_to_clock(seconds):
+    '''
+    Formats seconds since service-day start as HH:MM:SS (hours can exceed 24 for after-midnight trips).
+    '''
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
 
 
 def initialize_onemany(MAX_TRANSFER, DESTINATION_LIST):
@@ -10,53 +123,62 @@ def initialize_onemany(MAX_TRANSFER, DESTINATION_LIST):
         MAX_TRANSFER (int): maximum transfer limit.
         DESTINATION_LIST (list): list of stop ids of destination stop.
     Returns:
-        J (dict): dict to store arrival timestamps. Keys: number of transfer, Values: arrival time.
-        inf_time (pandas.datetime): Variable indicating infinite time.
+        J (dict): dict to store arrival times (seconds). Keys: number of transfer, Values: arrival time.
+        inf_time (int): Variable indicating infinite time.
     '''
-    #    inf_time = pd.to_datetime("today").round(freq='H') + pd.to_timedelta("365 day")
-    inf_time = pd.to_datetime("2023-01-26 20:00:00")
+    inf_time = INF_TIME
     J = {desti: {x: [inf_time, 0] for x in range(MAX_TRANSFER+1)} for desti in DESTINATION_LIST}
     return J, inf_time
 
 
 def initialize_from_desti_onemany(routes_by_stop_dict, stops_dict, DESTINATION_LIST, footpath_dict, idx_by_route_stop_dict):
     '''
-    initialize routes/footpath to leading to destination stop in case of one-to-many rTBTR
+    initialize routes/footpath to leading to destination stop in case of one-to-many rTBTR.
+    L does not depend on the source, so it is built once per network (for all stops) and shared by every
+    onetomany_rtbtr call. It is inverted by route so that a trip segment only looks at the destinations
+    reachable from its own stops.
     Args:
         routes_by_stop_dict (dict): preprocessed dict. Format {stop_id: [id of routes passing through stop]}.
         stops_dict (dict): preprocessed dict. Format {route_id: [ids of stops in the route]}.
         DESTINATION_LIST (list): list of stop ids of destination stop.
-        footpath_dict (dict): preprocessed dict. Format {from_stop_id: [(to_stop_id, footpath_time)]}.
+        footpath_dict (dict): preprocessed dict. Format {from_stop_id: [(to_stop_id, footpath seconds)]}.
         idx_by_route_stop_dict (dict): preprocessed dict. Format {(route id, stop id): stop index in route}.
     Returns:
-        L (nested dict): A dict to track routes/leading to destination stops. Key: route_id, value: {destination_stop_id: [(from_stop_idx, travel time, stop id)]}
+        L (dict): A dict to track routes/footpaths leading to destination stops. Key: route_id, value: (from_stop_idx, destination, walking time)
+        int32 arrays sorted by from_stop_idx, the destination given by its position in routes_by_stop_dict. Walking time is 0 if the
+        destination is on the route.
     '''
-    L_dict_final = {}
+    L_dict = defaultdict(lambda: [])
     for destination in DESTINATION_LIST:
-        L_dict = defaultdict(lambda: [])
         try:
             transfer_to_desti = footpath_dict[destination]
             for from_stop, foot_time in transfer_to_desti:
                 try:
                     walkalble_desti_route = routes_by_stop_dict[from_stop]
                     for route in walkalble_desti_route:
-                        L_dict[route].append((idx_by_route_stop_dict[(route, from_stop)], foot_time, from_stop))
+                        L_dict[route].append((idx_by_route_stop_dict[(route, from_stop)], destination, foot_time))
                 except KeyError:
                     pass
         except KeyError:
             pass
-        delta_tau = pd.to_timedelta(0, unit="seconds")
+        delta_tau = 0
         for route in routes_by_stop_dict[destination]:
-            L_dict[route].append((idx_by_route_stop_dict[(route, destination)], delta_tau, destination))
-        L_dict_final[destination] = dict(L_dict)
-    return L_dict_final
+            L_dict[route].append((idx_by_route_stop_dict[(route, destination)], destination, delta_tau))
+    stop_col = {stop: x for x, stop in enumerate(routes_by_stop_dict)}
+    L = {}
+    for route, last_legs in L_dict.items():
+        last_legs.sort()
+        L[route] = (np.array([from_stop_idx for from_stop_idx, _, _ in last_legs], dtype=np.int32),
+                    np.array([stop_col[destination] for _, destination, _ in last_legs], dtype=np.int32),
+                    np.array([foot_time for _, _, foot_time in last_legs], dtype=np.int32))
+    return L
 
 
 def update_label(label, no_of_transfer, predecessor_label, J, MAX_TRANSFER):
     '''
     Updates and returns destination pareto set.
     Args:
-        label (pandas.datetime): optimal arrival time .
+        label (int): optimal arrival time (seconds).
         no_of_transfer (int): number of transfer.
         predecessor_label (tuple): predecessor_label for backtracking (To be developed)
         J (dict): dict to store arrival timestamps. Keys: number of transfer, Values: arrival time
@@ -71,6 +193,36 @@ def update_label(label, no_of_transfer, predecessor_label, J, MAX_TRANSFER):
     return J
 
 
+def initialize_rt(MAX_TRANSFER, route_times, route_trip_offset):
+    '''
+    Initialize R_t for rTBTR. Trips of a route occupy a contiguous block of columns, so "all later trips of the route"
+    is a slice. Cells of unreached trips hold the route length, i.e. the trip can be scanned till its last stop.
+    Args:
+        MAX_TRANSFER (int): maximum transfer limit.
+        route_times (dict): arrival time matrices from route_timetable. Format {route_id: route_times[route_id][tid, stop index] = arrival seconds}.
+        route_trip_offset (dict): first trip of every route. Format {route_id: trip}.
+    Returns:
+        R_t (numpy.ndarray): int32 array of shape (MAX_TRANSFER + 2, number of trips). Format R_t[round, trip] = first reached stop index.
+    '''
+    R_t = np.empty((MAX_TRANSFER + 2, sum(len(times) for times in route_times.values())), dtype=np.int32)
+    for route, first_trip in route_trip_offset.items():
+        times = route_times[route]
+        if len(times):
+            R_t[:, first_trip: first_trip + len(times)] = times.shape[1]
+    return R_t
+
+
+def route_timetable(stoptimes_dict):
+    '''
+    Arrival times of every route as one matrix, so that a trip segment is a row slice and its stops are compared in bulk.
+    Args:
+        stoptimes_dict (dict): preprocessed dict. Format {route_id: [[trip_1], [trip_2]]} where trip_1 = [(stop id, arrival seconds)].
+    Returns:
+        route_times (dict): int32 arrays of shape (number of trips, number of stops). Format {route_id: route_times[route_id][tid, stop index] = arrival seconds}.
+    '''
+    return {route: np.array([[arrival for _, arrival in trip] for trip in trips], dtype=np.int32) for route, trips in stoptimes_dict.items()}
+
+
 def post_process_range(J, Q, rounds_desti_reached, PRINT_ITINERARY, DESTINATION, SOURCE, footpath_dict, stops_dict, stoptimes_dict, d_time, MAX_TRANSFER, trip_transfer_dict):
     '''
     Contains all the post-processing features for rTBTR.
@@ -91,211 +243,114 @@ def post_process_range(J, Q, rounds_desti_reached, PRINT_ITINERARY, DESTINATION,
         no_of_transfer = transfer_needed
         current_trip = J[transfer_needed][1][0]
         journey = []
-        while current_trip != 0:
+        while current_trip is not None:
             journey.append(current_trip)
-            current_trip = [x for x in Q[no_of_transfer] if x[1] == current_trip][-1][-1][0]
+            current_trip = [x for x in Q[no_of_transfer] if x[1] == current_trip][-1][5][0]
             no_of_transfer = no_of_transfer - 1
         necessory_trips.extend(journey)
     return set(necessory_trips)
 
 
-def initialize_from_source_range(dep_details, MAX_TRANSFER, stoptimes_dict, R_t):
+def initialize_from_source_range(dep_list, MAX_TRANSFER, route_times, R_t, trip_route_idx, route_trip_offset):
     '''
     Initialize trips segments from source in rTBTR
     Args:
-        dep_details (list): list of format [trip id, departure time, source index]
+        dep_list (list): departures boarded in the first round, usually a single one. Format [(trip, departure time, source index)].
         MAX_TRANSFER (int): maximum transfer limit.
-        stoptimes_dict (dict): preprocessed dict. Format {route_id: [[trip_1], [trip_2]]}.
-        R_t (nested dict): Nested_Dict with primary keys as trip id and secondary keys as number of transfers. Format {trip_id: {[round]: first reached stop}}
+        route_times (dict): arrival time matrices from route_timetable. Format {route_id: route_times[route_id][tid, stop index] = arrival seconds}.
+        R_t (numpy.ndarray): first reached stop index. Format R_t[round, trip] = stop index.
+        trip_route_idx (list): route and position of every trip. Format trip_route_idx[trip] = (route_id, trip index in route).
+        route_trip_offset (dict): first trip of every route. Format {route_id: trip}.
     Returns:
         Q (list): list of trips segments
     '''
     Q = [[] for x in range(MAX_TRANSFER + 2)]
-    route, trip_idx = [int(x) for x in dep_details[0].split("_")]
-    stop_index = dep_details[2]
-    # _enqueue_range1(f'{route}_{trip_idx}', stop_index, n, (0, 0), R_t, Q, stoptimes_dict, MAX_TRANSFER)
-    connection_list = [(f'{route}_{trip_idx}', stop_index)]
-    enqueue_range(connection_list, 1, (0, 0), R_t, Q, stoptimes_dict, MAX_TRANSFER)
+    connection_list = [((trip, idx), None) for trip, _, idx in dep_list]
+    enqueue_range(connection_list, 1, (None, None), R_t, Q, route_times, MAX_TRANSFER, trip_route_idx, route_trip_offset)
     return Q
 
 
-def enqueue_range(connection_list, nextround, predecessor_label, R_t, Q, stoptimes_dict, MAX_TRANSFER):
+def enqueue_range(connection_list, nextround, predecessor_label, R_t, Q, route_times, MAX_TRANSFER, trip_route_idx, route_trip_offset, stats=None):
     '''
     adds trips-segments to next round round and update R_t. Used in range queries
     Args:
-        connection_list (list): list of connections to be added. Format: [(to_trip_id, to_trip_id_stop_index)].
+        connection_list (list): list of connections to be added. Format: [((to_trip, to_trip_stop_index), transfer stop index)] where the transfer
+        stop index is the stop of the predecessor trip the transfer starts from (None for trips boarded at the source).
         nextround (int): next round/transfer number to which trip-segments are added
-        predecessor_label (tuple): predecessor_label for backtracking journey ( To be developed ).
-        R_t (nested dict): Nested_Dict with primary keys as trip id and secondary keys as number of transfers. Format {trip_id: {[round]: first reached stop}}
+        predecessor_label (tuple): predecessor_label for backtracking journey. Format (trip, segment counter). (None, None) for trips boarded at the source.
+        R_t (numpy.ndarray): first reached stop index. Format R_t[round, trip] = stop index.
         Q (list): list of trips segments
-        stoptimes_dict (dict): preprocessed dict. Format {route_id: [[trip_1], [trip_2]]}.
+        route_times (dict): arrival time matrices from route_timetable. Format {route_id: route_times[route_id][tid, stop index] = arrival seconds}.
         MAX_TRANSFER (int): maximum transfer limit.
+        trip_route_idx (list): route and position of every trip. Format trip_route_idx[trip] = (route_id, trip index in route).
+        route_trip_offset (dict): first trip of every route. Format {route_id: trip}.
+        stats (dict): optional round statistics of onetomany_rtbtr. The number of R_t cells lowered is added to stats["rt_updates"].
     Returns: None
     '''
-    for to_trip_id, to_trip_id_stop in connection_list:
-        if to_trip_id_stop < R_t[nextround][to_trip_id]:
-            route, tid = [int(x) for x in to_trip_id.split("_")]
-            Q[nextround].append((to_trip_id_stop, to_trip_id, R_t[nextround][to_trip_id], route, tid, predecessor_label))
-            for x in range(tid, len(stoptimes_dict[route]) + 1):
-                for r in range(nextround, MAX_TRANSFER + 1):
-                    new_tid = f"{route}_{x}"
-                    if R_t[r][new_tid] > to_trip_id_stop:
-                        R_t[r][new_tid] = to_trip_id_stop
-
-
-def post_process_range_onemany(J, Q, rounds_desti_reached, PRINT_ITINERARY, desti, SOURCE, footpath_dict,
-                               stops_dict, stoptimes_dict, d_time, MAX_TRANSFER, trip_transfer_dict):
+    for (to_trip_id, to_trip_id_stop), transfer_stop_idx in connection_list:
+        reached_stop = int(R_t[nextround, to_trip_id])
+        if to_trip_id_stop < reached_stop:
+            route, tid = trip_route_idx[to_trip_id]
+            Q[nextround].append((to_trip_id_stop, to_trip_id, reached_stop, route, tid, predecessor_label, transfer_stop_idx))
+            later_trips = R_t[nextround: MAX_TRANSFER + 1, to_trip_id: route_trip_offset[route] + len(route_times[route])]
+            if stats is not None:
+                stats["rt_updates"] += int(np.count_nonzero(later_trips > to_trip_id_stop))
+            np.minimum(later_trips, to_trip_id_stop, out=later_trips)
+
+
+def post_process_range_onemany(J, Q, rounds_desti_reached, PRINT_ITINERARY, desti, SOURCE, stops_dict, stoptimes_dict, trip_route_idx, footpath_time_dict):
     '''
     Contains all the post-processing features for One-To-Many rTBTR.
     Currently supported functionality:
-        Collect list of trips needed to cover pareto-optimal journeys.
+        Collect transfer patterns of pareto-optimal journeys.
     Args:
         J (dict): dict to store arrival timestamps. Keys: number of transfer, Values: arrival time
         Q (list): list of trips segments.
         rounds_desti_reached (list): Rounds in which DESTINATION is reached.
         desti (int): destination stop id.
+        trip_route_idx (list): route and position of every trip. Format trip_route_idx[trip] = (route_id, trip index in route).
+        footpath_time_dict (dict): Format {(from_stop_id, to_stop_id): footpath seconds}. Only read if PRINT_ITINERARY == 1.
     Returns:
-        TBTR_out (set): Trips needed to cover pareto-optimal journeys.
+        TP (list): transfer patterns of pareto-optimal journeys. Format [[stop ids in journey order]].
     '''
     rounds_desti_reached = list(set(rounds_desti_reached))
-    TP = _print_tbtr_journey_otm(J, Q, desti, SOURCE, footpath_dict, stops_dict, stoptimes_dict, d_time, MAX_TRANSFER, trip_transfer_dict, rounds_desti_reached, PRINT_ITINERARY)
+    TP = _print_tbtr_journey_otm(J, Q, desti, SOURCE, stops_dict, stoptimes_dict, rounds_desti_reached, PRINT_ITINERARY, trip_route_idx, footpath_time_dict)
     return TP
 
-def _print_tbtr_journey_otm(J, Q, DESTINATION, SOURCE, footpath_dict, stops_dict, stoptimes_dict, D_TIME, MAX_TRANSFER, trip_transfer_dict, rounds_desti_reached, PRINT_ITINERARY):
+def _print_tbtr_journey_otm(J, Q, DESTINATION, SOURCE, stops_dict, stoptimes_dict, rounds_desti_reached, PRINT_ITINERARY, trip_route_idx, footpath_time_dict):
+    '''
+    Backtracks the journeys to DESTINATION by following predecessor pointers. Every trip segment in Q stores the segment it was
+    reached from and the stop index at which that trip was left, and the destination label stores the stop index at which the
+    last trip is left, so every leg is read off directly.
+    Args:
+        J (dict): destination labels. J[DESTINATION][round][1] = (trip, walking, segment counter, alighting stop index).
+        Q (list): list of trips segments. Format Q[round] = [(boarding stop index, trip, reached stop index, route, tid, predecessor_label, transfer stop index)].
+        rounds_desti_reached (list): Rounds in which DESTINATION is reached.
+        trip_route_idx (list): route and position of every trip. Format trip_route_idx[trip] = (route_id, trip index in route).
+        footpath_time_dict (dict): Format {(from_stop_id, to_stop_id): footpath seconds}. Only read if PRINT_ITINERARY == 1.
+    Returns:
+        TP_list (list): one transfer pattern per round. Format [[stop ids in journey order]].
+    '''
     TP_list = []
     for x in reversed(rounds_desti_reached):
-        round_no = x
+        _, walking, trip_segement_counter, alight_idx = J[DESTINATION][x][1]
         journey = []
-        trip_segement_counter = J[DESTINATION][x][1][2]
-        while round_no>0:
-            pred = Q[round_no][trip_segement_counter]
-            journey.append((pred[5][0], pred[1], pred[0]))
-            trip_segement_counter = pred[5][1]
-            round_no = round_no - 1
-        from_stop_list = []
-        for id, t_transfer in enumerate(journey[:-1]):
-            from_Stop_onwards = journey[id+1][2]
-            for from_stop, trasnsfer_list in trip_transfer_dict[t_transfer[0]].items():
-                if from_stop<from_Stop_onwards:
-                    continue
-                else:
-                    if (t_transfer[1], t_transfer[2]) in trasnsfer_list:
-                        from_stop_list.append(from_stop)
-        journey_final = [(journey[counter][0], x, journey[counter][1], journey[counter][2]) for counter, x in enumerate(from_stop_list)]
-        # from source
-        from_trip, from_stop_idxx= journey[-1][1], journey[-1][2]
-        fromstopid = stops_dict[int(from_trip.split("_")[0])][from_stop_idxx]
-        if fromstopid==SOURCE:
-            journey_final.append(("trip",0, from_trip, from_stop_idxx))
-        else:
-            for to_stop, to_time in footpath_dict[fromstopid]:
-                if to_stop== SOURCE:
-                    journey_final.append(("walk", SOURCE, fromstopid, to_time+D_TIME))
-                    break
-        #Add final lag. Destination can either be along the route or at a walking distance from it.
-        if J[DESTINATION][x][1][1] != (0, 0):    #Add here if the destination is at walking distance from final route
-            try:
-                final_route, boarded_from = int(journey_final[0][2].split("_")[0]), journey_final[0][3]
-                found = 0
-                for walking_from_stop_idx, stop_id in enumerate(stops_dict[final_route]):
-                    if walking_from_stop_idx<boarded_from:continue
-                    try:
-                        for to_stop, to_stop_time in footpath_dict[stop_id]:
-                            if to_stop==DESTINATION:
-                                found = 1
-                                journey_final.insert(0, ("walk", journey_final[0][2], boarded_from, walking_from_stop_idx, to_stop_time)) #walking_pointer, from_trip, from_stop, to_stop
-                                break
-                    except KeyError:continue
-                    if found==1:break
-            except AttributeError:
-                if len(journey_final)==1:
-                    final_route =int(J[DESTINATION][x][1][0].split("_")[0])
-                    boarded_from = stops_dict[final_route].index(journey_final[0][2])
-                    found = 0
-                    for walking_from_stop_idx, stop_id in enumerate(stops_dict[final_route]):
-                        if walking_from_stop_idx<boarded_from:continue
-                        try:
-                            for to_stop, to_stop_time in footpath_dict[stop_id]:
-                                if to_stop==DESTINATION:
-                                    found = 1
-                                    journey_final.insert(0, ("walk", J[DESTINATION][x][1][0], boarded_from, walking_from_stop_idx, to_stop_time)) #walking_pointer, from_trip, from_stop, to_stop
-                                    break
-                        except KeyError:continue
-                        if found==1:break
-                else:raise NameError
-        else:   #Destination is along the route.
-            try:
-                final_route, boarded_from = int(journey_final[0][2].split("_")[0]), journey_final[0][3]
-                desti_index = stops_dict[final_route].index(DESTINATION)
-                journey_final.insert(0, ("trip", journey_final[0][2], boarded_from, desti_index)) #walking_pointer, from_trip, from_stop, to_stop
-            except AttributeError:
-                if len(journey_final)==1:
-                    final_route =int(J[DESTINATION][x][1][0].split("_")[0])
-                    boarded_from = stops_dict[final_route].index(journey_final[0][2])
-                    desti_index = stops_dict[final_route].index(DESTINATION)
-                    journey_final.insert(0, ("trip", J[DESTINATION][x][1][0], boarded_from, desti_index)) #walking_pointer, from_trip, from_stop, to_stop
-        if journey_final==[]:
-            tid = [int(x) for x in journey[0][1].split("_")]
-            tostop_det = stops_dict[tid[0]].index(DESTINATION)
-            journey_final.append((journey[0][1], stoptimes_dict[tid[0]][tid[1]][journey[0][2]], stoptimes_dict[tid[0]][tid[1]][tostop_det]))
-        journey_final.reverse()
-        journey_final_copy = journey_final.copy()
-        journey_final.clear()
-        for c, leg in enumerate(journey_final_copy):
-            if c==0:
-                if leg[0]=="trip":
-                    [trip_route, numb], fromstopidx = [int(x) for x in leg[2].split("_")], leg[3]
-                    try:
-                        journey_final.append([leg[2], stoptimes_dict[trip_route][numb][fromstopidx], stoptimes_dict[trip_route][numb][journey_final_copy[c+1][1]]])
-                    except TypeError:
-                        try:
-                            journey_final.append([leg[2], stoptimes_dict[trip_route][numb][fromstopidx], stoptimes_dict[trip_route][numb][stops_dict[trip_route].index(DESTINATION)]])
-                            break
-                        except ValueError:
-                            journey_final.append([leg[2], stoptimes_dict[trip_route][numb][fromstopidx], stoptimes_dict[trip_route][numb][journey_final_copy[c+1][3]]])
-                elif leg[0]=="walk":
-                    journey_final.append(("walk", leg[1], leg[2], [time for stop, time in footpath_dict[leg[1]] if stop==leg[2]][0]))
-            elif c==len(journey_final_copy)-1:
-                if leg[0]=="trip":
-                    [trip_route, numb], fromstopidx, tostopidx = [int(x) for x in leg[1].split("_")], leg[2], leg[3]
-                    journey_final.append([leg[1], stoptimes_dict[trip_route][numb][fromstopidx], stoptimes_dict[trip_route][numb][tostopidx]])
-                elif leg[0]=="walk":
-                    from_trip = [int(x) for x in leg[1].split("_")]
-                    journey_final.append((leg[1], stoptimes_dict[from_trip[0]][from_trip[1]][leg[2]], stoptimes_dict[from_trip[0]][from_trip[1]][leg[3]]))
-                    foot_connect = stoptimes_dict[from_trip[0]][from_trip[1]][leg[3]]
-                    last_foot_tme = [time for stop, time in footpath_dict[foot_connect[0]] if stop==DESTINATION][0]
-                    journey_final.append(("walk", foot_connect[0], DESTINATION, last_foot_tme, stoptimes_dict[from_trip[0]][from_trip[1]][leg[3]][1] + last_foot_tme))
-            else:
-                if c==1:
-                    if journey_final_copy[c-1][0]=="walk":
-                        [trip_route, numb], tostopidx = [int(x) for x in leg[0].split("_")], leg[1]
-                        fromstopidx = stops_dict[trip_route].index(journey_final_copy[c-1][2])
-                        journey_final.append([leg[0], stoptimes_dict[trip_route][numb][fromstopidx], stoptimes_dict[trip_route][numb][tostopidx]])
-                    elif journey_final_copy[c-1][0]=="trip":
-                        [trip_route, numb], tostopidx = [int(x) for x in leg[0].split("_")], leg[1]
-                        fromstopidx = stops_dict[trip_route].index(SOURCE)
-                        if [leg[0], stoptimes_dict[trip_route][numb][fromstopidx], stoptimes_dict[trip_route][numb][tostopidx]] not in journey_final:
-                            journey_final.append([leg[0], stoptimes_dict[trip_route][numb][fromstopidx], stoptimes_dict[trip_route][numb][tostopidx]])
-                from_stop = stops_dict[int(journey_final_copy[c][0].split("_")[0])][int(journey_final_copy[c][1])]
-                to_stop = stops_dict[int(journey_final_copy[c][2].split("_")[0])][int(journey_final_copy[c][3])]
-                if from_stop!=to_stop:
-                    time_needed = [x[1] for x in footpath_dict[from_stop] if x[0]==to_stop][0]
-                    journey_final.append(("walk", from_stop, to_stop, time_needed))
-                    if c+1!=len(journey_final_copy)-1:
-                        [trip_route, numb], fromstopidx = [int(x) for x in leg[2].split("_")], leg[3]
-                        journey_final.append([leg[2], stoptimes_dict[trip_route][numb][fromstopidx], stoptimes_dict[trip_route][numb][journey_final_copy[c+1][1]]])
-                elif from_stop==to_stop:
-                    if c+1!=len(journey_final_copy)-1:
-                        [trip_route, numb], fromstopidx = [int(x) for x in leg[2].split("_")], leg[3]
-                        journey_final.append([leg[2], stoptimes_dict[trip_route][numb][fromstopidx], stoptimes_dict[trip_route][numb][journey_final_copy[c+1][1]]])
-        TP = []
-        for leg in journey_final:
-            if leg[0]=="walk":
-                if PRINT_ITINERARY==1:print(f"from {leg[1]} walk till  {leg[2]} for {leg[3].total_seconds()} seconds")
-                TP.extend([leg[1], leg[2]])
-            else:
-                if PRINT_ITINERARY==1: print(f"from {leg[1][0]} board at {leg[1][1].time()} and get down on {leg[2][0]} at {leg[2][1].time()} along {leg[0]}")
-                TP.extend([leg[1][0], leg[2][0]])
+        for round_no in range(x, 0, -1):
+            board_idx, trip, _, route, tid, predecessor_label, transfer_stop_idx = Q[round_no][trip_segement_counter]
+            journey.append((trip, route, tid, board_idx, alight_idx))
+            trip_segement_counter, alight_idx = predecessor_label[1], transfer_stop_idx
+        TP = [SOURCE]
+        for trip, route, tid, board_idx, alight_idx in reversed(journey):
+            board_stop, alight_stop = stops_dict[route][board_idx], stops_dict[route][alight_idx]
+            if PRINT_ITINERARY == 1:
+                if board_stop != TP[-1]:
+                    print(f"from {TP[-1]} walk till  {board_stop} for {footpath_time_dict[(TP[-1], board_stop)]} seconds")
+                trip_times = stoptimes_dict[route][tid]
+                print(f"from {board_stop} board at {seconds_to_clock(trip_times[board_idx][1])} and get down on {alight_stop} at {seconds_to_clock(trip_times[alight_idx][1])} along {trip}")
+            TP.extend([board_stop, alight_stop])
+        if walking[0] == 1:
+            if PRINT_ITINERARY == 1: print(f"from {walking[1]} walk till  {DESTINATION} for {footpath_time_dict[(walking[1], DESTINATION)]} seconds")
+            TP.append(DESTINATION)
         TP_list.append(list(dict.fromkeys(TP)))
         if PRINT_ITINERARY==1: print("####################################")
     return TP_list
@@ -314,93 +369,179 @@ def direct_connection_tabe(stop_times_file):
     connection_dict = dict(connection_dict)
     return connection_dict
 
-def onetomany_rtbtr(SOURCE, DESTINATION_LIST, d_time_groups, MAX_TRANSFER, WALKING_FROM_SOURCE, PRINT_ITINERARY, OPTIMIZED,
-                    routes_by_stop_dict, stops_dict, stoptimes_dict, footpath_dict, idx_by_route_stop_dict, trip_transfer_dict, trip_set):
+def source_departures(SOURCE, departures_dict, footpath_dict, WALKING_FROM_SOURCE):
+    '''
+    Lists the departures the range query of SOURCE sweeps over, latest first.
+    Args:
+        SOURCE (int): stop id of source stop.
+        departures_dict (dict): all possible departures times from all stops. Format {stop_id: [(trip, departure seconds, stop index)]}.
+        footpath_dict (dict): preprocessed dict. Format {from_stop_id: [(to_stop_id, footpath seconds)]}.
+        WALKING_FROM_SOURCE (int): 1 or 0. 1 means the departures of stops within walking distance of SOURCE are included.
+    Returns:
+        d_time_list (list): Format [(trip, departure seconds, stop index)].
+    '''
+    d_time_list = departures_dict[SOURCE].copy()
+    if WALKING_FROM_SOURCE == 1:
+        try:
+            source_footpaths = footpath_dict[SOURCE]
+            for connection in source_footpaths:
+                d_time_list.extend(departures_dict[connection[0]])
+        except KeyError:
+            pass
+    d_time_list.sort(key=lambda x: x[1], reverse=True)
+    return d_time_list
+
+
+def onetomany_rtbtr(SOURCE, DESTINATION_LIST, departures_dict, MAX_TRANSFER, WALKING_FROM_SOURCE, PRINT_ITINERARY, OPTIMIZED,
+                    routes_by_stop_dict, stops_dict, stoptimes_dict, footpath_dict, idx_by_route_stop_dict, trip_transfers,
+                    trip_route_idx, route_trip_offset, L, route_times, stats=None, pattern_sink=None, d_time_window=None):
     """
     One to many rTBTR implementation
     Args:
         SOURCE (int): stop id of source stop.
-        DESTINATION_LIST (list): list of stop ids of destination stop.
-        d_time_groups (pandas.group): all possible departures times from all stops.
+        DESTINATION_LIST (list): list of stop ids of destination stop, all of them keys of routes_by_stop_dict.
+        departures_dict (dict): all possible departures times from all stops. Format {stop_id: [(trip, departure seconds, stop index)]}.
         MAX_TRANSFER (int): maximum transfer limit.
         WALKING_FROM_SOURCE (int): 1 or 0. 1 means walking from SOURCE is allowed.
         PRINT_ITINERARY (int): 1 or 0. 1 means print complete path.
         OPTIMIZED (int): 1 or 0. 1 means collect trips and 0 means collect routes.
         routes_by_stop_dict (dict): preprocessed dict. Format {stop_id: [id of routes passing through stop]}.
         stops_dict (dict): preprocessed dict. Format {route_id: [ids of stops in the route]}.
-        stoptimes_dict (dict): preprocessed dict. Format {route_id: [[trip_1], [trip_2]]}.
-        footpath_dict (dict): preprocessed dict. Format {from_stop_id: [(to_stop_id, footpath_time)]}.
+        stoptimes_dict (dict): preprocessed dict. Format {route_id: [[trip_1], [trip_2]]} where trip_1 = [(stop id, arrival seconds)].
+        footpath_dict (dict): preprocessed dict. Format {from_stop_id: [(to_stop_id, footpath seconds)]}.
         idx_by_route_stop_dict (dict): preprocessed dict. Format {(route id, stop id): stop index in route}.
-        trip_transfer_dict (nested dict): keys: id of trip we are transferring from, value: {stop number: list of tuples
-        of form (id of trip we are transferring to, stop number)}
-        trip_set (set): set of trip ids from which trip-transfers are available.
+        trip_transfers (dict): trip transfers as flat arrays, see trip_transfer_table.
+        trip_route_idx (list): route and position of every trip. Format trip_route_idx[trip] = (route_id, trip index in route).
+        route_trip_offset (dict): first trip of every route. Format {route_id: trip}.
+        L (dict): network wide destination lookup from initialize_from_desti_onemany. Format {route_id: (from_stop_idx, destination, walking time)}
+        route_times (dict): arrival time matrices from route_timetable. Format {route_id: route_times[route_id][tid, stop index] = arrival seconds}.
+        stats (list): optional. If given, one dict per departure is appended to it, Format {"d_time": departure seconds, "postprocess_s": seconds,
+            "rounds": [{"round", "segments_scanned", "segments_enqueued", "rt_updates", "labels_improved", "destinations_in_scope", "scan_s", "enqueue_s"}]}.
+            Left as None the search does no extra work.
+        pattern_sink (dict): optional DAG from new_pattern_sink the patterns are added to as they are found, e.g. one streaming to
+            the pattern file of SOURCE. It is closed before returning. By default the DAG is built in memory.
+        d_time_window (tuple): optional (start, end) departure seconds. Only the departures in [start, end) are swept and collect
+            patterns, so windows of one source can run on separate workers and their patterns be merged. The departures after the
+            window are first searched together as one departure (no patterns collected, "d_time" None in stats): that leaves J as
+            the sweep over them would and R_t no lower, so the window finds the journeys the full sweep finds.
+    All trips are the dense integer ids and all times are the seconds produced by encode_network.
     Returns:
-        if OPTIMIZED==1:
-            out (list):  list of trips required to cover all optimal journeys Format: [trip_id]
-        elif OPTIMIZED==0:
-            out (list):  list of routes required to cover all optimal journeys. Format: [route_id]
+        pattern_dag (dict): transfer patterns of all pareto-optimal journeys as a DAG with shared suffixes, every distinct pattern
+            stored once however many departures produce it. See close_pattern_sink, None if pattern_sink streams to a file.
     """
     DESTINATION_LIST.remove(SOURCE)
-    d_time_list = d_time_groups.get_group(SOURCE)[["trip_id", 'arrival_time', 'stop_sequence']].values.tolist()
-    if WALKING_FROM_SOURCE == 1:
-        try:
-            source_footpaths = footpath_dict[SOURCE]
-            for connection in source_footpaths:
-                d_time_list.extend(d_time_groups.get_group(connection[0])[["trip_id", 'arrival_time', 'stop_sequence']].values.tolist())
-        except KeyError:
-            pass
-    d_time_list.sort(key=lambda x: x[1], reverse=True)
+    d_time_list = source_departures(SOURCE, departures_dict, footpath_dict, WALKING_FROM_SOURCE)
+    sweep = [[dep_details] for dep_details in d_time_list]
+    seeded = False
+    if d_time_window is not None:
+        later = [dep_details for dep_details in d_time_list if dep_details[1] >= d_time_window[1]]
+        sweep = [[dep_details] for dep_details in d_time_list if d_time_window[0] <= dep_details[1] < d_time_window[1]]
+        if later:
+            # Earliest first, so the trips boarded first prune the later trips of their routes in R_t.
+            sweep.insert(0, later[::-1])
+            seeded = True
 
-    TP_list = []
+    if pattern_sink is None:
+        pattern_sink = new_pattern_sink(SOURCE)
+    footpath_time_dict = {(from_stop, to_stop): foot_time for from_stop, connections in footpath_dict.items() for to_stop, foot_time in connections} if PRINT_ITINERARY == 1 else {}
     J, inf_time = initialize_onemany(MAX_TRANSFER, DESTINATION_LIST)
-    L = initialize_from_desti_onemany(routes_by_stop_dict, stops_dict, DESTINATION_LIST, footpath_dict, idx_by_route_stop_dict)
-    R_t = {x: defaultdict(lambda: 1000) for x in range(0, MAX_TRANSFER + 2)}  # assuming maximum route length is 1000
+    # J_time mirrors the arrival times in J, one column per stop in routes_by_stop_dict order (the destinations of L), so that
+    # the legs of a trip segment are compared with one gather. in_scope marks the destinations still in scope in the round.
+    stop_LIST = list(routes_by_stop_dict)
+    stop_col = {stop: x for x, stop in enumerate(stop_LIST)}
+    J_time = np.full((MAX_TRANSFER + 1, len(stop_LIST)), inf_time, dtype=np.int64)
+    destination_mask = np.zeros(len(stop_LIST), dtype=bool)
+    destination_mask[[stop_col[desti] for desti in DESTINATION_LIST]] = True
+    R_t = initialize_rt(MAX_TRANSFER, route_times, route_trip_offset)
+    trip_slot_start, transfer_start, trip_has_transfers = trip_transfers["trip_slot_start"], trip_transfers["transfer_start"], trip_transfers["trip_has_transfers"]
+    transfer_trip, transfer_stop_idx = trip_transfers["transfer_trip"], trip_transfers["transfer_stop_idx"]
 
-    for dep_details in d_time_list:
+    for sweep_idx, dep_list in enumerate(sweep):
+        seed = seeded and sweep_idx == 0
         rounds_desti_reached = {x: [] for x in DESTINATION_LIST}
         n = 1
-        Q = initialize_from_source_range(dep_details, MAX_TRANSFER, stoptimes_dict, R_t)
-        dest_list_prime = DESTINATION_LIST.copy()
+        Q = initialize_from_source_range(dep_list, MAX_TRANSFER, route_times, R_t, trip_route_idx, route_trip_offset)
+        in_scope = destination_mask.copy()
+        if stats is not None:
+            departure_stats = {"d_time": None if seed else dep_list[0][1], "rounds": []}
+            stats.append(departure_stats)
+        round_stats = None
         while n <= MAX_TRANSFER:
-            stop_mark_dict = {stop: 0 for stop in dest_list_prime}
-            scope = []
+            scope_cols = np.flatnonzero(in_scope)
+            next_scope = np.zeros(len(stop_LIST), dtype=bool)
+            if stats is not None:
+                round_stats = {"round": n, "segments_scanned": len(Q[n]), "destinations_in_scope": len(scope_cols), "rt_updates": 0, "enqueue_s": 0.0}
+                departure_stats["rounds"].append(round_stats)
+                round_start = perf_counter()
             for counter, trip_segment in enumerate(Q[n]):
                 from_stop, tid, to_stop, trip_route, tid_idx = trip_segment[0: 5]
-                trip = stoptimes_dict[trip_route][tid_idx][from_stop:to_stop]
-                connection_list = []
-                for desti in dest_list_prime:
-                    try:
-                        L[desti][trip_route]
-                        stop_list, _ = zip(*trip)
-                        for last_leg in L[desti][trip_route]:
-                            idx = [x[0] for x in enumerate(stop_list) if x[1] == last_leg[2]]
-                            if idx and from_stop < last_leg[0] and trip[idx[0]][1] + last_leg[1] < J[desti][n][0]:
-                                if last_leg[1] == pd.to_timedelta(0, unit="seconds"):
+                arrival_row = route_times[trip_route][tid_idx]
+                if trip_route in L:
+                    leg_idx, leg_desti, leg_walk = L[trip_route]
+                    lo, hi = np.searchsorted(leg_idx, (from_stop + 1, to_stop + 1)).tolist()
+                    if lo < hi:
+                        leg_cols = leg_desti[lo:hi]
+                        leg_arrival = arrival_row[leg_idx[lo:hi]] + leg_walk[lo:hi]
+                        # Only the legs improving a label at the time of the gather are visited, in L order. An earlier leg of the
+                        # segment can improve the same destination further, so every one is checked again against J.
+                        for x in np.flatnonzero(in_scope[leg_cols] & (leg_arrival < J_time[n, leg_cols])).tolist():
+                            desti, label, alight_idx = stop_LIST[leg_cols[x]], int(leg_arrival[x]), int(leg_idx[lo + x])
+                            if label < J[desti][n][0]:
+                                if leg_walk[lo + x] == 0:
                                     walking = (0, 0)
                                 else:
-                                    walking = (1, stops_dict[trip_route][last_leg[0]])
-                                J[desti] = update_label(trip[idx[0]][1] + last_leg[1], n, (tid, walking, counter), J[desti], MAX_TRANSFER)
+                                    walking = (1, stops_dict[trip_route][alight_idx])
+                                J[desti] = update_label(label, n, (tid, walking, counter, alight_idx), J[desti], MAX_TRANSFER)
+                                np.minimum(J_time[n:, leg_cols[x]], label, out=J_time[n:, leg_cols[x]])
                                 rounds_desti_reached[desti].append(n)
-                    except KeyError:
-                        pass
-                    try:
-                        if tid in trip_set and trip[1][1] < J[desti][n][0]:
-                            if stop_mark_dict[desti]==0:
-                                scope.append(desti)
-                                stop_mark_dict[desti]=1
-                            connection_list.extend([connection for from_stop_idx, transfer_stop_id in enumerate(trip[1:], from_stop + 1)
-                                                    for connection in trip_transfer_dict[tid][from_stop_idx]])
-                    except IndexError:
-                        pass
-                connection_list = list(set(connection_list))
-                enqueue_range(connection_list, n + 1, (tid, counter, 0), R_t, Q, stoptimes_dict, MAX_TRANSFER)
-            dest_list_prime = [*scope]
+                # The segment runs up to and including to_stop, the stop the trip was reached at before: the segment that boarded there
+                # scanned only the stops after it, so the arrival at to_stop by an earlier boarding is new.
+                segment_length = min(to_stop + 1, len(arrival_row)) - from_stop
+                transfers_needed = False
+                if trip_has_transfers[tid] and segment_length > 1:
+                    # Destinations the next stop of the segment arrives before stay in scope for the next round.
+                    improvable = scope_cols[J_time[n, scope_cols] > arrival_row[from_stop + 1]]
+                    if len(improvable):
+                        next_scope[improvable] = True
+                        transfers_needed = True
+                if transfers_needed:
+                    # Transfers of the stops after from_stop are one contiguous run of the table. Keep the earliest stop a
+                    # connection can be made from, it is the transfer stop recorded for backtracking.
+                    first_slot = trip_slot_start[tid] + from_stop + 1
+                    bounds = transfer_start[first_slot: first_slot + segment_length].tolist()
+                    to_trips = transfer_trip[bounds[0]: bounds[-1]].tolist()
+                    to_stop_idxs = transfer_stop_idx[bounds[0]: bounds[-1]].tolist()
+                    connection_dict = {}
+                    for x in range(len(bounds) - 1):
+                        for y in range(bounds[x] - bounds[0], bounds[x + 1] - bounds[0]):
+                            connection_dict.setdefault((to_trips[y], to_stop_idxs[y]), from_stop + 1 + x)
+                    if round_stats is not None:
+                        enqueue_start = perf_counter()
+                    enqueue_range(connection_dict.items(), n + 1, (tid, counter), R_t, Q, route_times, MAX_TRANSFER, trip_route_idx, route_trip_offset, round_stats)
+                    if round_stats is not None:
+                        round_stats["enqueue_s"] += perf_counter() - enqueue_start
+            if round_stats is not None:
+                round_stats["segments_enqueued"] = len(Q[n + 1])
+                round_stats["scan_s"] = perf_counter() - round_start - round_stats["enqueue_s"]
+            in_scope = next_scope
             n = n + 1
-        for desti in DESTINATION_LIST:
+        if stats is not None:
+            # Every improved label appended its round to rounds_desti_reached.
+            improved = defaultdict(int)
+            for rounds in rounds_desti_reached.values():
+                for x in rounds:
+                    improved[x] += 1
+            for round_stats in departure_stats["rounds"]:
+                round_stats["labels_improved"] = improved[round_stats["round"]]
+            postprocess_start = perf_counter()
+        for desti in DESTINATION_LIST if not seed else ():
             if rounds_desti_reached[desti]:
-                TP_list.extend(post_process_range_onemany(J, Q, rounds_desti_reached[desti], PRINT_ITINERARY, desti, SOURCE, footpath_dict, stops_dict, stoptimes_dict,
-                                                          dep_details[1], MAX_TRANSFER, trip_transfer_dict))
-    return TP_list
+                for pattern in post_process_range_onemany(J, Q, rounds_desti_reached[desti], PRINT_ITINERARY, desti, SOURCE, stops_dict, stoptimes_dict,
+                                                          trip_route_idx, footpath_time_dict):
+                    add_pattern(pattern_sink, pattern)
+        if stats is not None:
+            departure_stats["postprocess_s"] = perf_counter() - postprocess_start
+    return close_pattern_sink(pattern_sink)
 
 def tempfunc(item_list):
     item_list.append(2)
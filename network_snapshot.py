@@ -0,0 +1,392 @@
+"""
+Compiled network snapshots: the encoded timetable (see encode_network) stored once as typed NumPy arrays in one directory,
+so workers and query processes memory-map it instead of parsing GTFS csv files and unpickling the network dicts.
+Usage: python network_snapshot.py --folder ./sweden    writes ./GTFS/{folder}/network_snapshot
+       python network_snapshot.py --folder ./sweden --keep-previous    also keeps the replaced snapshot for preprocessing_code.py --incremental
+"""
+import json
+import os
+import pickle
+import shutil
+from bisect import bisect_right
+from collections import defaultdict
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+import pandas as pd
+
+from function_file import encode_network, initialize_from_desti_onemany
+from query_func import prepare_query_network
+
+SNAPSHOT_VERSION = 2
+SNAPSHOT_ARRAYS = {
+    # routes: ids sorted, stops in CSR layout, trips are the dense ids of encode_network and contiguous per route
+    "route_ids": np.int64, "route_stop_start": np.int64, "route_stops": np.int64, "route_trip_start": np.int64,
+    # arrival seconds of every (trip, stop index) slot, slot = trip_slot_start[trip] + stop index
+    "trip_slot_start": np.int64, "arrival": np.int32,
+    # routes_by_stop_dict in CSR layout, stops in the original key order
+    "stop_ids": np.int64, "stop_route_start": np.int64, "stop_routes": np.int64,
+    # footpaths in CSR layout
+    "footpath_stops": np.int64, "footpath_start": np.int64, "footpath_to": np.int64, "footpath_time": np.int32,
+    # trip transfers in CSR layout over slots, slot_has_transfers marks the (trip, stop index) keys present in trip_transfer_dict
+    "trip_has_transfers": np.uint8, "slot_has_transfers": np.uint8, "transfer_start": np.int64, "transfer_trip": np.int32, "transfer_stop_idx": np.int32,
+    # destination lookup L of initialize_from_desti_onemany in CSR layout over route positions, destinations as positions in stop_ids
+    "L_start": np.int64, "L_stop_idx": np.int32, "L_destination": np.int32, "L_walk": np.int32,
+}
+
+
+def snapshot_path(FOLDER):
+    return f"./GTFS/{FOLDER}/network_snapshot"
+
+
+def write_network_snapshot(path, stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, trip_transfer_dict, day_start, previous_path=None):
+    '''
+    Writes an encoded network as a snapshot directory. Written through a temporary directory so readers never see a partial snapshot.
+    Args:
+        path (str): snapshot directory.
+        stops_dict (dict): preprocessed dict. Format {route_id: [ids of stops in the route]}.
+        stoptimes_dict (dict): Format {route_id: [[trip_1], [trip_2]]} where trip_1 = [(stop id, arrival seconds)] (see encode_network).
+        footpath_dict (dict): Format {from_stop_id: [(to_stop_id, footpath seconds)]}.
+        routes_by_stop_dict (dict): preprocessed dict. Format {stop_id: [id of routes passing through stop]}.
+        trip_transfer_dict (nested dict): Format {trip: {stop index: [(trip, stop index)]}} with the integer trips of encode_network.
+        day_start (pandas.datetime): timestamp corresponding to 0 seconds.
+        previous_path (str): if given, a snapshot already at path is moved there instead of being deleted.
+    Returns: None
+    '''
+    route_ids = sorted(stoptimes_dict.keys())
+    arrays = defaultdict(list)
+    route_stop_start, route_trip_start, trip_slot_start = [0], [0], [0]
+    for route in route_ids:
+        arrays["route_stops"].extend(stops_dict[route])
+        route_stop_start.append(len(arrays["route_stops"]))
+        route_trip_start.append(route_trip_start[-1] + len(stoptimes_dict[route]))
+        for trip in stoptimes_dict[route]:
+            arrays["arrival"].extend(arrival for _, arrival in trip)
+            trip_slot_start.append(len(arrays["arrival"]))
+    num_trips = route_trip_start[-1]
+    stop_route_start = [0]
+    for stop, listofroutes in routes_by_stop_dict.items():
+        arrays["stop_ids"].append(stop)
+        arrays["stop_routes"].extend(listofroutes)
+        stop_route_start.append(len(arrays["stop_routes"]))
+    footpath_start = [0]
+    for from_stop in sorted(footpath_dict.keys()):
+        arrays["footpath_stops"].append(from_stop)
+        for to_stop, footpath_time in footpath_dict[from_stop]:
+            arrays["footpath_to"].append(to_stop)
+            arrays["footpath_time"].append(footpath_time)
+        footpath_start.append(len(arrays["footpath_to"]))
+    trip_has_transfers = np.zeros(num_trips, dtype=np.uint8)
+    slot_has_transfers = np.zeros(trip_slot_start[-1], dtype=np.uint8)
+    transfer_count = np.zeros(trip_slot_start[-1], dtype=np.int64)
+    for trip, stop_transfers in sorted(trip_transfer_dict.items()):
+        trip_has_transfers[trip] = 1
+        for stop_idx, transfers in sorted(stop_transfers.items()):
+            slot = trip_slot_start[trip] + stop_idx
+            slot_has_transfers[slot] = 1
+            transfer_count[slot] = len(transfers)
+            for to_trip, to_stop_idx in transfers:
+                arrays["transfer_trip"].append(to_trip)
+                arrays["transfer_stop_idx"].append(to_stop_idx)
+    idx_by_route_stop_dict = {(route, stop): stop_idx for route in route_ids for stop_idx, stop in enumerate(stops_dict[route])}
+    L = initialize_from_desti_onemany(routes_by_stop_dict, stops_dict, list(routes_by_stop_dict.keys()), footpath_dict, idx_by_route_stop_dict)
+    L_start = [0]
+    for route in route_ids:
+        for name, column in zip(("L_stop_idx", "L_destination", "L_walk"), L.get(route, ((), (), ()))):
+            arrays[name].extend(column)
+        L_start.append(len(arrays["L_stop_idx"]))
+    arrays.update(L_start=L_start, route_ids=route_ids, route_stop_start=route_stop_start, route_trip_start=route_trip_start, trip_slot_start=trip_slot_start,
+                  stop_route_start=stop_route_start, footpath_start=footpath_start, trip_has_transfers=trip_has_transfers,
+                  slot_has_transfers=slot_has_transfers, transfer_start=np.concatenate([[0], np.cumsum(transfer_count)]))
+
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path)
+    for name, dtype in SNAPSHOT_ARRAYS.items():
+        np.save(f"{tmp_path}/{name}.npy", np.asarray(arrays[name], dtype=dtype))
+    with open(f"{tmp_path}/meta.json", "w") as fp:
+        json.dump({"version": SNAPSHOT_VERSION, "day_start": day_start.isoformat(), "routes": len(route_ids), "trips": num_trips,
+                   "stops": len(routes_by_stop_dict)}, fp)
+    if os.path.exists(path):
+        if previous_path is None:
+            shutil.rmtree(path)
+        else:
+            if os.path.exists(previous_path):
+                shutil.rmtree(previous_path)
+            os.replace(path, previous_path)
+    os.replace(tmp_path, path)
+
+
+def open_network_snapshot(path):
+    '''
+    Memory-maps a snapshot written by write_network_snapshot. Nothing is read until the arrays are used.
+    Args:
+        path (str): snapshot directory.
+    Returns:
+        snapshot (dict): read-only arrays keyed by the names of SNAPSHOT_ARRAYS, and "meta" (dict). Raises ValueError for other versions.
+    '''
+    with open(f"{path}/meta.json") as fp:
+        meta = json.load(fp)
+    if meta["version"] != SNAPSHOT_VERSION:
+        raise ValueError(f"{path} has snapshot version {meta['version']}, expected {SNAPSHOT_VERSION}. Compile the network again.")
+    snapshot = {name: np.load(f"{path}/{name}.npy", mmap_mode="r") for name in SNAPSHOT_ARRAYS}
+    snapshot["meta"] = meta
+    return snapshot
+
+
+class SnapshotView(Mapping):
+    '''
+    Read-only dict over the arrays of a snapshot for the code that still works on the network dicts. A value is built from the
+    arrays the first time its key is read and then kept, so a process only ever converts the part of the network it touches.
+    Pickling (e.g. a Spark broadcast) turns the view into a plain dict.
+    Args:
+        keys (function): returns the keys in iteration order. A key given twice keeps its last position.
+        build (function): builds the value of the key at a position.
+    '''
+
+    def __init__(self, keys, build):
+        self._keys, self._build, self._position, self._values = keys, build, None, {}
+
+    def _positions(self):
+        if self._position is None:
+            self._position = {key: x for x, key in enumerate(self._keys())}
+        return self._position
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            value = self._values[key] = self._build(self._positions()[key])
+            return value
+
+    def __contains__(self, key):
+        return key in self._positions()
+
+    def __iter__(self):
+        return iter(self._positions())
+
+    def __len__(self):
+        return len(self._positions())
+
+    def __reduce__(self):
+        return dict, (dict(self.items()),)
+
+
+class TripRoutes(Sequence):
+    '''
+    trip_route_idx of encode_network over a snapshot: the route of a trip is found by bisecting the first trips of the routes.
+    Format trip_routes[trip] = (route_id, trip index in route).
+    '''
+
+    def __init__(self, route_ids, route_trip_start):
+        self._route_ids, self._route_trip_start = route_ids, route_trip_start
+
+    def __getitem__(self, trip):
+        if not 0 <= trip < self._route_trip_start[-1]:
+            raise IndexError(trip)
+        x = bisect_right(self._route_trip_start, trip) - 1
+        return self._route_ids[x], trip - self._route_trip_start[x]
+
+    def __len__(self):
+        return self._route_trip_start[-1]
+
+
+def _snapshot_route_times(snapshot, route_ids):
+    '''
+    Returns:
+        route_times (dict): as returned by route_timetable, every matrix a view of the mapped arrival array.
+    '''
+    route_stop_start, route_trip_start = snapshot["route_stop_start"].tolist(), snapshot["route_trip_start"].tolist()
+    trip_slot_start, arrival = snapshot["trip_slot_start"], np.asarray(snapshot["arrival"])
+    route_times = {}
+    for x, route in enumerate(route_ids):
+        first_trip, last_trip = route_trip_start[x], route_trip_start[x + 1]
+        route_times[route] = arrival[trip_slot_start[first_trip]: trip_slot_start[last_trip]].reshape(last_trip - first_trip, route_stop_start[x + 1] - route_stop_start[x])
+    return route_times
+
+
+def snapshot_to_network(snapshot):
+    '''
+    Returns the network of a snapshot in the form used by the rTBTR preprocessing and by the queries. Nothing is copied out of the
+    mapped arrays up front: the dicts are SnapshotView objects that convert an entry when it is first read, and the trip transfers
+    are handed over as the arrays, so the processes using a snapshot share one copy through the page cache.
+    Args:
+        snapshot (dict): snapshot returned by open_network_snapshot.
+    Returns:
+        stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict: as read_testcase and encode_network
+            return them (times in seconds, integer trips).
+        trip_transfers (dict): as returned by trip_transfer_table.
+        departures_dict, trip_route_idx, route_trip_offset, day_start: as returned by encode_network.
+    '''
+    route_ids, route_stop_start, route_trip_start = snapshot["route_ids"].tolist(), snapshot["route_stop_start"].tolist(), snapshot["route_trip_start"].tolist()
+    route_stops, stop_route_start, stop_routes = snapshot["route_stops"], snapshot["stop_route_start"].tolist(), snapshot["stop_routes"]
+    footpath_start, footpath_to, footpath_time = snapshot["footpath_start"].tolist(), snapshot["footpath_to"], snapshot["footpath_time"]
+    stop_ids = snapshot["stop_ids"].tolist()
+    route_position = {route: x for x, route in enumerate(route_ids)}
+    route_times = _snapshot_route_times(snapshot, route_ids)
+
+    stops_dict = SnapshotView(lambda: route_ids, lambda x: route_stops[route_stop_start[x]: route_stop_start[x + 1]].tolist())
+    stoptimes_dict = SnapshotView(lambda: route_ids, lambda x: [list(zip(stops_dict[route_ids[x]], trip)) for trip in route_times[route_ids[x]].tolist()])
+    routes_by_stop_dict = SnapshotView(lambda: stop_ids, lambda x: stop_routes[stop_route_start[x]: stop_route_start[x + 1]].tolist())
+    footpath_dict = SnapshotView(lambda: snapshot["footpath_stops"].tolist(),
+                                 lambda x: list(zip(footpath_to[footpath_start[x]: footpath_start[x + 1]].tolist(), footpath_time[footpath_start[x]: footpath_start[x + 1]].tolist())))
+    # Keys are every (route, stop) of route_stops in order, so a stop visited twice keeps its last index.
+    idx_by_route_stop_dict = SnapshotView(lambda: [(route, stop) for x, route in enumerate(route_ids) for stop in route_stops[route_stop_start[x]: route_stop_start[x + 1]].tolist()],
+                                          lambda y: y - route_stop_start[bisect_right(route_stop_start, y) - 1])
+
+    def stop_departures(x):
+        stop, departures = stop_ids[x], []
+        for route in sorted(routes_by_stop_dict[stop]):
+            stop_idx_list = [stop_idx for stop_idx, route_stop in enumerate(stops_dict[route]) if route_stop == stop]
+            first_trip = route_trip_start[route_position[route]]
+            for tid, arrival_list in enumerate(route_times[route][:, stop_idx_list].tolist()):
+                departures.extend((first_trip + tid, arrival_time, stop_idx) for arrival_time, stop_idx in zip(arrival_list, stop_idx_list))
+        return departures
+
+    departures_dict = SnapshotView(lambda: stop_ids, stop_departures)
+    # np.asarray drops the memmap subclass, whose slices are slower to create, but keeps the mapping.
+    trip_transfers = {name: np.asarray(snapshot[name]) for name in ("trip_slot_start", "transfer_start", "transfer_trip", "transfer_stop_idx", "trip_has_transfers")}
+    route_trip_offset = dict(zip(route_ids, route_trip_start))
+    day_start = pd.Timestamp(snapshot["meta"]["day_start"])
+    return (stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict, trip_transfers,
+            departures_dict, TripRoutes(route_ids, route_trip_start), route_trip_offset, day_start)
+
+
+def snapshot_search_arrays(snapshot):
+    '''
+    The source independent lookups of the rTBTR search, taken from the snapshot without going through the network dicts.
+    Args:
+        snapshot (dict): snapshot returned by open_network_snapshot.
+    Returns:
+        L (dict): as returned by initialize_from_desti_onemany for all stops, the arrays are views of the mapped ones.
+        route_times (dict): as returned by route_timetable, the matrices are views of the mapped arrival array.
+        departure_counts (dict): number of departures from every stop, i.e. len(departures_dict[stop]). Format {stop_id: count}.
+    '''
+    route_ids, L_start = snapshot["route_ids"].tolist(), snapshot["L_start"].tolist()
+    L_stop_idx, L_destination, L_walk = (np.asarray(snapshot[name]) for name in ("L_stop_idx", "L_destination", "L_walk"))
+    L = {route: (L_stop_idx[L_start[x]: L_start[x + 1]], L_destination[L_start[x]: L_start[x + 1]], L_walk[L_start[x]: L_start[x + 1]])
+         for x, route in enumerate(route_ids) if L_start[x] < L_start[x + 1]}
+    stops_per_route = np.diff(snapshot["route_stop_start"])
+    stop_ids, inverse = np.unique(snapshot["route_stops"], return_inverse=True)
+    counts = np.bincount(inverse, weights=np.repeat(np.diff(snapshot["route_trip_start"]), stops_per_route), minlength=len(stop_ids))
+    departure_counts = dict(zip(stop_ids.tolist(), counts.astype(np.int64).tolist()))
+    return L, _snapshot_route_times(snapshot, route_ids), departure_counts
+
+
+def _route_signature(snapshot, x, trip_keys):
+    '''
+    Arrays describing route position x of a snapshot: stops, arrivals, which trips and stops have trip transfers, the number of
+    transfers per stop and their targets. Targets are given as (route id, trip index in route) since trip ids are renumbered
+    by every snapshot.
+    '''
+    route_trip_start, trip_slot_start, transfer_start = snapshot["route_trip_start"], snapshot["trip_slot_start"], snapshot["transfer_start"]
+    first_trip, last_trip = int(route_trip_start[x]), int(route_trip_start[x + 1])
+    first_slot, last_slot = int(trip_slot_start[first_trip]), int(trip_slot_start[last_trip])
+    first_transfer, last_transfer = int(transfer_start[first_slot]), int(transfer_start[last_slot])
+    transfer_trip = snapshot["transfer_trip"][first_transfer: last_transfer]
+    return (snapshot["route_stops"][snapshot["route_stop_start"][x]: snapshot["route_stop_start"][x + 1]],
+            snapshot["arrival"][first_slot: last_slot].astype(np.int64), snapshot["trip_has_transfers"][first_trip: last_trip],
+            snapshot["slot_has_transfers"][first_slot: last_slot], np.diff(transfer_start[first_slot: last_slot + 1]),
+            trip_keys[0][transfer_trip], trip_keys[1][transfer_trip], snapshot["transfer_stop_idx"][first_transfer: last_transfer])
+
+
+def _snapshot_footpaths(snapshot):
+    '''
+    Footpaths of a snapshot. Format {(from_stop_id, to_stop_id): footpath seconds}.
+    '''
+    footpath_start, footpath_to, footpath_time = snapshot["footpath_start"].tolist(), snapshot["footpath_to"].tolist(), snapshot["footpath_time"].tolist()
+    return {(from_stop, footpath_to[y]): footpath_time[y] for x, from_stop in enumerate(snapshot["footpath_stops"].tolist())
+            for y in range(footpath_start[x], footpath_start[x + 1])}
+
+
+def diff_network_snapshots(old_snapshot, new_snapshot):
+    '''
+    Compares two snapshots of the same network route by route. A route counts as changed if it was added or removed, or if its
+    stops, the arrival times of its trips, or its outgoing trip transfers differ. Routes feeding a retimed or new route therefore
+    show up as changed as well, because their transfers into it change.
+    Args:
+        old_snapshot (dict): snapshot returned by open_network_snapshot.
+        new_snapshot (dict): snapshot returned by open_network_snapshot.
+    Returns:
+        changed_routes (dict): Format {route_id: [ids of stops in the route in old_snapshot]}. Added routes map to [].
+        retimed_routes (set): changed routes that may offer journeys old_snapshot did not have, i.e. added routes and routes with changed
+            stops or with new or retimed trips. Routes whose transfers changed only or that only lost trips are left out.
+        changed_footpaths (set): footpaths added, removed or retimed. Format {(from_stop_id, to_stop_id)}.
+    '''
+    shift = int((pd.Timestamp(new_snapshot["meta"]["day_start"]) - pd.Timestamp(old_snapshot["meta"]["day_start"])).total_seconds())
+    trip_keys, route_position = [], []
+    for snapshot in (old_snapshot, new_snapshot):
+        route_ids, trips_per_route = np.asarray(snapshot["route_ids"]), np.diff(snapshot["route_trip_start"])
+        first_trip = np.repeat(snapshot["route_trip_start"][:-1], trips_per_route)
+        trip_keys.append((np.repeat(route_ids, trips_per_route), np.arange(len(first_trip)) - first_trip))
+        route_position.append({route: x for x, route in enumerate(route_ids.tolist())})
+    changed_routes, retimed_routes = {}, set()
+    for route in route_position[0].keys() | route_position[1].keys():
+        if route not in route_position[1]:
+            x = route_position[0][route]
+            changed_routes[route] = _route_signature(old_snapshot, x, trip_keys[0])[0].tolist()
+            retimed_routes.add(route)
+            continue
+        if route not in route_position[0]:
+            changed_routes[route] = []
+            retimed_routes.add(route)
+            continue
+        old_signature = _route_signature(old_snapshot, route_position[0][route], trip_keys[0])
+        new_signature = _route_signature(new_snapshot, route_position[1][route], trip_keys[1])
+        old_signature = (old_signature[0], old_signature[1] - shift, *old_signature[2:])
+        if not all(np.array_equal(old_array, new_array) for old_array, new_array in zip(old_signature, new_signature)):
+            changed_routes[route] = old_signature[0].tolist()
+            if not np.array_equal(old_signature[0], new_signature[0]):
+                retimed_routes.add(route)
+            elif not np.array_equal(old_signature[1], new_signature[1]):
+                # A route that only lost trips offers no journey the old network did not have.
+                old_trips = set(map(bytes, old_signature[1].reshape(-1, len(old_signature[0]))))
+                if not set(map(bytes, new_signature[1].reshape(-1, len(new_signature[0])))) <= old_trips:
+                    retimed_routes.add(route)
+    old_footpaths, new_footpaths = _snapshot_footpaths(old_snapshot), _snapshot_footpaths(new_snapshot)
+    changed_footpaths = {pair for pair in old_footpaths.keys() | new_footpaths.keys() if old_footpaths.get(pair) != new_footpaths.get(pair)}
+    return changed_routes, retimed_routes, changed_footpaths
+
+
+def compile_network(FOLDER, path, previous_path=None):
+    '''
+    Reads a network with read_testcase and its TBTR trip transfers, and writes the snapshot.
+    Args:
+        FOLDER (str): network folder.
+        path (str): snapshot directory.
+        previous_path (str): see write_network_snapshot.
+    Returns: None
+    '''
+    from miscellaneous_func import read_testcase
+    stops_file, trips_file, stop_times_file, transfers_file, stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict = read_testcase(FOLDER)
+    with open(f'./GTFS/{FOLDER}/TBTR_trip_transfer_dict.pkl', 'rb') as file:
+        trip_transfer_dict = pickle.load(file)
+    stoptimes_dict, footpath_dict, trip_transfer_dict, _, _, _, day_start = encode_network(stoptimes_dict, footpath_dict, trip_transfer_dict)
+    write_network_snapshot(path, stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, trip_transfer_dict, day_start, previous_path)
+
+
+def load_query_network(FOLDER):
+    '''
+    Loads the network for the queries from its snapshot if one has been compiled, otherwise with read_testcase.
+    Returns:
+        query_network (dict): see prepare_query_network.
+    '''
+    path = snapshot_path(FOLDER)
+    if not os.path.exists(f"{path}/meta.json"):
+        from miscellaneous_func import read_testcase
+        stops_file, trips_file, stop_times_file, transfers_file, stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict = read_testcase(FOLDER)
+        return prepare_query_network(stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict)
+    stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, _, _, _, _, _, day_start = snapshot_to_network(open_network_snapshot(path))
+    stop_ids = list(routes_by_stop_dict.keys())
+    routesindx_by_stop_dict = SnapshotView(lambda: stop_ids, lambda x: [(route, stops_dict[route].index(stop_ids[x])) for route in routes_by_stop_dict[stop_ids[x]]])
+    return {"stoptimes_dict": stoptimes_dict, "footpath_dict": footpath_dict, "routesindx_by_stop_dict": routesindx_by_stop_dict, "day_start": day_start}
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Compile a network into a memory-mappable snapshot.")
+    parser.add_argument("--folder", default="./swiss", help="network folder, e.g. ./sweden or ./swiss")
+    parser.add_argument("--keep-previous", action="store_true", help="keep the replaced snapshot as {snapshot}.previous")
+    args = parser.parse_args()
+    path = snapshot_path(args.folder)
+    compile_network(args.folder, path, f"{path}.previous" if args.keep_previous else None)
+    print(f"    Snapshot written to {path}")
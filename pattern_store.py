@@ -0,0 +1,374 @@
+import os
+import pickle
+from array import array
+
+import numpy as np
+
+STORE_MAGIC = b"TPSTORE1"
+HEADER_BYTES = 24  # magic, number of sources, byte offset of the index
+DAG_MAGIC = b"TPDAG001"  # pattern file of one source: magic, int64 source stop id, chunks written by _flush_pattern_sink
+SINK_CHUNK_NODES = 65536
+MAX_SINK_NODES = 2 ** 22
+_open_stores = {}  # path -> (store, (inode, modification time)) of the file when it was mapped
+_open_hubs = {}
+
+
+def new_pattern_sink(SOURCE, path=None, max_nodes=MAX_SINK_NODES):
+    '''
+    Starts the transfer pattern DAG of one source as in Bast et al.: the source is the implicit root and the other nodes are built
+    backwards from the destination, so patterns sharing a suffix share its nodes and a pattern seen before adds nothing.
+    With a path the DAG is streamed to that file: new nodes are appended in chunks of SINK_CHUNK_NODES, and once max_nodes nodes
+    are indexed for deduplication the index is dropped and later patterns start new nodes. Memory then stays bounded however many
+    patterns the source has, at the price of a pattern occasionally being stored twice.
+    Args:
+        SOURCE (int): stop id of source stop.
+        path (str): pattern file to stream to, None to keep the DAG in memory.
+        max_nodes (int): nodes indexed before the index is dropped. Ignored without path.
+    Returns:
+        pattern_sink (dict): pass to add_pattern and close_pattern_sink.
+    '''
+    pattern_sink = {"source": SOURCE, "path": path, "fp": None, "max_nodes": max_nodes, "nodes": {}, "roots": set(), "count": 0,
+                    "stops": array("i"), "next": array("i"), "new_roots": array("i")}
+    if path is not None:
+        pattern_sink["fp"] = open(f"{path}.tmp{os.getpid()}", "wb")
+        pattern_sink["fp"].write(DAG_MAGIC + np.array([SOURCE], dtype=np.int64).tobytes())
+    return pattern_sink
+
+
+def add_pattern(pattern_sink, pattern):
+    '''
+    Inserts one transfer pattern into a DAG started with new_pattern_sink.
+    Args:
+        pattern_sink (dict): see new_pattern_sink.
+        pattern (list): stop ids in journey order, starting at the source.
+    Returns: None
+    '''
+    nodes = pattern_sink["nodes"]
+    node = -1
+    for x in range(len(pattern) - 1, 0, -1):
+        # One int per (stop, successor node) keeps the index small, successor -1 of destination nodes is stored as 0.
+        key = pattern[x] << 32 | (node + 1)
+        found = nodes.get(key)
+        if found is None:
+            found = nodes[key] = pattern_sink["count"]
+            pattern_sink["count"] += 1
+            pattern_sink["stops"].append(pattern[x])
+            pattern_sink["next"].append(node)
+        node = found
+    if node not in pattern_sink["roots"]:
+        pattern_sink["roots"].add(node)
+        pattern_sink["new_roots"].append(node)
+    if pattern_sink["fp"] is not None:
+        if len(nodes) >= pattern_sink["max_nodes"]:
+            _flush_pattern_sink(pattern_sink)
+            nodes.clear()
+            pattern_sink["roots"].clear()
+        elif len(pattern_sink["stops"]) >= SINK_CHUNK_NODES:
+            _flush_pattern_sink(pattern_sink)
+
+
+def _flush_pattern_sink(pattern_sink):
+    '''
+    Appends the nodes and roots added since the last flush to the file as one chunk: int64 (nodes, roots) | int32 stops | int32 next | int32 roots.
+    '''
+    fp = pattern_sink["fp"]
+    fp.write(np.array([len(pattern_sink["stops"]), len(pattern_sink["new_roots"])], dtype=np.int64).tobytes())
+    for name in ("stops", "next", "new_roots"):
+        fp.write(pattern_sink[name].tobytes())
+        pattern_sink[name] = array("i")
+
+
+def close_pattern_sink(pattern_sink):
+    '''
+    Finishes a DAG started with new_pattern_sink. A streamed file only replaces path once it is complete.
+    Returns:
+        pattern_dag (dict): None if the DAG was streamed to a file. Format {"source": SOURCE, "stops": int32 stop id of every node,
+            "next": int32 successor node of every node (-1 for destinations), "roots": int32 node following the source in every pattern}.
+    '''
+    if pattern_sink["fp"] is None:
+        return {"source": pattern_sink["source"], "stops": np.frombuffer(pattern_sink["stops"], dtype=np.int32),
+                "next": np.frombuffer(pattern_sink["next"], dtype=np.int32), "roots": np.frombuffer(pattern_sink["new_roots"], dtype=np.int32)}
+    _flush_pattern_sink(pattern_sink)
+    pattern_sink["fp"].close()
+    os.replace(pattern_sink["fp"].name, pattern_sink["path"])
+    return None
+
+
+def abort_pattern_sink(pattern_sink):
+    '''
+    Drops a DAG started with new_pattern_sink, e.g. after the search failed. The file at path is left as it was.
+    '''
+    if pattern_sink["fp"] is not None and not pattern_sink["fp"].closed:
+        pattern_sink["fp"].close()
+        os.remove(pattern_sink["fp"].name)
+
+
+def build_pattern_dag(SOURCE, TP_list, path=None):
+    '''
+    Args:
+        SOURCE (int): stop id of source stop.
+        TP_list (iterable): transfer patterns of SOURCE. Format [[SOURCE, stop_id, ...]].
+        path (str): pattern file to stream the DAG to, None to return it.
+    Returns:
+        pattern_dag (dict): see close_pattern_sink.
+    '''
+    pattern_sink = new_pattern_sink(SOURCE, path)
+    for pattern in TP_list:
+        add_pattern(pattern_sink, pattern)
+    return close_pattern_sink(pattern_sink)
+
+
+def dag_patterns(pattern_dag):
+    '''
+    Yields every transfer pattern of a DAG as a list of stop ids in journey order, starting at the source.
+    '''
+    stops, successors = pattern_dag["stops"].tolist(), pattern_dag["next"].tolist()
+    for node in pattern_dag["roots"].tolist():
+        pattern = [pattern_dag["source"]]
+        while node != -1:
+            pattern.append(stops[node])
+            node = successors[node]
+        yield pattern
+
+
+def load_pattern_file(path, SOURCE):
+    '''
+    Reads the pattern file of one source written by preprocessing_code.py. Pickled files of older runs holding the flat pattern
+    list or the DAG are read as well.
+    Returns:
+        pattern_dag (dict): see close_pattern_sink.
+    '''
+    with open(path, "rb") as fp:
+        data = fp.read()
+    if not data.startswith(DAG_MAGIC):
+        patterns = pickle.loads(data)
+        return build_pattern_dag(SOURCE, patterns) if isinstance(patterns, list) else patterns
+    chunks = {"stops": [], "next": [], "roots": []}
+    position = len(DAG_MAGIC) + 8
+    while position < len(data):
+        num_nodes, num_roots = [int(x) for x in np.frombuffer(data, dtype=np.int64, count=2, offset=position)]
+        position += 16
+        for name, count in (("stops", num_nodes), ("next", num_nodes), ("roots", num_roots)):
+            chunks[name].append(np.frombuffer(data, dtype=np.int32, count=count, offset=position))
+            position += 4 * count
+    return {"source": int(np.frombuffer(data, dtype=np.int64, count=1, offset=len(DAG_MAGIC))[0]),
+            **{name: np.concatenate(arrays) if arrays else np.empty(0, dtype=np.int32) for name, arrays in chunks.items()}}
+
+
+def pattern_edges(pattern_dag):
+    '''
+    Collapses the transfer pattern DAG of one source into the edges of its pattern graph.
+    Args:
+        pattern_dag (dict): see close_pattern_sink.
+    Returns:
+        edges (numpy.ndarray): int32 array of shape (number of edges, 2) with unique (from stop, to stop) rows sorted by from stop.
+    '''
+    stops, successors, roots = pattern_dag["stops"].astype(np.int64), pattern_dag["next"], pattern_dag["roots"]
+    inner = successors != -1
+    # Stop ids are non-negative int32, so one int64 key per edge sorts and deduplicates much faster than rows.
+    keys = np.unique(np.concatenate([(np.int64(pattern_dag["source"]) << 32) | stops[roots], (stops[inner] << 32) | stops[successors[inner]]]))
+    edges = np.stack([keys >> 32, keys & 0xFFFFFFFF], axis=1).astype(np.int32)
+    return edges
+
+
+def union_pattern_edges(edges_list):
+    '''
+    Args:
+        edges_list (list): edge arrays as returned by pattern_edges or get_pattern_edges.
+    Returns:
+        edges (numpy.ndarray): int32 array of shape (number of edges, 2) with the unique rows of all of them sorted by from stop.
+    '''
+    keys = np.unique(np.concatenate([(edges[:, 0].astype(np.int64) << 32) | edges[:, 1] for edges in edges_list]))
+    return np.stack([keys >> 32, keys & 0xFFFFFFFF], axis=1).astype(np.int32)
+
+
+def write_pattern_store(path, source_edges):
+    '''
+    Writes the pattern graphs of many sources into one binary file.
+    Layout: header | edges of every source as int32 (from stop, to stop) rows | index.
+    The index holds three int64 arrays sorted by source: source stop id, first edge row, number of edge rows.
+    Args:
+        path (str): output file. Written through a temporary file so readers never see a partial store.
+        source_edges (iterable): yields (SOURCE, edges) with edges as returned by pattern_edges.
+    Returns: None
+    '''
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    sources, starts, counts = [], [], []
+    row = 0
+    with open(tmp_path, "wb") as fp:
+        fp.write(bytes(HEADER_BYTES))
+        for SOURCE, edges in source_edges:
+            edges = np.ascontiguousarray(edges, dtype=np.int32).reshape(-1, 2)
+            fp.write(edges.tobytes())
+            sources.append(SOURCE)
+            starts.append(row)
+            counts.append(len(edges))
+            row += len(edges)
+        order = np.argsort(np.array(sources, dtype=np.int64), kind="stable")
+        index_offset = fp.tell()
+        for column in (sources, starts, counts):
+            fp.write(np.array(column, dtype=np.int64)[order].tobytes())
+        fp.seek(0)
+        fp.write(STORE_MAGIC + np.array([len(sources), index_offset], dtype=np.int64).tobytes())
+    os.replace(tmp_path, path)
+    _open_stores.pop(path, None)
+
+
+def open_pattern_store(path):
+    '''
+    Memory-maps a store written by write_pattern_store. Stores are opened once per process and shared by all callers, and mapped
+    again once the file has been replaced (e.g. by update_pattern_store in another process).
+    Args:
+        path (str): store file.
+    Returns:
+        store (dict): keys "edges" (numpy.memmap of shape (rows, 2)), "sources", "starts", "counts" (numpy.memmap index arrays).
+    '''
+    stat = os.stat(path)
+    identity = (stat.st_ino, stat.st_mtime_ns)
+    try:
+        store, mapped_identity = _open_stores[path]
+        if mapped_identity == identity:
+            return store
+    except KeyError:
+        pass
+    with open(path, "rb") as fp:
+        header = fp.read(HEADER_BYTES)
+    if header[:8] != STORE_MAGIC:
+        raise ValueError(f"{path} is not a transfer pattern store")
+    num_sources, index_offset = [int(x) for x in np.frombuffer(header, dtype=np.int64, offset=8)]
+    num_rows = (index_offset - HEADER_BYTES) // 8
+    # np.memmap refuses empty regions, so empty stores fall back to empty arrays.
+    edges = np.memmap(path, dtype=np.int32, mode="r", offset=HEADER_BYTES, shape=(num_rows, 2)) if num_rows else np.empty((0, 2), dtype=np.int32)
+    index = np.memmap(path, dtype=np.int64, mode="r", offset=index_offset, shape=(3, num_sources)) if num_sources else np.empty((3, 0), dtype=np.int64)
+    store = {"edges": edges, "sources": index[0], "starts": index[1], "counts": index[2]}
+    _open_stores[path] = (store, identity)
+    return store
+
+
+def get_pattern_edges(store, SOURCE):
+    '''
+    Zero-copy view of the pattern graph of one source.
+    Args:
+        store (dict): store returned by open_pattern_store.
+        SOURCE (int): stop id of source stop.
+    Returns:
+        edges (numpy.ndarray): read-only int32 view of shape (number of edges, 2). Raises KeyError if SOURCE is not in the store.
+    '''
+    position = int(np.searchsorted(store["sources"], SOURCE))
+    if position == len(store["sources"]) or store["sources"][position] != SOURCE:
+        raise KeyError(SOURCE)
+    start = int(store["starts"][position])
+    return store["edges"][start: start + int(store["counts"][position])]
+
+
+def update_pattern_store(path, source_edges, removed_sources=()):
+    '''
+    Replaces the pattern graphs of some sources of an existing store, adds new sources and drops removed ones. All other sources are
+    copied from the old store as they are. The new store replaces the file like write_pattern_store does, processes that mapped
+    the old store keep reading it until they open the store again (open_pattern_store then maps the new one).
+    Args:
+        path (str): store file.
+        source_edges (iterable): yields (SOURCE, edges) sorted by SOURCE, with edges as returned by pattern_edges.
+        removed_sources (iterable): stop ids of the sources to drop.
+    Returns: None
+    '''
+    old_store = open_pattern_store(path)
+    removed_sources = set(removed_sources)
+    old_LIST = [SOURCE for SOURCE in old_store["sources"].tolist() if SOURCE not in removed_sources]
+
+    def _merged_edges():
+        position = 0
+        for SOURCE, edges in source_edges:
+            while position < len(old_LIST) and old_LIST[position] <= SOURCE:
+                if old_LIST[position] != SOURCE:
+                    yield old_LIST[position], get_pattern_edges(old_store, old_LIST[position])
+                position = position + 1
+            yield SOURCE, edges
+        for SOURCE in old_LIST[position:]:
+            yield SOURCE, get_pattern_edges(old_store, SOURCE)
+
+    write_pattern_store(path, _merged_edges())
+
+
+def merge_pattern_stores(shard_paths, path):
+    '''
+    Merges stores (e.g. the shards written by spark_preprocessing.py) into one store. A source found in several shards is taken
+    from the last of them in shard_paths.
+    Args:
+        shard_paths (list): store files.
+        path (str): output store file.
+    Returns:
+        count (int): number of sources written.
+    '''
+    shard_by_source = {}
+    for shard_path in shard_paths:
+        for SOURCE in open_pattern_store(shard_path)["sources"].tolist():
+            shard_by_source[SOURCE] = shard_path
+    write_pattern_store(path, ((SOURCE, get_pattern_edges(open_pattern_store(shard_by_source[SOURCE]), SOURCE)) for SOURCE in sorted(shard_by_source)))
+    for shard_path in shard_paths:
+        _open_stores.pop(shard_path, None)
+    return len(shard_by_source)
+
+
+def write_store_hubs(path, hubs):
+    '''
+    Records the hubs of a store computed by a hub based run (preprocessing_code.py --hubs) in the file {path}.hubs next to it. The
+    store then holds global patterns for the hubs and local patterns for all other sources.
+    Args:
+        path (str): store file, it does not need to exist yet.
+        hubs (iterable): stop ids.
+    Returns: None
+    '''
+    tmp_path = f"{path}.hubs.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as fp:
+        fp.write(np.array(sorted(hubs), dtype=np.int64).tobytes())
+    os.replace(tmp_path, f"{path}.hubs")
+    _open_hubs.pop(path, None)
+
+
+def load_store_hubs(path):
+    '''
+    Reads the hubs written by write_store_hubs, once per process.
+    Args:
+        path (str): store file.
+    Returns:
+        hubs (frozenset): stop ids, None if the store has no hubs file (full patterns from every source).
+    '''
+    try:
+        return _open_hubs[path]
+    except KeyError:
+        pass
+    hubs = None
+    if os.path.exists(f"{path}.hubs"):
+        with open(f"{path}.hubs", "rb") as fp:
+            hubs = frozenset(np.frombuffer(fp.read(), dtype=np.int64).tolist())
+    _open_hubs[path] = hubs
+    return hubs
+
+
+def convert_pickles_to_store(pattern_folder, path):
+    '''
+    Builds a store from the per-source pickles written by preprocessing_code.py (one file per source named by its stop id).
+    Args:
+        pattern_folder (str): folder with the per-source pickles.
+        path (str): output store file.
+    Returns:
+        count (int): number of sources written.
+    '''
+    source_LIST = sorted(int(file_name) for file_name in os.listdir(pattern_folder) if file_name.isdigit())
+
+    def _source_edges():
+        for SOURCE in source_LIST:
+            yield SOURCE, pattern_edges(load_pattern_file(f"{pattern_folder}/{SOURCE}", SOURCE))
+
+    write_pattern_store(path, _source_edges())
+    return len(source_LIST)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert per-source transfer pattern pickles into a single pattern store.")
+    parser.add_argument("pattern_folder", help="folder with one pickle per source, e.g. ./transferpattern/transfer_pattern/./sweden")
+    parser.add_argument("path", help="output store file")
+    args = parser.parse_args()
+    print(f"    {convert_pickles_to_store(args.pattern_folder, args.path)} sources written to {args.path}")
@@ -1,38 +1,450 @@
+"""
+Computes transfer patterns from every stop using One-To-Many rTBTR.
+Usage: python preprocessing_code.py --folder ./swiss --cores 100
+Sources whose pattern file already exists are skipped, so an interrupted run can simply be restarted.
+After a timetable update compile the new snapshot with python network_snapshot.py --folder ./swiss --keep-previous and run
+    python preprocessing_code.py --folder ./swiss --incremental ./GTFS/./swiss/network_snapshot.previous
+to recompute only the journeys that may have changed and update the pattern store.
+With --stats the per-round search statistics of every source are written next to its pattern file as {SOURCE}.stats.json,
+python search_stats.py ./transferpattern/transfer_pattern/./swiss ranks the most expensive sources.
+With --split-departures 500 sources with more than 500 departures are run as time windows of about 500 departures on separate
+workers and their patterns merged, which shortens the tail of the run that large hubs otherwise are.
+With --hubs 1000 the run is hub based (Bast et al.): 1000 hubs are selected from the patterns of a sample of sources, only the hubs
+get full searches, and the searches from all other stops are local and stop at the first hub of a journey. The hubs are written
+to {store}.hubs and reused when the run is restarted or updated with --incremental.
+"""
+import argparse
+import gc
+import json
+import os
+import pickle
+import random
+from collections import Counter
+from multiprocessing import get_context
+from time import perf_counter, time
 
-from time import time
-from miscellaneous_func import *
-from transferpattern.transferpattern_func import *
 from tqdm import tqdm
-import pickle
-from multiprocessing import Pool
-
-print_logo()
-print("Reading Testcase...")
-FOLDER = './sweden'
-FOLDER = './swiss'
-cores = 100
-stops_file, trips_file, stop_times_file, transfers_file, stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict = read_testcase(FOLDER)
-
-with open(f'./GTFS/{FOLDER}/TBTR_trip_transfer_dict.pkl', 'rb') as file:
-    trip_transfer_dict = pickle.load(file)
-trip_set = set(trip_transfer_dict.keys())
-print_network_details(transfers_file, trips_file, stops_file)
+
+from function_file import *
+from miscellaneous_func import *
+from network_snapshot import diff_network_snapshots, open_network_snapshot, snapshot_path, snapshot_search_arrays, snapshot_to_network
+from pattern_store import abort_pattern_sink, add_pattern, build_pattern_dag, convert_pickles_to_store, dag_patterns, load_pattern_file, load_store_hubs, \
+    new_pattern_sink, open_pattern_store, pattern_edges, update_pattern_store, write_store_hubs
+
 MAX_TRANSFER = 4
 WALKING_FROM_SOURCE = 0
 PRINT_ITINERARY = 0
 OPTIMIZED = 1
-d_time_groups = stop_times_file.groupby("stop_id")
+# Filled once by load_network in the parent. Workers are forked afterwards and read it without copying or unpickling.
+NETWORK = {}
+
+
+def load_network(FOLDER):
+    """
+    Reads the network (from its snapshot if one has been compiled), converts it to the rTBTR representation and builds the
+    source independent lookups into NETWORK. From a snapshot the search runs on the mapped arrays and the network dicts are
+    views that convert an entry when it is first read (see snapshot_to_network), so loading does not grow with the network.
+    Args:
+        FOLDER (str): network folder.
+    Returns: None
+    """
+    path = snapshot_path(FOLDER)
+    if os.path.exists(f"{path}/meta.json"):
+        print("Loading network snapshot...")
+        snapshot = open_network_snapshot(path)
+        stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict, trip_transfers, departures_dict, trip_route_idx, \
+            route_trip_offset, day_start = snapshot_to_network(snapshot)
+        L, route_times, departure_counts = snapshot_search_arrays(snapshot)
+    else:
+        print("Reading Testcase...")
+        stops_file, trips_file, stop_times_file, transfers_file, stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict = read_testcase(FOLDER)
+        with open(f'./GTFS/{FOLDER}/TBTR_trip_transfer_dict.pkl', 'rb') as file:
+            trip_transfer_dict = pickle.load(file)
+        stoptimes_dict, footpath_dict, trip_transfer_dict, departures_dict, trip_route_idx, route_trip_offset, day_start = encode_network(stoptimes_dict, footpath_dict, trip_transfer_dict)
+        trip_transfers = trip_transfer_table(trip_transfer_dict, trip_route_idx, stops_dict)
+        print_network_details(transfers_file, trips_file, stops_file)
+        print(f"    Run python network_snapshot.py --folder {FOLDER} once to load this network from a snapshot next time")
+        # Destination lookup is the same for every source, build it once and let the pool workers inherit it.
+        L = initialize_from_desti_onemany(routes_by_stop_dict, stops_dict, list(routes_by_stop_dict.keys()), footpath_dict, idx_by_route_stop_dict)
+        route_times = route_timetable(stoptimes_dict)
+        departure_counts = {stop: len(departures) for stop, departures in departures_dict.items()}
+    NETWORK.update(stops_dict=stops_dict, stoptimes_dict=stoptimes_dict, footpath_dict=footpath_dict, routes_by_stop_dict=routes_by_stop_dict,
+                   idx_by_route_stop_dict=idx_by_route_stop_dict, trip_transfers=trip_transfers,
+                   departures_dict=departures_dict, trip_route_idx=trip_route_idx, route_trip_offset=route_trip_offset, L=L,
+                   route_times=route_times, departure_counts=departure_counts)
+
+
+def count_transfer_stops(SOURCE):
+    """
+    Full search from one source sampled by select_hubs.
+    Returns:
+        SOURCE (int): stop id.
+        counts (collections.Counter): number of the transfer patterns of SOURCE every stop is a transfer stop of (neither the first
+            nor the last stop), None if the search failed.
+    """
+    try:
+        pattern_dag = search_source(SOURCE, list(NETWORK["routes_by_stop_dict"].keys()))
+    except Exception:
+        return SOURCE, None
+    counts = Counter()
+    for pattern in dag_patterns(pattern_dag):
+        counts.update(pattern[1:-1])
+    return SOURCE, counts
+
+
+def select_hubs(num_hubs, sample_size, cores, seed=0):
+    """
+    Selects the hubs of a hub based run as in Bast et al.: the stops most journeys of a random sample of sources transfer at.
+    Args:
+        num_hubs (int): number of hubs.
+        sample_size (int): number of sources searched.
+        cores (int): number of worker processes.
+        seed (int): seed of the sample.
+    Returns:
+        hubs (list): stop ids, most frequent first.
+    """
+    stop_LIST = sorted(NETWORK["routes_by_stop_dict"].keys())
+    sample = random.Random(seed).sample(stop_LIST, min(sample_size, len(stop_LIST)))
+    counts = Counter()
+    gc.freeze()
+    with get_context("fork").Pool(cores) as pool:
+        for SOURCE, source_counts in tqdm(pool.imap_unordered(count_transfer_stops, sample, chunksize=1), total=len(sample)):
+            if source_counts is not None:
+                counts.update(source_counts)
+    return [stop for stop, _ in counts.most_common(num_hubs)]
+
+
+def use_hubs(hubs):
+    """
+    Makes the searches of NETWORK hub based: sources in hubs are searched as before (global patterns), all other sources on the trip
+    transfers of local_trip_transfers (local patterns).
+    Args:
+        hubs (iterable): stop ids.
+    Returns: None
+    """
+    hubs = frozenset(hubs)
+    NETWORK.update(hubs=hubs, local_trip_transfers=local_trip_transfers(NETWORK["trip_transfers"], NETWORK["trip_route_idx"], NETWORK["stops_dict"], hubs))
+
+
+def pending_sources(output_folder):
+    """
+    Lists the sources that still need to be processed, most expensive (most departures) first so that large hubs
+    do not end up as the tail of the run.
+    Args:
+        output_folder (str): folder with one pattern file per source, named by its stop id. Stats files and the pattern files of
+            departure windows (see window_path) do not mark a source as done.
+    Returns:
+        source_LIST (list): stop ids.
+    """
+    done = set()
+    for file_name in os.listdir(output_folder):
+        if ".tmp" in file_name:
+            os.remove(os.path.join(output_folder, file_name))
+        elif file_name.isdigit():
+            done.add(file_name)
+    departure_counts = NETWORK["departure_counts"]
+    source_LIST = [SOURCE for SOURCE in NETWORK["routes_by_stop_dict"].keys() if str(SOURCE) not in done]
+    source_LIST.sort(key=lambda SOURCE: departure_counts.get(SOURCE, 0), reverse=True)
+    return source_LIST
+
+
+def incremental_plan(FOLDER, previous_path, store_path):
+    """
+    Compares the snapshot the stored patterns were computed on with the current one and puts what run_incremental needs into NETWORK:
+        changed_pairs: stop pairs a stored pattern can no longer be trusted to use, i.e. every (a, b) with a before b on a changed
+            route (in the previous snapshot) and every changed footpath.
+        changed_stops: stops served by a changed route before or after the update, and the ends of changed footpaths. Journeys to
+            them are recomputed for every source. improved_destinations adds more once the full_sources are done.
+        full_sources: sources recomputed for all destinations, the stops whose own departures changed and stops not in the store.
+        retimed_pairs: every (a, b) with a before b on a route whose own stops or trips changed, in the current snapshot.
+    A changed route includes every route with new or changed transfers into an added or retimed route (see diff_network_snapshots).
+    Args:
+        FOLDER (str): network folder. Its current snapshot is compared with previous_path.
+        previous_path (str): snapshot the stored patterns were computed on.
+        store_path (str): pattern store.
+    Returns:
+        full_LIST (list): stop ids to recompute for all destinations, most departures first.
+        source_LIST (list): stop ids to update with run_incremental afterwards, most departures first.
+        removed_sources (list): stop ids in the store that are no longer in the network.
+    """
+    changed_routes, retimed_routes, changed_footpaths = diff_network_snapshots(open_network_snapshot(previous_path), open_network_snapshot(snapshot_path(FOLDER)))
+    stored_sources = set(open_pattern_store(store_path)["sources"].tolist())
+    stops_dict, routes_by_stop_dict, departure_counts = NETWORK["stops_dict"], NETWORK["routes_by_stop_dict"], NETWORK["departure_counts"]
+    changed_pairs = set(changed_footpaths)
+    changed_stops = {stop for footpath in changed_footpaths for stop in footpath}
+    for route, old_stops in changed_routes.items():
+        changed_pairs.update((from_stop, to_stop) for x, from_stop in enumerate(old_stops) for to_stop in old_stops[x + 1:])
+        changed_stops.update(old_stops)
+        changed_stops.update(stops_dict.get(route, []))
+    retimed_pairs = {(from_stop, to_stop) for route in retimed_routes for x, from_stop in enumerate(stops_dict.get(route, []))
+                     for to_stop in stops_dict[route][x + 1:]}
+    full_sources = {stop for route in changed_routes for stop in stops_dict.get(route, [])} | (routes_by_stop_dict.keys() - stored_sources)
+    if WALKING_FROM_SOURCE == 1:
+        full_sources.update(stop for footpath in changed_footpaths for stop in footpath)
+    NETWORK.update(changed_pairs=changed_pairs, changed_stops=changed_stops, full_sources=full_sources, retimed_pairs=retimed_pairs)
+    source_LIST = sorted(routes_by_stop_dict.keys(), key=lambda SOURCE: departure_counts.get(SOURCE, 0), reverse=True)
+    full_LIST = [SOURCE for SOURCE in source_LIST if SOURCE in full_sources]
+    source_LIST = [SOURCE for SOURCE in source_LIST if SOURCE not in full_sources] if changed_stops else []
+    removed_sources = sorted(stored_sources - routes_by_stop_dict.keys())
+    print(f"    {len(changed_routes)} routes ({len(retimed_routes)} retimed) and {len(changed_footpaths)} footpaths changed, "
+          f"{len(full_LIST)} sources recomputed for all destinations, {len(removed_sources)} removed")
+    return full_LIST, source_LIST, removed_sources
+
+
+def improved_destinations(output_folder):
+    """
+    A journey that became optimal through an added or retimed route boards it at one of its stops, and from there on it is an optimal
+    journey of that stop, which the full_sources have just recomputed. The destinations such stops now reach by first riding a retimed
+    route are therefore recomputed for every source as well.
+    Args:
+        output_folder (str): folder with one pattern file per source.
+    Returns:
+        destinations (set): stop ids.
+    """
+    retimed_pairs = NETWORK["retimed_pairs"]
+    destinations = set()
+    for SOURCE in {from_stop for from_stop, _ in retimed_pairs}:
+        destinations.update(pattern[-1] for pattern in dag_patterns(load_pattern_file(f"{output_folder}/{SOURCE}", SOURCE)) if (pattern[0], pattern[1]) in retimed_pairs)
+    return destinations
+
+
+def run_incremental(SOURCE):
+    """
+    Updates the stored transfer patterns of one source after incremental_plan. Patterns that use none of the changed pairs and end at
+    a destination outside changed_stops are kept, the journeys to every other destination are searched again.
+    changed_stops also holds the destinations improved_destinations found, so journeys that only became optimal through a new or
+    retimed trip are searched for as well.
+    Returns:
+        SOURCE (int): stop id.
+        error (str): None on success, otherwise the exception raised for this source.
+    """
+    net = NETWORK
+    routes_by_stop_dict, changed_pairs = net["routes_by_stop_dict"], net["changed_pairs"]
+    if SOURCE in net["full_sources"] or not os.path.exists(f"{net['output_folder']}/{SOURCE}"):
+        return run_parallel(SOURCE)
+    pattern_dag = load_pattern_file(f"{net['output_folder']}/{SOURCE}", SOURCE)
+    affected = set(net["changed_stops"])
+    affected.update(pattern[-1] for pattern in dag_patterns(pattern_dag) if any((pattern[x], pattern[x + 1]) in changed_pairs for x in range(len(pattern) - 1)))
+    DESTINATION_LIST = [desti for desti in affected if desti in routes_by_stop_dict and desti != SOURCE] + [SOURCE]
+    pattern_sink = new_pattern_sink(SOURCE, f"{net['output_folder']}/{SOURCE}")
+    try:
+        for pattern in dag_patterns(pattern_dag):
+            if pattern[-1] not in affected:
+                add_pattern(pattern_sink, pattern)
+        search_source(SOURCE, DESTINATION_LIST, pattern_sink)
+    except Exception as error:
+        abort_pattern_sink(pattern_sink)
+        return SOURCE, repr(error)
+    return SOURCE, None
+
+
+def search_source(SOURCE, DESTINATION_LIST, pattern_sink=None, d_time_window=None):
+    """
+    Runs onetomany_rtbtr for one source, or one departure window of it, on NETWORK and adds the patterns to pattern_sink if one is
+    given (see onetomany_rtbtr). If NETWORK["COLLECT_STATS"] is set, the per-departure statistics of the search are written to
+    {output_folder}/{SOURCE}.stats.json ({SOURCE}.w{start}-{end}.stats.json for a window).
+    Format {"source", "window", "destinations", "total_s", "departures"} with "departures" as filled by onetomany_rtbtr.
+    After use_hubs the search from a source that is not a hub is local.
+    Returns:
+        pattern_dag (dict): transfer patterns returned by onetomany_rtbtr, None with a pattern_sink streaming to a file.
+    """
+    net = NETWORK
+    stats = [] if net.get("COLLECT_STATS") else None
+    destinations = len(DESTINATION_LIST) - 1
+    trip_transfers = net["trip_transfers"]
+    if "hubs" in net and SOURCE not in net["hubs"]:
+        trip_transfers = net["local_trip_transfers"]
+    start = perf_counter()
+    pattern_dag = onetomany_rtbtr(SOURCE, DESTINATION_LIST, net["departures_dict"], MAX_TRANSFER, WALKING_FROM_SOURCE, PRINT_ITINERARY, OPTIMIZED,
+                                  net["routes_by_stop_dict"], net["stops_dict"], net["stoptimes_dict"], net["footpath_dict"], net["idx_by_route_stop_dict"],
+                                  trip_transfers, net["trip_route_idx"], net["route_trip_offset"], net["L"], net["route_times"], stats, pattern_sink,
+                                  d_time_window)
+    if stats is not None:
+        path = f"{window_path(net['output_folder'], SOURCE, d_time_window)}.stats.json"
+        with open(f"{path}.tmp{os.getpid()}", "w") as fp:
+            json.dump({"source": SOURCE, "window": d_time_window, "destinations": destinations, "total_s": perf_counter() - start, "departures": stats}, fp)
+        os.replace(f"{path}.tmp{os.getpid()}", path)
+    return pattern_dag
+
+
+def _stored_edges(output_folder, source_LIST):
+    """
+    Yields (SOURCE, edges) from the pattern files of the given sources, sorted by SOURCE.
+    """
+    for SOURCE in sorted(source_LIST):
+        yield SOURCE, pattern_edges(load_pattern_file(f"{output_folder}/{SOURCE}", SOURCE))
+
+
 def run_parallel(SOURCE):
-    DESTINATION_LIST = list(routes_by_stop_dict.keys())
-    output = onetomany_rtbtr(SOURCE, DESTINATION_LIST, d_time_groups, MAX_TRANSFER, WALKING_FROM_SOURCE, PRINT_ITINERARY,
-                             OPTIMIZED, routes_by_stop_dict, stops_dict, stoptimes_dict, footpath_dict, idx_by_route_stop_dict, trip_transfer_dict,
-                             trip_set)
-    with open(f"./transferpattern/transfer_pattern/{FOLDER}/{SOURCE}", "wb") as fp:
-        pickle.dump(output, fp)
+    """
+    Computes the transfer patterns of one source, streaming them to its pattern file.
+    Returns:
+        SOURCE (int): stop id.
+        error (str): None on success, otherwise the exception raised for this source (the run carries on with the others).
+    """
+    return SOURCE, run_window((SOURCE, None))[1]
 
-if __name__ == "__main__":
-    source_LIST = list(routes_by_stop_dict.keys())
+
+def window_path(output_folder, SOURCE, d_time_window):
+    """
+    Returns:
+        path (str): pattern file of SOURCE, or of one departure window of it. Format {output_folder}/{SOURCE}.w{start}-{end} for windows.
+    """
+    if d_time_window is None:
+        return f"{output_folder}/{SOURCE}"
+    return f"{output_folder}/{SOURCE}.w{d_time_window[0]}-{d_time_window[1]}"
+
+
+def split_departures(source_LIST, max_departures):
+    """
+    Splits the departure sweep of every source with more than max_departures departures into time windows of about max_departures
+    departures (see d_time_window of onetomany_rtbtr), so that a large hub keeps several workers busy instead of being the tail of
+    the run. Windows whose pattern file is left from an interrupted run are not run again.
+    Args:
+        source_LIST (list): stop ids.
+        max_departures (int): 0 runs every source in one piece.
+    Returns:
+        task_LIST (list): Format [(SOURCE, d_time_window)] with d_time_window None for a whole source, most departures first.
+        windows_dict (dict): windows of the split sources. Format {SOURCE: [(start, end)]}.
+    """
+    net = NETWORK
+    task_cost, windows_dict = [], {}
+    for SOURCE in source_LIST:
+        if not net["departure_counts"].get(SOURCE):
+            task_cost.append(((SOURCE, None), 0))
+            continue
+        times = [dep_details[1] for dep_details in source_departures(SOURCE, net["departures_dict"], net["footpath_dict"], WALKING_FROM_SOURCE)][::-1]
+        if not max_departures or len(times) <= max_departures:
+            task_cost.append(((SOURCE, None), len(times)))
+            continue
+        # Departures at the same time must share a window, so boundaries are departure times.
+        num_windows = -(-len(times) // max_departures)
+        bounds = sorted({times[len(times) * x // num_windows] for x in range(1, num_windows)})
+        windows_dict[SOURCE] = list(zip([times[0]] + bounds, bounds + [INF_TIME]))
+        for d_time_window in windows_dict[SOURCE]:
+            if not os.path.exists(window_path(net["output_folder"], SOURCE, d_time_window)):
+                task_cost.append(((SOURCE, d_time_window), sum(d_time_window[0] <= d_time < d_time_window[1] for d_time in times)))
+    task_cost.sort(key=lambda task: task[1], reverse=True)
+    return [task for task, _ in task_cost], windows_dict
+
+
+def run_window(task):
+    """
+    Computes the transfer patterns of one task of split_departures and streams them to the pattern file of the source or window.
+    Returns:
+        task (tuple): Format (SOURCE, d_time_window).
+        error (str): None on success, otherwise the exception raised for this task.
+    """
+    SOURCE, d_time_window = task
+    net = NETWORK
+    pattern_sink = new_pattern_sink(SOURCE, window_path(net["output_folder"], SOURCE, d_time_window))
+    try:
+        search_source(SOURCE, list(net["routes_by_stop_dict"].keys()), pattern_sink, d_time_window)
+    except Exception as error:
+        abort_pattern_sink(pattern_sink)
+        return task, repr(error)
+    return task, None
+
+
+def merge_windows(output_folder, windows_dict):
+    """
+    Merges the window pattern files of every split source whose windows are all done into the pattern file of the source.
+    Args:
+        output_folder (str): folder with one pattern file per source.
+        windows_dict (dict): see split_departures.
+    Returns: None
+    """
+    for SOURCE, windows in windows_dict.items():
+        paths = [window_path(output_folder, SOURCE, d_time_window) for d_time_window in windows]
+        if not all(os.path.exists(path) for path in paths):
+            continue
+        build_pattern_dag(SOURCE, (pattern for path in paths for pattern in dag_patterns(load_pattern_file(path, SOURCE))), f"{output_folder}/{SOURCE}")
+        for path in paths:
+            os.remove(path)
+
+
+def run_pool(worker, source_LIST, cores):
+    """
+    Runs worker for every source in a pool of forked processes that inherit NETWORK.
+    Returns:
+        failed (list): Format [(SOURCE, error)] for the sources worker reported an error for.
+    """
+    # Keep the garbage collector away from the inherited network so its pages stay shared between workers.
+    gc.freeze()
+    failed = []
+    with get_context("fork").Pool(cores) as pool:
+        for SOURCE, error in tqdm(pool.imap_unordered(worker, source_LIST, chunksize=1), total=len(source_LIST)):
+            if error is not None:
+                failed.append((SOURCE, error))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transfer pattern preprocessing using One-To-Many rTBTR.")
+    parser.add_argument("--folder", default="./swiss", help="network folder, e.g. ./sweden or ./swiss")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--incremental", metavar="PREVIOUS_SNAPSHOT", help="snapshot the existing pattern store was computed on. "
+                        "Only journeys affected by the changes since then are recomputed and updated in the store")
+    parser.add_argument("--stats", action="store_true", help="write the per-round search statistics of every source next to its pattern file")
+    parser.add_argument("--split-departures", type=int, default=0, metavar="N", help="run sources with more than N departures as time "
+                        "windows of about N departures on separate workers")
+    parser.add_argument("--hubs", type=int, default=0, metavar="N", help="hub based run: select N hubs, search all other sources locally "
+                        "up to the first hub of a journey")
+    parser.add_argument("--hub-sample", type=int, default=100, help="number of sources searched to select the hubs")
+    args = parser.parse_args()
+
+    print_logo()
+    load_network(args.folder)
+    output_folder = f"./transferpattern/transfer_pattern/{args.folder}"
+    os.makedirs(output_folder, exist_ok=True)
+    NETWORK.update(output_folder=output_folder)
+    store_path = f"{output_folder}.tpstore"
+    hubs = load_store_hubs(store_path)
+    if hubs is None and args.hubs:
+        if args.incremental or os.listdir(output_folder):
+            parser.error(f"the patterns in {output_folder} were computed without hubs, use a new folder for a hub based run")
+        print(f"    Selecting {args.hubs} hubs from {args.hub_sample} sampled sources...")
+        hubs = select_hubs(args.hubs, args.hub_sample, args.cores)
+        write_store_hubs(store_path, hubs)
+    if hubs is not None:
+        use_hubs(hubs)
+        print(f"    {len(hubs)} hubs from {store_path}.hubs, the other sources are searched locally")
+    NETWORK["COLLECT_STATS"] = args.stats
+    if args.incremental:
+        if not os.path.exists(store_path) or not os.path.exists(f"{snapshot_path(args.folder)}/meta.json"):
+            parser.error(f"--incremental needs the pattern store {store_path} and a compiled snapshot of the current network")
+        full_LIST, source_LIST, removed_sources = incremental_plan(args.folder, args.incremental, store_path)
+    else:
+        source_LIST = pending_sources(output_folder)
+        print(f"    {len(source_LIST)} sources left")
     start = time()
-    with Pool(cores) as pool:
-        result = pool.map(run_parallel, source_LIST)
+    if args.incremental:
+        task_LIST, windows_dict = split_departures(full_LIST, args.split_departures)
+        failed = run_pool(run_window, task_LIST, args.cores)
+        merge_windows(output_folder, windows_dict)
+        if not failed:
+            NETWORK["changed_stops"].update(improved_destinations(output_folder))
+            print(f"    Journeys to {len(NETWORK['changed_stops'])} destinations are recomputed for the other sources")
+            failed = run_pool(run_incremental, source_LIST, args.cores)
+        source_LIST = full_LIST + source_LIST
+    else:
+        task_LIST, windows_dict = split_departures(source_LIST, args.split_departures)
+        failed = run_pool(run_window, task_LIST, args.cores)
+        merge_windows(output_folder, windows_dict)
     print(f'    Time required: {round(time() - start)}')
+    if failed:
+        print(f"    {len(failed)} sources failed and will be retried on the next run, e.g. {failed[:5]}")
+    elif args.incremental:
+        update_pattern_store(store_path, _stored_edges(output_folder, source_LIST), removed_sources)
+        for SOURCE in removed_sources:
+            for path in (f"{output_folder}/{SOURCE}", f"{output_folder}/{SOURCE}.stats.json"):
+                if os.path.exists(path):
+                    os.remove(path)
+        print(f"    {len(source_LIST)} sources updated in {store_path}")
+    else:
+        count = convert_pickles_to_store(output_folder, store_path)
+        print(f"    {count} sources written to {store_path}")
+
+
+if __name__ == "__main__":
+    main()
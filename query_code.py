@@ -25,9 +25,9 @@ from pyspark.streaming import StreamingContext
 from time import sleep
 import pandas as pd
 from tqdm import tqdm
-import networkx as nx
 import pickle
-import itertools
+from query_func import *
+from spark_query import query_stream
 
 
 
@@ -96,117 +96,23 @@ def load_all_db(FOLDER):
     transfers_file = pd.read_csv(f'{path}/transfers.txt', sep=',')
     return stops_file, trips_file, stop_times_file, transfers_file
 
-def build_query_graph(SOURCE, FOLDER):
-    with open(f"gdrive/MyDrive/transfer_pattern/{FOLDER}/{SOURCE}", "rb") as fp:   # Unpickling
-        stored_transferpattern = pickle.load(fp)
-    edge_list = [(edge[x], edge[x+1]) for edge in stored_transferpattern for x in range(len(edge)-1)]
-    G = nx.DiGraph()
-    G.add_edges_from(edge_list)
-    adj_list = {int(x.split(',')[0]): [[int(x) for x in x.split(',')[1:]], [], []] for x in list(nx.generate_adjlist(G, delimiter=','))}
-    return adj_list
-
-
-def arrivaltme_query(stop1, stop2, deptime, routesindx_by_stop_dict, stoptimes_dict):
-    routeidx1,routeidx2 = routesindx_by_stop_dict[stop1], routesindx_by_stop_dict[stop2]
-    comon_routes = [(seq1, seq2) for seq1, seq2 in itertools.product(routeidx1,routeidx2) if seq1[0]==seq2[0] and seq1[1]<seq2[1]]
-    arrival_times =[]
-    for iternary in comon_routes:
-        for trip_idx, trip in enumerate(stoptimes_dict[iternary[0][0]]):
-            if trip[iternary[0][1]][1] >= deptime:
-                arrival_times.append(trip[iternary[1][1]][1])
-                break
-    return min(arrival_times)
-
-def multicriteria_dij(SOURCE, D_TIME, DESTINATION, footpath_dict, FOLDER, routesindx_by_stop_dict, stoptimes_dict):
-    try:
-        adjlist_dict = build_query_graph(SOURCE, FOLDER)
-        t_l = []
-        init_label = [D_TIME, 0, 0, 0, SOURCE]  #criteria1, criteria2, pred_node_id, idx_predece_label, self.node_id
-
-        t_l.append(init_label)
-        adjlist_dict[SOURCE][1].append(init_label)
-
-        while t_l:
-            l_q = min(t_l)
-            q = l_q[4]
-
-            #Move l_q from temporary to permanent
-            t_l.remove(l_q)
-            adjlist_dict[q][1].remove(l_q)
-            adjlist_dict[q][2].append(l_q)
-
-            h = adjlist_dict[q][2].index(l_q) #Store the position of label l_q from l_pq
-            for j in adjlist_dict[q][0]:
-                #Compute l_j the current label of vertex j
-                try:
-                    arr_time = arrivaltme_query(q, j, l_q[0], routesindx_by_stop_dict, stoptimes_dict)
-                except ValueError:continue #No trip avaliable after l_q[0]
-                l_j = list((arr_time, l_q[1] + 1, q, h, j))
-
-                #Verify there is no label of j dominated by l_j
-                dominated = False
-                for label in adjlist_dict[j][1] + adjlist_dict[j][2]:
-                    if label[0] <= l_j[0] and label[1] <= l_j[1]:
-                        dominated = True
-                        break
-
-                if dominated == False:
-                    #Store l_j as temporary label of j
-                    adjlist_dict[j][1].append(l_j)
-                    t_l.append(l_j)
-                    #Delete all temporary labels of j dominated by l_j
-                    for label in adjlist_dict[j][1]:
-                        if l_j[0] == label[0] and l_j[1] == label[1]:
-                            continue
-                        if l_j[0] <= label[0] and l_j[1] <= label[1]:
-                            adjlist_dict[j][1].remove(label)
-                            t_l.remove(label)
-            try:
-                for j, footpath_time in footpath_dict[q]:
-                    l_j = list((l_q[0]+ footpath_time, l_q[1], q, h, j))
-
-                    #Verify there is no label of j dominated by l_j
-                    dominated = False
-                    for label in adjlist_dict[j][1] + adjlist_dict[j][2]:
-                        if label[0] <= l_j[0] and label[1] <= l_j[1]:
-                            dominated = True
-                            break
-
-                    if dominated == False:
-                        #Store l_j as temporary label of j
-                        adjlist_dict[j][1].append(l_j)
-                        t_l.append(l_j)
-                        #Delete all temporary labels of j dominated by l_j
-                        for label in adjlist_dict[j][1]:
-                            if l_j[0] == label[0] and l_j[1] == label[1]:
-                                continue
-                            if l_j[0] <= label[0] and l_j[1] <= label[1]:
-                                adjlist_dict[j][1].remove(label)
-                                t_l.remove(label)
-            except KeyError: pass
-        try:
-            TP_output1 = f"Best arrival times are:{list(zip(*adjlist_dict[DESTINATION][2]))[0]}" 
-            return TP_output1
-        except KeyError:
-            return "No Path exist"
-    except FileNotFoundError:
-      return "Invalid Source stop"
-
 # from func_file4 import *
 FOLDER = './sweden'
+GOAL_DIRECTED = 1
+BATCH_SIZE = 50       # OD pairs per micro-batch
+NUM_PARTITIONS = 4    # queries are partitioned by origin
 stops_file, trips_file, stop_times_file, transfers_file, stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict = read_testcase(FOLDER)
-routesindx_by_stop_dict = {stop: list(zip(listofroutes, [stops_dict[x].index(stop) for x in listofroutes])) for stop, listofroutes in routes_by_stop_dict.items()}
+query_network = prepare_query_network(stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict)
+D_TIME = int((pd.to_datetime('2019-11-06 00:20:00') - query_network["day_start"]).total_seconds())
 OD_pairs = pd.read_csv(r"sweden_randomOD.csv", nrows=100)
 
 sc = SparkContext(appName="PythonStreamingQueueStream")
 ssc = StreamingContext(sc, 1)
 
-OD_RDD = []
-for _,i in tqdm(OD_pairs.iterrows()):
-    OD_RDD.append(ssc.sparkContext.parallelize([[i.SOURCE, pd.to_datetime('2019-11-06 00:20:00'), i.DESTINATION]]))
-input_stream = ssc.queueStream(OD_RDD)
-ODmappedStream = input_stream.map(lambda x: multicriteria_dij(x[0], x[1], x[2], footpath_dict, FOLDER, routesindx_by_stop_dict, stoptimes_dict))
-# ODmappedStream = input_stream.map(lambda x: x)
+# The timetable is shipped once per executor, each Python worker builds its timetable index and graph cache once.
+network_bc = sc.broadcast(query_network)
+od_list = [(int(i.SOURCE), D_TIME, int(i.DESTINATION)) for _, i in OD_pairs.iterrows()]
+ODmappedStream = query_stream(ssc, od_list, network_bc, FOLDER, BATCH_SIZE, NUM_PARTITIONS, GOAL_DIRECTED)
 ODmappedStream.pprint()
 ssc.start()
 sleep(600)
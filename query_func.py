@@ -0,0 +1,644 @@
+import sys
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict, deque
+from heapq import heappop, heappush
+
+import numpy as np
+
+from function_file import encode_network, seconds_to_clock
+from pattern_store import get_pattern_edges, load_store_hubs, open_pattern_store, union_pattern_edges
+
+QUERY_GRAPH_CACHE_MAX_BYTES = 512 * 1024 * 1024  # per worker process
+# ("graph", FOLDER, SOURCE, DESTINATION) -> (adjacency, size in bytes) and ("lower_bounds", FOLDER, SOURCE, DESTINATION) ->
+# (lower bounds, size in bytes), least recently used first. DESTINATION is None for graphs that serve every destination.
+_query_graph_cache = OrderedDict()
+_query_graph_cache_stats = {"bytes": 0, "hits": 0, "misses": 0}
+_footpath_edges = {}    # FOLDER -> footpaths as an int64 array of shape (number of footpaths, 2), see hub_query_footpaths
+
+
+def adjacency_from_edges(edges):
+    '''
+    Builds the query graph directly from the pattern edges of a source.
+    Args:
+        edges (numpy.ndarray): int32 array of shape (number of edges, 2) sorted by from stop, as returned by get_pattern_edges.
+    Returns:
+        adjacency (dict): Format {stop_id: (successor stop ids)}. Stops without outgoing edges map to an empty tuple.
+    '''
+    adjacency = {}
+    if len(edges) == 0:
+        return adjacency
+    from_stops, starts = np.unique(edges[:, 0], return_index=True)
+    bounds = starts.tolist() + [len(edges)]
+    to_stops = edges[:, 1].tolist()
+    for x, stop in enumerate(from_stops.tolist()):
+        adjacency[stop] = tuple(to_stops[bounds[x]: bounds[x + 1]])
+    for stop in to_stops:
+        if stop not in adjacency:
+            adjacency[stop] = ()
+    return adjacency
+
+
+def _query_graph_nbytes(adjacency):
+    return sys.getsizeof(adjacency) + sum(sys.getsizeof(successors) + 28 for successors in adjacency.values())
+
+
+def _cache_get(key):
+    '''
+    Returns:
+        value: cached value of key, None if it is not cached. Marks it as most recently used.
+    '''
+    try:
+        value = _query_graph_cache[key][0]
+    except KeyError:
+        _query_graph_cache_stats["misses"] += 1
+        return None
+    _query_graph_cache.move_to_end(key)
+    _query_graph_cache_stats["hits"] += 1
+    return value
+
+
+def _cache_put(key, value, size):
+    '''
+    Adds value to the cache, evicting the least recently used entries beyond QUERY_GRAPH_CACHE_MAX_BYTES.
+    '''
+    if size <= QUERY_GRAPH_CACHE_MAX_BYTES:
+        _query_graph_cache[key] = (value, size)
+        _query_graph_cache_stats["bytes"] += size
+        while _query_graph_cache_stats["bytes"] > QUERY_GRAPH_CACHE_MAX_BYTES:
+            _, (_, evicted_size) = _query_graph_cache.popitem(last=False)
+            _query_graph_cache_stats["bytes"] -= evicted_size
+
+
+def build_query_graph(SOURCE, FOLDER, DESTINATION=None, footpath_dict=None):
+    '''
+    Returns the query graph of SOURCE. Graphs are kept in a per-process LRU cache bounded by QUERY_GRAPH_CACHE_MAX_BYTES,
+    so hub origins that are queried again and again are built only once. The returned dict is shared, do not modify it.
+    If the store was computed with hubs (see write_store_hubs) and SOURCE is not a hub, its local patterns end at the first hub
+    of every journey, and the global patterns of each hub in them are added to continue from there (Bast et al.), see
+    stitch_hub_edges. Bast et al. also add the local patterns towards DESTINATION because their global patterns only cover the
+    hubs. Here the hubs are searched like any full source, so their global patterns reach every stop and the destination side
+    needs nothing of its own (tests/test_hub_patterns.py compares the answers with a store without hubs).
+    Args:
+        SOURCE (int): stop id of source stop.
+        FOLDER (str): network folder.
+        DESTINATION (int): stop id of destination stop. With hubs only the edges on paths to DESTINATION are kept, so the graph of
+            one query stays small. None keeps the global patterns of the hubs whole, for searches to many destinations.
+        footpath_dict (dict): Format {from_stop_id: [(to_stop_id, footpath seconds)]}. Needed with DESTINATION, see edges_toward.
+    Returns:
+        adjacency (dict): Format {stop_id: (successor stop ids)}. Raises KeyError if SOURCE is not in the pattern store.
+    '''
+    path = f"gdrive/MyDrive/transfer_pattern/{FOLDER}.tpstore"
+    hubs = load_store_hubs(path)
+    if hubs is None or SOURCE in hubs or DESTINATION == SOURCE:
+        DESTINATION = None
+    key = ("graph", FOLDER, SOURCE, DESTINATION)
+    adjacency = _cache_get(key)
+    if adjacency is not None:
+        return adjacency
+    store = open_pattern_store(path)   # memory-mapped once per process
+    edges = local_edges = get_pattern_edges(store, SOURCE)
+    if hubs is not None and SOURCE not in hubs:
+        footpath_edges = None if DESTINATION is None else hub_query_footpaths(FOLDER, footpath_dict)
+        edges = stitch_hub_edges(store, local_edges, hubs, DESTINATION, footpath_edges)
+    adjacency = adjacency_from_edges(edges)
+    if DESTINATION is not None and len(local_edges):
+        adjacency.setdefault(SOURCE, ())    # only walks from SOURCE may lead to DESTINATION
+    _cache_put(key, adjacency, _query_graph_nbytes(adjacency))
+    return adjacency
+
+
+def query_lower_bounds(SOURCE, DESTINATION, FOLDER, adjacency, footpath_dict, timetable_index):
+    '''
+    goal_lower_bounds of the query graph of SOURCE, kept in the query graph cache so repeated queries of an OD pair skip the
+    reverse searches.
+    Args:
+        SOURCE (int): stop id of source stop.
+        DESTINATION (int): stop id of destination stop.
+        FOLDER (str): network folder.
+        adjacency (dict): query graph returned by build_query_graph(SOURCE, FOLDER, DESTINATION, footpath_dict).
+        footpath_dict, timetable_index: see goal_lower_bounds.
+    Returns:
+        lower_bounds (dict): see goal_lower_bounds. Shared, do not modify it.
+    '''
+    key = ("lower_bounds", FOLDER, SOURCE, DESTINATION)
+    lower_bounds = _cache_get(key)
+    if lower_bounds is None:
+        lower_bounds = goal_lower_bounds(adjacency, DESTINATION, footpath_dict, timetable_index)
+        _cache_put(key, lower_bounds, sys.getsizeof(lower_bounds) + 92 * len(lower_bounds))
+    return lower_bounds
+
+
+def hub_query_footpaths(FOLDER, footpath_dict):
+    '''
+    Returns:
+        footpath_edges (numpy.ndarray): the footpaths of footpath_dict as an int64 array of shape (number of footpaths, 2) with rows
+            (from stop, to stop) sorted by from stop. Built once per process and FOLDER.
+    '''
+    try:
+        return _footpath_edges[FOLDER]
+    except KeyError:
+        pass
+    footpath_edges = np.array(sorted((from_stop, to_stop) for from_stop, connections in footpath_dict.items() for to_stop, _ in connections),
+                              dtype=np.int64).reshape(-1, 2)
+    _footpath_edges[FOLDER] = footpath_edges
+    return footpath_edges
+
+
+def _ranges(sorted_values, values):
+    '''
+    Returns:
+        positions (numpy.ndarray): positions of all entries of sorted_values equal to one of values, grouped by values.
+    '''
+    starts = np.searchsorted(sorted_values, values, "left")
+    counts = np.searchsorted(sorted_values, values, "right") - starts
+    return np.arange(counts.sum()) + np.repeat(starts - np.cumsum(counts) + counts, counts)
+
+
+def edges_toward(edges, targets, footpath_edges=None):
+    '''
+    Args:
+        edges (numpy.ndarray): int32 array of shape (number of edges, 2), as returned by get_pattern_edges.
+        targets (list): stop ids.
+        footpath_edges (numpy.ndarray): see hub_query_footpaths. _label_search walks between any two stops of a query graph, so
+            the footpaths between the stops of edges and targets lead to targets as well.
+    Returns:
+        edges (numpy.ndarray): the edges on a path to one of targets, in the order of edges.
+    '''
+    if len(edges) == 0:
+        return edges
+    targets = np.asarray(targets, dtype=np.int64)
+    stops = np.union1d(edges, targets)
+    graph = edges
+    if footpath_edges is not None:
+        walks = footpath_edges[_ranges(footpath_edges[:, 0], stops)]
+        graph = np.concatenate([edges, walks[np.isin(walks[:, 1], stops)]])
+    #Backward breadth first search over the edges sorted by to stop, on the positions of their stops in stops so that the
+    #search allocates by the size of the graph and not by the largest stop id
+    graph = np.searchsorted(stops, graph)
+    order = np.argsort(graph[:, 1], kind="stable")
+    to_stops = graph[order, 1]
+    on_path = np.zeros(len(graph), dtype=bool)
+    reached = np.zeros(len(stops), dtype=bool)
+    frontier = np.searchsorted(stops, np.unique(targets))
+    reached[frontier] = True
+    while len(frontier):
+        rows = order[_ranges(to_stops, frontier)]
+        on_path[rows] = True
+        from_stops = np.unique(graph[rows, 0])
+        frontier = from_stops[~reached[from_stops]]
+        reached[frontier] = True
+    return edges[on_path[:len(edges)]]
+
+
+def stitch_hub_edges(store, edges, hubs, DESTINATION=None, footpath_edges=None):
+    '''
+    Adds the global pattern edges of every hub reached by the local patterns of a source. With DESTINATION, only the edges of the
+    stitched graph that lie on a path to DESTINATION are kept. The graph is cut as a whole, because a journey can leave the global
+    patterns of one hub for those of another hub or for the local patterns where they meet or are a walk apart.
+    Args:
+        store (dict): store returned by open_pattern_store.
+        edges (numpy.ndarray): local pattern edges of the source, as returned by get_pattern_edges.
+        hubs (frozenset): stop ids of the hubs of the store.
+        DESTINATION (int): stop id of destination stop, None to keep the whole stitched graph.
+        footpath_edges (numpy.ndarray): see edges_toward.
+    Returns:
+        edges (numpy.ndarray): int32 array of shape (number of edges, 2) sorted by from stop.
+    '''
+    edges_list = [edges]
+    for stop in np.unique(edges[:, 1]).tolist():
+        if stop in hubs:
+            try:
+                edges_list.append(get_pattern_edges(store, stop))
+            except KeyError:    # hub no longer in the network
+                continue
+    if len(edges_list) > 1:
+        edges = union_pattern_edges(edges_list)
+    if DESTINATION is not None:
+        edges = edges_toward(edges, [DESTINATION], footpath_edges)
+    return edges
+
+
+def query_graph_cache_info():
+    '''
+    Returns:
+        info (dict): number of cached graphs and lower bounds, their estimated size in bytes, cache hits and misses of this process.
+    '''
+    graphs = sum(key[0] == "graph" for key in _query_graph_cache)
+    return {"graphs": graphs, "lower_bounds": len(_query_graph_cache) - graphs, **_query_graph_cache_stats}
+
+
+def build_routesindx_by_stop(stops_dict, routes_by_stop_dict):
+    '''
+    Returns:
+        routesindx_by_stop_dict (dict): Format {stop_id: [(route_id, stop index in route)]}.
+    '''
+    return {stop: list(zip(listofroutes, [stops_dict[x].index(stop) for x in listofroutes])) for stop, listofroutes in routes_by_stop_dict.items()}
+
+
+def prepare_query_network(stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict):
+    '''
+    Converts the dicts returned by read_testcase into the structures used by the queries.
+    Args:
+        stops_dict (dict): preprocessed dict. Format {route_id: [ids of stops in the route]}.
+        stoptimes_dict (dict): preprocessed dict. Format {route_id: [[trip_1], [trip_2]]}.
+        footpath_dict (dict): preprocessed dict. Format {from_stop_id: [(to_stop_id, footpath_time)]}.
+        routes_by_stop_dict (dict): preprocessed dict. Format {stop_id: [id of routes passing through stop]}.
+    Returns:
+        query_network (dict): keys "stoptimes_dict" and "footpath_dict" in seconds (see encode_network), "routesindx_by_stop_dict"
+            (Format {stop_id: [(route_id, stop index in route)]}) and "day_start" (pandas.datetime corresponding to 0 seconds).
+    '''
+    stoptimes_dict, footpath_dict, _, _, _, _, day_start = encode_network(stoptimes_dict, footpath_dict, {})
+    routesindx_by_stop_dict = build_routesindx_by_stop(stops_dict, routes_by_stop_dict)
+    return {"stoptimes_dict": stoptimes_dict, "footpath_dict": footpath_dict, "routesindx_by_stop_dict": routesindx_by_stop_dict, "day_start": day_start}
+
+
+class _LazyIndex(dict):
+    '''
+    dict whose entries are built by build(key) on first access and kept.
+    '''
+
+    def __init__(self, build):
+        super().__init__()
+        self._build = build
+
+    def __missing__(self, key):
+        value = self[key] = self._build(key)
+        return value
+
+
+def _route_departures(stoptimes_dict, route):
+    trips = stoptimes_dict[route]
+    if not trips:
+        raise KeyError(route)
+    return [list(times) for times in zip(*[[arrival for _, arrival in trip] for trip in trips])]
+
+
+def build_timetable_index(stoptimes_dict, routesindx_by_stop_dict):
+    '''
+    Builds the timetable index used by arrivaltme_query. Built once per network and shared by all queries. Its entries are filled
+    on first use, so a process only converts the routes and stops its queries touch.
+    Args:
+        stoptimes_dict (dict): Format {route_id: [[trip_1], [trip_2]]} where trip_1 = [(stop id, arrival seconds)] (see encode_network).
+        routesindx_by_stop_dict (dict): Format {stop_id: [(route_id, stop index in route)]}.
+    Returns:
+        timetable_index (dict): keys
+            "departures": Format {route_id: [times at stop index 0, times at stop index 1, ...]}. Every list holds one time per trip
+                in stoptimes_dict order, so it is sorted (trips of a route do not overtake each other) and can be bisected.
+                Routes without trips are missing.
+            "routes_by_stop": Format {stop_id: {route_id: stop index in route}}.
+            "connections": Format {(stop_id, stop_id): [(route_id, from stop index, to stop index)]}. Filled lazily by _connections.
+            "min_ride": Format {(stop_id, stop_id): seconds}. Filled lazily by min_ride_time.
+    '''
+    departures = _LazyIndex(lambda route: _route_departures(stoptimes_dict, route))
+    routes_by_stop = _LazyIndex(lambda stop: dict(routesindx_by_stop_dict[stop]))
+    return {"departures": departures, "routes_by_stop": routes_by_stop, "connections": {}, "min_ride": {}}
+
+
+def _connections(stop1, stop2, timetable_index):
+    '''
+    Returns:
+        connections (list): routes running from stop1 to stop2. Format [(route_id, from stop index, to stop index)]. Memoised in timetable_index.
+    '''
+    try:
+        return timetable_index["connections"][(stop1, stop2)]
+    except KeyError:
+        routeidx2 = timetable_index["routes_by_stop"][stop2]
+        connections = [(route, from_idx, routeidx2[route]) for route, from_idx in timetable_index["routes_by_stop"][stop1].items()
+                       if route in routeidx2 and from_idx < routeidx2[route]]
+        timetable_index["connections"][(stop1, stop2)] = connections
+        return connections
+
+
+def arrivaltme_query(stop1, stop2, deptime, timetable_index):
+    '''
+    Earliest arrival at stop2 when boarding any route from stop1 to stop2 at or after deptime.
+    Args:
+        stop1 (int): boarding stop id.
+        stop2 (int): alighting stop id.
+        deptime (int): earliest departure in seconds.
+        timetable_index (dict): index returned by build_timetable_index.
+    Returns:
+        arrival (int): arrival seconds at stop2. Raises ValueError if no trip leaves stop1 for stop2 at or after deptime.
+    '''
+    departures = timetable_index["departures"]
+    arrival_times = []
+    for route, from_idx, to_idx in _connections(stop1, stop2, timetable_index):
+        times = departures[route]
+        trip_idx = bisect_left(times[from_idx], deptime)
+        if trip_idx < len(times[from_idx]):
+            arrival_times.append(times[to_idx][trip_idx])
+    return min(arrival_times)
+
+def min_ride_time(stop1, stop2, timetable_index):
+    '''
+    Shortest in-vehicle time from stop1 to stop2 over all connecting routes and trips. Memoised in timetable_index.
+    Returns:
+        ride (int): seconds, None if no route runs from stop1 to stop2.
+    '''
+    try:
+        return timetable_index["min_ride"][(stop1, stop2)]
+    except KeyError:
+        pass
+    departures = timetable_index["departures"]
+    rides = [min(to_time - from_time for from_time, to_time in zip(departures[route][from_idx], departures[route][to_idx]))
+             for route, from_idx, to_idx in _connections(stop1, stop2, timetable_index)]
+    ride = min(rides) if rides else None
+    timetable_index["min_ride"][(stop1, stop2)] = ride
+    return ride
+
+
+def goal_lower_bounds(adjacency, DESTINATION, footpath_dict, timetable_index):
+    '''
+    Lower bounds on the remaining travel time and number of trips from every stop of a query graph to DESTINATION.
+    Trip edges are weighted with min_ride_time and footpaths with their duration, so waiting is ignored and the bounds never overestimate.
+    Args:
+        adjacency (dict): query graph returned by build_query_graph.
+        DESTINATION (int): stop id of destination stop.
+        footpath_dict (dict): Format {from_stop_id: [(to_stop_id, footpath seconds)]}.
+        timetable_index (dict): index returned by build_timetable_index.
+    Returns:
+        lower_bounds (dict): Format {stop_id: (seconds, trips)}. Stops that cannot reach DESTINATION are missing.
+    '''
+    reverse_trip, reverse_walk = defaultdict(list), defaultdict(list)
+    for q, successors in adjacency.items():
+        for j in successors:
+            ride = min_ride_time(q, j, timetable_index)
+            if ride is not None:
+                reverse_trip[j].append((q, ride))
+        for j, footpath_time in footpath_dict.get(q, ()):
+            if j in adjacency:
+                reverse_walk[j].append((q, footpath_time))
+    #Dijkstra on travel time
+    time_bound = {}
+    heap = [(0, DESTINATION)]
+    while heap:
+        seconds, j = heappop(heap)
+        if j in time_bound:
+            continue
+        time_bound[j] = seconds
+        for q, weight in reverse_trip[j] + reverse_walk[j]:
+            if q not in time_bound:
+                heappush(heap, (seconds + weight, q))
+    #0-1 BFS on number of trips (footpaths are free)
+    trip_bound = {DESTINATION: 0}
+    queue = deque([DESTINATION])
+    while queue:
+        j = queue.popleft()
+        trips = trip_bound[j]
+        for q, _ in reverse_walk[j]:
+            if trip_bound.get(q, trips + 1) > trips:
+                trip_bound[q] = trips
+                queue.appendleft(q)
+        for q, _ in reverse_trip[j]:
+            if trip_bound.get(q, trips + 2) > trips + 1:
+                trip_bound[q] = trips + 1
+                queue.append(q)
+    return {stop: (seconds, trip_bound[stop]) for stop, seconds in time_bound.items()}
+
+
+def _dominated(bag, time, transfers):
+    '''
+    Checks if a label of the Pareto bag dominates (time, transfers) (equal labels count as dominating).
+    Args:
+        bag (list): [times, transfers] where times is ascending and transfers strictly descending, so the bag is always a Pareto set.
+    Returns:
+        dominated (bool)
+    '''
+    position = bisect_right(bag[0], time)
+    #The label with the latest time <= time has the fewest transfers among them
+    return position > 0 and bag[1][position - 1] <= transfers
+
+
+def _insert_pareto(bag, time, transfers):
+    '''
+    Inserts (time, transfers) into a Pareto bag unless an existing label dominates it.
+    Args:
+        bag (list): see _dominated.
+        time (int): arrival seconds of the new label.
+        transfers (int): number of trips of the new label.
+    Returns:
+        inserted (bool): False if the new label is dominated. Labels dominated by the new one are removed from the bag.
+    '''
+    if _dominated(bag, time, transfers):
+        return False
+    times, transfers_list = bag
+    position = end = bisect_left(times, time)
+    while end < len(times) and transfers_list[end] >= transfers:
+        end = end + 1
+    times[position:end] = [time]
+    transfers_list[position:end] = [transfers]
+    return True
+
+
+def _label_search(adjacency, SOURCE, D_TIME, DESTINATION, footpath_dict, timetable_index, lower_bounds):
+    '''
+    Bicriteria (arrival time, number of trips) label-setting search on the query graph of SOURCE.
+    Temporary labels live in a binary heap with lazy deletion: a popped label is skipped if it has been removed from the Pareto
+    bag of its stop in the meantime. Labels are tuples (key time, key trips, arrival time, number of trips, stop_id,
+    predecessor stop_id, index of the predecessor label in the settled list of that stop), where the key adds the lower bounds
+    of the stop to its criteria. Labels whose key is dominated by the Pareto bag of DESTINATION cannot contribute and are pruned,
+    and the search stops once no label left in the heap can.
+    Args:
+        adjacency (dict): query graph returned by build_query_graph. Must contain SOURCE.
+        SOURCE (int): stop id of source stop.
+        D_TIME (int): departure seconds.
+        DESTINATION (int): stop id of destination stop. None searches the whole graph without pruning (one-to-many).
+        footpath_dict (dict): Format {from_stop_id: [(to_stop_id, footpath seconds)]}.
+        timetable_index (dict): index returned by build_timetable_index.
+        lower_bounds (dict): Format {stop_id: (seconds, trips)}. Stops missing from it are never labelled. Must contain SOURCE.
+    Returns:
+        bags (dict): final Pareto bags. Format {stop_id: [arrival times ascending, number of trips descending]}.
+    '''
+    min_trips = lower_bounds[SOURCE][1]     #no journey to DESTINATION takes fewer trips
+    bags = {SOURCE: [[D_TIME], [0]]}    #Pareto bag of temporary and settled labels per stop
+    settled = {}                        #settled labels per stop, in settling order
+    destination_bag = bags.setdefault(DESTINATION, [[], []])
+    heap = [(D_TIME + lower_bounds[SOURCE][0], min_trips, D_TIME, 0, SOURCE, 0, 0)]
+    while heap:
+        l_q = heappop(heap)
+        key_time, key_transfers, time, transfers, q = l_q[:5]
+        #Every label left has key time >= key_time and key trips >= min_trips
+        if _dominated(destination_bag, key_time, min_trips):
+            break
+        times, transfers_list = bags[q]
+        position = bisect_left(times, time)
+        if position == len(times) or times[position] != time or transfers_list[position] != transfers:
+            continue    #Removed from the bag by a dominating label
+        if q != DESTINATION and _dominated(destination_bag, key_time, key_transfers):
+            continue
+        settled_q = settled.setdefault(q, [])
+        h = len(settled_q)
+        settled_q.append(l_q)
+        for j in adjacency[q]:
+            if j not in lower_bounds:
+                continue
+            try:
+                arr_time = arrivaltme_query(q, j, time, timetable_index)
+            except ValueError:continue #No trip avaliable after time
+            bound_time, bound_transfers = lower_bounds[j]
+            if (j == DESTINATION or not _dominated(destination_bag, arr_time + bound_time, transfers + 1 + bound_transfers)) \
+                    and _insert_pareto(bags.setdefault(j, [[], []]), arr_time, transfers + 1):
+                heappush(heap, (arr_time + bound_time, transfers + 1 + bound_transfers, arr_time, transfers + 1, j, q, h))
+        for j, footpath_time in footpath_dict.get(q, ()):
+            if j not in lower_bounds:
+                continue
+            arr_time = time + footpath_time
+            bound_time, bound_transfers = lower_bounds[j]
+            if (j == DESTINATION or not _dominated(destination_bag, arr_time + bound_time, transfers + bound_transfers)) \
+                    and _insert_pareto(bags.setdefault(j, [[], []]), arr_time, transfers):
+                heappush(heap, (arr_time + bound_time, transfers + bound_transfers, arr_time, transfers, j, q, h))
+    return bags
+
+
+def _format_arrivals(times):
+    if not times:
+        return "No Path exist"
+    return f"Best arrival times are:{tuple(seconds_to_clock(time) for time in times)}"
+
+
+def multicriteria_dij(SOURCE, D_TIME, DESTINATION, footpath_dict, FOLDER, timetable_index, GOAL_DIRECTED=0):
+    '''
+    Pareto optimal (arrival time, number of trips) journeys from SOURCE to DESTINATION on its query graph, see _label_search.
+    Args:
+        SOURCE (int): stop id of source stop.
+        D_TIME (int): departure seconds.
+        DESTINATION (int): stop id of destination stop.
+        footpath_dict (dict): Format {from_stop_id: [(to_stop_id, footpath seconds)]}.
+        FOLDER (str): network folder.
+        timetable_index (dict): index returned by build_timetable_index.
+        GOAL_DIRECTED (int): 1 to use the lower bounds of goal_lower_bounds (cached by query_lower_bounds), 0 to use zero bounds
+            (the search settles every stop that is not dominated by DESTINATION).
+    Returns:
+        TP_output1 (str): Pareto optimal arrival times at DESTINATION, "No Path exist" or "Invalid Source stop".
+    '''
+    try:
+        adjacency = build_query_graph(SOURCE, FOLDER, DESTINATION, footpath_dict)
+    except KeyError:    # SOURCE is not in the pattern store
+      return "Invalid Source stop"
+    if SOURCE not in adjacency:
+        return "Invalid Source stop"
+    if DESTINATION not in adjacency:
+        return "No Path exist"
+    if GOAL_DIRECTED == 1:
+        lower_bounds = query_lower_bounds(SOURCE, DESTINATION, FOLDER, adjacency, footpath_dict, timetable_index)
+    else:
+        lower_bounds = dict.fromkeys(adjacency, (0, 0))
+    if SOURCE not in lower_bounds:
+        return "No Path exist"
+    bags = _label_search(adjacency, SOURCE, D_TIME, DESTINATION, footpath_dict, timetable_index, lower_bounds)
+    TP_output1 = _format_arrivals(bags[DESTINATION][0])
+    return TP_output1
+
+
+def multicriteria_onetomany(SOURCE, D_TIME, DESTINATION_LIST, footpath_dict, FOLDER, timetable_index):
+    '''
+    Answers several queries that share SOURCE and D_TIME with one search over the whole query graph of SOURCE.
+    Args:
+        SOURCE (int): stop id of source stop.
+        D_TIME (int): departure seconds.
+        DESTINATION_LIST (list): stop ids of destination stops.
+        footpath_dict (dict): Format {from_stop_id: [(to_stop_id, footpath seconds)]}.
+        FOLDER (str): network folder.
+        timetable_index (dict): index returned by build_timetable_index.
+    Returns:
+        TP_output_list (list): output of multicriteria_dij for every stop of DESTINATION_LIST.
+    '''
+    pareto_list = pareto_onetomany(SOURCE, D_TIME, DESTINATION_LIST, footpath_dict, FOLDER, timetable_index)
+    if pareto_list is None:
+        return ["Invalid Source stop"] * len(DESTINATION_LIST)
+    TP_output_list = [_format_arrivals([time for time, _ in pareto]) for pareto in pareto_list]
+    return TP_output_list
+
+
+def multicriteria_batch(query_list, footpath_dict, FOLDER, timetable_index, GOAL_DIRECTED=0):
+    '''
+    Answers queries of many origins. Queries sharing origin and departure time are answered together: a single query by
+    multicriteria_dij (which can use goal directed pruning), several by one search of multicriteria_onetomany.
+    Args:
+        query_list (list): Format [(SOURCE, D_TIME, DESTINATION)].
+        footpath_dict (dict): Format {from_stop_id: [(to_stop_id, footpath seconds)]}.
+        FOLDER (str): network folder.
+        timetable_index (dict): index returned by build_timetable_index.
+        GOAL_DIRECTED (int): see multicriteria_dij, only used for single queries.
+    Returns:
+        TP_output_list (list): output of multicriteria_dij for every query, in the order of query_list.
+    '''
+    positions_dict = defaultdict(list)
+    for x, (SOURCE, D_TIME, DESTINATION) in enumerate(query_list):
+        positions_dict[(SOURCE, D_TIME)].append(x)
+    TP_output_list = [None] * len(query_list)
+    for (SOURCE, D_TIME), positions in positions_dict.items():
+        if len(positions) == 1:
+            TP_output_list[positions[0]] = multicriteria_dij(SOURCE, D_TIME, query_list[positions[0]][2], footpath_dict, FOLDER, timetable_index, GOAL_DIRECTED)
+        else:
+            outputs = multicriteria_onetomany(SOURCE, D_TIME, [query_list[x][2] for x in positions], footpath_dict, FOLDER, timetable_index)
+            for x, output in zip(positions, outputs):
+                TP_output_list[x] = output
+    return TP_output_list
+
+
+def pareto_arrays(pareto_list):
+    '''
+    Packs Pareto sets into flat arrays for matrix consumers, e.g. the earliest arrivals are arrival[pareto_start[:-1]] for the
+    entries with pareto_start[x] < pareto_start[x + 1].
+    Args:
+        pareto_list (list): Format [[(arrival seconds, number of trips)]].
+    Returns:
+        pareto_start (numpy.ndarray): int64 array of length len(pareto_list) + 1, the labels of entry x are [pareto_start[x]: pareto_start[x + 1]].
+        arrival (numpy.ndarray): int32 arrival seconds, ascending within an entry.
+        trips (numpy.ndarray): int32 number of trips, descending within an entry.
+    '''
+    pareto_start = np.zeros(len(pareto_list) + 1, dtype=np.int64)
+    pareto_start[1:] = np.cumsum([len(pareto) for pareto in pareto_list])
+    arrival = np.fromiter((time for pareto in pareto_list for time, _ in pareto), dtype=np.int32, count=int(pareto_start[-1]))
+    trips = np.fromiter((trips for pareto in pareto_list for _, trips in pareto), dtype=np.int32, count=int(pareto_start[-1]))
+    return pareto_start, arrival, trips
+
+
+def pareto_onetomany(SOURCE, D_TIME, DESTINATION_LIST, footpath_dict, FOLDER, timetable_index, AS_ARRAYS=0):
+    '''
+    Pareto optimal (arrival time, number of trips) labels of many destinations, e.g. an isochrone or one row of an OD matrix,
+    from one search over the whole query graph of SOURCE.
+    Args:
+        SOURCE (int): stop id of source stop.
+        D_TIME (int): departure seconds.
+        DESTINATION_LIST (list): stop ids of destination stops.
+        footpath_dict (dict): Format {from_stop_id: [(to_stop_id, footpath seconds)]}.
+        FOLDER (str): network folder.
+        timetable_index (dict): index returned by build_timetable_index.
+        AS_ARRAYS (int): 1 to return the labels packed by pareto_arrays.
+    Returns:
+        pareto_list (list): Pareto set of every stop of DESTINATION_LIST. Format [[(arrival seconds, number of trips)]] by ascending
+            arrival time, empty if there is no path. None if SOURCE is not in the pattern store.
+            With AS_ARRAYS=1 the output of pareto_arrays instead, every entry empty if SOURCE is not in the pattern store.
+    '''
+    try:
+        adjacency = build_query_graph(SOURCE, FOLDER)
+    except KeyError:    # SOURCE is not in the pattern store
+        adjacency = {}
+    pareto_list = None
+    if SOURCE in adjacency:
+        bags = _label_search(adjacency, SOURCE, D_TIME, None, footpath_dict, timetable_index, dict.fromkeys(adjacency, (0, 0)))
+        pareto_list = [list(zip(*bags[DESTINATION])) if DESTINATION in bags else [] for DESTINATION in DESTINATION_LIST]
+    if AS_ARRAYS == 1:
+        return pareto_arrays(pareto_list if pareto_list is not None else [[]] * len(DESTINATION_LIST))
+    return pareto_list
+
+
+def pareto_manytomany(SOURCE_LIST, D_TIME, DESTINATION_LIST, footpath_dict, FOLDER, timetable_index, AS_ARRAYS=0):
+    '''
+    OD matrix: pareto_onetomany for every origin, one search per origin.
+    Args:
+        SOURCE_LIST (list): stop ids of source stops.
+        D_TIME (int): departure seconds.
+        DESTINATION_LIST (list): stop ids of destination stops.
+        footpath_dict, FOLDER, timetable_index, AS_ARRAYS: see pareto_onetomany.
+    Returns:
+        pareto_matrix (list): Format pareto_matrix[x][y] = Pareto set from SOURCE_LIST[x] to DESTINATION_LIST[y], a row is None if
+            the origin is not in the pattern store. With AS_ARRAYS=1 the output of pareto_arrays over the matrix in row-major
+            order (entry x * len(DESTINATION_LIST) + y).
+    '''
+    pareto_matrix = [pareto_onetomany(SOURCE, D_TIME, DESTINATION_LIST, footpath_dict, FOLDER, timetable_index) for SOURCE in SOURCE_LIST]
+    if AS_ARRAYS == 1:
+        return pareto_arrays([pareto for row in pareto_matrix for pareto in (row if row is not None else [[]] * len(DESTINATION_LIST))])
+    return pareto_matrix
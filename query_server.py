@@ -0,0 +1,189 @@
+"""
+Local query service for transfer pattern queries, an alternative to the Spark Streaming job in query_code.py.
+The network, the timetable index and the pattern store stay resident. Requests arriving within BATCH_WINDOW seconds of each
+other that share an origin are answered by one pool task, and requests of such a batch with the same departure time by one search.
+Usage: python query_server.py --folder ./sweden --port 8000 --workers 8
+    GET /query?source=<stop id>&destination=<stop id>&departure=<HH:MM:SS or seconds>
+    GET /stats    latency percentiles (ms) and throughput since start
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from time import perf_counter
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from network_snapshot import load_query_network
+from query_func import build_timetable_index, multicriteria_batch
+
+BATCH_WINDOW = 0.002    # seconds a request waits for other requests from the same origin
+MAX_BATCH = 256         # a batch is dispatched as soon as it holds this many requests
+LATENCY_WINDOW = 10000  # number of recent requests the latency percentiles are computed over
+# Filled once by load_network in the parent. Pool workers are forked afterwards and read it without copying or unpickling.
+NETWORK = {}
+_pending = {}   # SOURCE -> [(D_TIME, DESTINATION, asyncio.Future)] waiting to be dispatched
+# "start" is set by main once the network and the pool are ready, so the throughput only counts serving time.
+_metrics = {"latencies": deque(maxlen=LATENCY_WINDOW), "answered": 0, "batches": 0, "start": None}
+
+
+def load_network(FOLDER, GOAL_DIRECTED):
+    """
+    Reads the network (from its snapshot if one has been compiled) and builds the timetable index into NETWORK.
+    Args:
+        FOLDER (str): network folder.
+        GOAL_DIRECTED (int): see multicriteria_dij.
+    Returns: None
+    """
+    query_network = load_query_network(FOLDER)
+    NETWORK.update(FOLDER=FOLDER, GOAL_DIRECTED=GOAL_DIRECTED, footpath_dict=query_network["footpath_dict"],
+                   timetable_index=build_timetable_index(query_network["stoptimes_dict"], query_network["routesindx_by_stop_dict"]))
+
+
+def answer_batch(SOURCE, query_list):
+    """
+    Answers queries sharing SOURCE in a pool worker with multicriteria_batch, so queries with the same departure time are answered
+    by one search.
+    Args:
+        SOURCE (int): stop id of source stop.
+        query_list (list): Format [(D_TIME, DESTINATION)].
+    Returns:
+        TP_output_list (list): output of multicriteria_dij for every query, in the order of query_list.
+    """
+    net = NETWORK
+    return multicriteria_batch([(SOURCE, D_TIME, DESTINATION) for D_TIME, DESTINATION in query_list], net["footpath_dict"], net["FOLDER"],
+                               net["timetable_index"], net["GOAL_DIRECTED"])
+
+
+def _dispatch(pool, SOURCE, batch):
+    """
+    Hands a batch to the process pool unless it has already been dispatched.
+    """
+    if _pending.get(SOURCE) is not batch:
+        return
+    del _pending[SOURCE]
+    _metrics["batches"] += 1
+    task = asyncio.get_running_loop().run_in_executor(pool, answer_batch, SOURCE, [(D_TIME, DESTINATION) for D_TIME, DESTINATION, _ in batch])
+
+    def _resolve(task):
+        error = task.exception()
+        for x, (_, _, waiter) in enumerate(batch):
+            if waiter.done():
+                continue
+            if error is not None:
+                waiter.set_exception(error)
+            else:
+                waiter.set_result(task.result()[x])
+    task.add_done_callback(_resolve)
+
+
+async def query(pool, SOURCE, D_TIME, DESTINATION):
+    """
+    Queues one query into the batch of its origin and waits for the answer.
+    Returns:
+        TP_output1 (str): output of multicriteria_dij.
+    """
+    loop = asyncio.get_running_loop()
+    waiter = loop.create_future()
+    batch = _pending.get(SOURCE)
+    if batch is None:
+        batch = _pending[SOURCE] = []
+        loop.call_later(BATCH_WINDOW, _dispatch, pool, SOURCE, batch)
+    batch.append((D_TIME, DESTINATION, waiter))
+    if len(batch) >= MAX_BATCH:
+        _dispatch(pool, SOURCE, batch)
+    return await waiter
+
+
+def parse_departure(departure):
+    """
+    Converts "HH:MM:SS" (hours may exceed 24) or plain seconds to seconds since the start of the service day.
+    """
+    if ":" not in departure:
+        return int(departure)
+    hours, minutes, seconds = [int(x) for x in departure.split(":")]
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def server_stats():
+    """
+    Returns:
+        stats (dict): answered queries, dispatched batches, throughput (queries per second since serving started) and latency percentiles in ms.
+    """
+    elapsed = perf_counter() - _metrics["start"]
+    stats = {"answered": _metrics["answered"], "batches": _metrics["batches"], "throughput": round(_metrics["answered"] / elapsed, 2)}
+    if _metrics["latencies"]:
+        p50, p95, p99 = np.percentile(np.array(_metrics["latencies"]) * 1000, [50, 95, 99])
+        stats.update(p50_ms=round(p50, 3), p95_ms=round(p95, 3), p99_ms=round(p99, 3))
+    return stats
+
+
+async def handle_connection(pool, reader, writer):
+    """
+    Serves one HTTP/1.0 style request (the connection is closed after the response).
+    """
+    start = perf_counter()
+    request_line = (await reader.readline()).decode("latin-1").split()
+    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+        pass
+    status, body = "404 Not Found", {"error": "unknown path"}
+    url = urlsplit(request_line[1]) if len(request_line) > 1 else None
+    if url is not None and url.path == "/query":
+        params = parse_qs(url.query)
+        try:
+            SOURCE, DESTINATION = int(params["source"][0]), int(params["destination"][0])
+            D_TIME = parse_departure(params["departure"][0])
+        except (KeyError, ValueError):
+            status, body = "400 Bad Request", {"error": "expected source, destination and departure"}
+        else:
+            try:
+                output = await query(pool, SOURCE, D_TIME, DESTINATION)
+                status, body = "200 OK", {"source": SOURCE, "destination": DESTINATION, "departure": D_TIME, "result": output}
+                _metrics["answered"] += 1
+                _metrics["latencies"].append(perf_counter() - start)
+            except Exception as error:
+                status, body = "500 Internal Server Error", {"error": repr(error)}
+    elif url is not None and url.path == "/stats":
+        status, body = "200 OK", server_stats()
+    payload = json.dumps(body).encode()
+    writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+    try:
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(pool, host, port):
+    server = await asyncio.start_server(lambda reader, writer: handle_connection(pool, reader, writer), host, port)
+    print(f"    Serving on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local transfer pattern query service.")
+    parser.add_argument("--folder", default="./sweden", help="network folder, e.g. ./sweden or ./swiss")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--goal-directed", type=int, default=1, help="1 to use goal directed pruning for single queries")
+    args = parser.parse_args()
+
+    load_network(args.folder, args.goal_directed)
+    # Keep the garbage collector away from the inherited network so its pages stay shared between workers.
+    gc.freeze()
+    with ProcessPoolExecutor(args.workers, mp_context=get_context("fork")) as pool:
+        _metrics["start"] = perf_counter()
+        try:
+            asyncio.run(serve(pool, args.host, args.port))
+        except KeyboardInterrupt:
+            print(f"    {server_stats()}")
+
+
+if __name__ == "__main__":
+    main()
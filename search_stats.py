@@ -0,0 +1,73 @@
+"""
+Aggregates the search statistics written by preprocessing_code.py --stats and ranks the most expensive sources.
+Usage: python search_stats.py ./transferpattern/transfer_pattern/./sweden --top 20 --sort total_s
+    --csv sources.csv    also writes the per-source table
+Per round totals over all sources are printed as well, compare them before and after a pruning change.
+"""
+import argparse
+import json
+import os
+
+import pandas as pd
+
+ROUND_COLUMNS = ["segments_scanned", "segments_enqueued", "rt_updates", "labels_improved", "destinations_in_scope", "scan_s", "enqueue_s"]
+
+
+def aggregate_stats(stats_folder):
+    '''
+    Reads every {SOURCE}.stats.json of a pattern folder. The windows of a source run with --split-departures are added up.
+    Args:
+        stats_folder (str): folder the pattern files and statistics were written to.
+    Returns:
+        sources (pandas.DataFrame): one row per source with its departures, destinations, total seconds, the round columns summed over
+            all departures and rounds, postprocess_s and max_round (last round that scanned a trip segment). The searches seeding
+            departure windows count towards the totals but not towards departures.
+        rounds (pandas.DataFrame): one row per round with the round columns summed over all sources and departures.
+    '''
+    source_rows, round_rows = [], []
+    for file_name in os.listdir(stats_folder):
+        if not file_name.endswith(".stats.json"):
+            continue
+        with open(os.path.join(stats_folder, file_name)) as fp:
+            source_stats = json.load(fp)
+        departure_rounds = pd.DataFrame([round_stats for departure in source_stats["departures"] for round_stats in departure["rounds"]],
+                                        columns=["round"] + ROUND_COLUMNS)
+        row = {"source": source_stats["source"], "departures": sum(departure["d_time"] is not None for departure in source_stats["departures"]),
+               "destinations": source_stats["destinations"],
+               "total_s": source_stats["total_s"], **{column: departure_rounds[column].sum().item() for column in ROUND_COLUMNS},
+               "postprocess_s": sum(departure["postprocess_s"] for departure in source_stats["departures"]),
+               "max_round": int(departure_rounds.loc[departure_rounds["segments_scanned"] > 0, "round"].max()) if len(departure_rounds) else 0}
+        source_rows.append(row)
+        round_rows.append(departure_rounds.groupby("round")[ROUND_COLUMNS].sum())
+    sources = pd.DataFrame(source_rows, columns=["source", "departures", "destinations", "total_s"] + ROUND_COLUMNS + ["postprocess_s", "max_round"])
+    sources = sources.groupby("source", as_index=False).agg({column: "max" if column in ("destinations", "max_round") else "sum" for column in sources.columns[1:]})
+    rounds = pd.concat(round_rows).groupby(level=0).sum() if round_rows else pd.DataFrame(columns=ROUND_COLUMNS)
+    return sources, rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rank sources by the search statistics written by preprocessing_code.py --stats.")
+    parser.add_argument("stats_folder", help="pattern folder, e.g. ./transferpattern/transfer_pattern/./sweden")
+    parser.add_argument("--top", type=int, default=20, help="number of sources to list")
+    parser.add_argument("--sort", default="total_s", help="column to rank by, e.g. total_s, segments_scanned or rt_updates")
+    parser.add_argument("--csv", help="write the table of all sources to this file")
+    args = parser.parse_args()
+
+    sources, rounds = aggregate_stats(args.stats_folder)
+    if sources.empty:
+        parser.error(f"no .stats.json files in {args.stats_folder}, run preprocessing_code.py with --stats first")
+    if args.sort not in sources.columns:
+        parser.error(f"--sort must be one of {', '.join(sources.columns)}")
+    sources = sources.sort_values(args.sort, ascending=False)
+    if args.csv:
+        sources.to_csv(args.csv, index=False)
+    total = sources["total_s"].sum()
+    print(f"    {len(sources)} sources, {round(total, 1)} s of search time")
+    print(f"    Top {args.top} by {args.sort} ({round(sources['total_s'].head(args.top).sum() / total * 100, 1)}% of the search time):")
+    print(sources.head(args.top).round(3).to_string(index=False))
+    print("    Per round over all sources:")
+    print(rounds.round(3).to_string())
+
+
+if __name__ == "__main__":
+    main()
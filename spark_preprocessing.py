@@ -0,0 +1,188 @@
+"""
+Computes transfer patterns with Spark instead of a single machine's process pool.
+The network is shipped once per executor as a broadcast variable. Sources are spread over partitions by their number of
+departures, heaviest first, and every partition runs onetomany_rtbtr for its sources in mapPartitionsWithIndex and writes
+one pattern store shard. Sources that fail are retried in partitions of their own, and the shards are finally merged into
+the store read by query_code.py.
+Usage (local mode): python spark_preprocessing.py --folder ./sweden --master "local[4]"
+On a cluster the output folder must be on a filesystem shared by the driver and the executors. Shards of an interrupted run
+are kept and their sources skipped when the run is restarted.
+--hubs 1000 makes the run hub based as in preprocessing_code.py. The hubs are selected on the driver and broadcast with the network.
+"""
+import argparse
+import heapq
+import os
+from time import perf_counter, strftime, time
+
+import preprocessing_code
+from pattern_store import load_store_hubs, merge_pattern_stores, open_pattern_store, pattern_edges, write_pattern_store, write_store_hubs
+
+# Per Python worker: FOLDER whose broadcast has been loaded into preprocessing_code.NETWORK. Spark reuses workers, so this
+# outlives a single partition.
+_worker_network = {}
+
+
+def _worker_load(network_bc, FOLDER):
+    '''
+    Fills preprocessing_code.NETWORK of this worker from the broadcast on first use.
+    '''
+    if FOLDER not in _worker_network:
+        network = network_bc.value
+        preprocessing_code.NETWORK.clear()
+        preprocessing_code.NETWORK.update(network, COLLECT_STATS=False)
+        _worker_network.clear()
+        _worker_network[FOLDER] = True
+
+
+def assign_partitions(source_LIST, cost_dict, NUM_PARTITIONS):
+    '''
+    Spreads sources over partitions so that every partition gets about the same total cost (longest processing time first).
+    The most expensive sources land in the first partitions, which Spark schedules first, so large hubs do not end up as the
+    tail of the job.
+    Args:
+        source_LIST (list): stop ids.
+        cost_dict (dict): estimated cost of every source. Format {SOURCE: cost}.
+        NUM_PARTITIONS (int): number of partitions.
+    Returns:
+        assignment (list): Format [(partition, SOURCE)].
+    '''
+    loads = [(0, x) for x in range(NUM_PARTITIONS)]
+    assignment = []
+    for SOURCE in sorted(source_LIST, key=lambda SOURCE: cost_dict[SOURCE], reverse=True):
+        load, x = heapq.heappop(loads)
+        assignment.append((x, SOURCE))
+        heapq.heappush(loads, (load + cost_dict[SOURCE], x))
+    return assignment
+
+
+def preprocess_partition(index, source_iter, network_bc, FOLDER, shard_prefix):
+    '''
+    mapPartitionsWithIndex function computing the transfer patterns of one partition into the shard {shard_prefix}-{index}.tpstore.
+    The shard is written through a temporary file, so a re-executed task simply replaces it.
+    Args:
+        index (int): partition index.
+        source_iter (iterator): Format (partition, SOURCE).
+        network_bc (pyspark.Broadcast): broadcast of preprocessing_code.NETWORK.
+        FOLDER (str): network folder.
+        shard_prefix (str): path prefix of the shards of this job.
+    Yields:
+        result (tuple): Format (SOURCE, error, seconds) with error None on success, otherwise the exception raised for SOURCE.
+    '''
+    _worker_load(network_bc, FOLDER)
+    results = []
+
+    def _source_edges():
+        for _, SOURCE in source_iter:
+            start = perf_counter()
+            try:
+                pattern_dag = preprocessing_code.search_source(SOURCE, list(preprocessing_code.NETWORK["routes_by_stop_dict"].keys()))
+            except Exception as error:
+                results.append((SOURCE, repr(error), perf_counter() - start))
+                continue
+            results.append((SOURCE, None, perf_counter() - start))
+            yield SOURCE, pattern_edges(pattern_dag)
+
+    write_pattern_store(f"{shard_prefix}-{index:05d}.tpstore", _source_edges())
+    yield from results
+
+
+def run_job(sc, network_bc, FOLDER, source_LIST, cost_dict, NUM_PARTITIONS, shard_prefix):
+    '''
+    Computes the transfer patterns of source_LIST as one Spark job.
+    Returns:
+        results (list): see preprocess_partition.
+    '''
+    NUM_PARTITIONS = max(1, min(NUM_PARTITIONS, len(source_LIST)))
+    assignment = assign_partitions(source_LIST, cost_dict, NUM_PARTITIONS)
+    return sc.parallelize(assignment, NUM_PARTITIONS) \
+        .partitionBy(NUM_PARTITIONS, lambda x: x) \
+        .mapPartitionsWithIndex(lambda index, source_iter: preprocess_partition(index, source_iter, network_bc, FOLDER, shard_prefix)) \
+        .collect()
+
+
+def stored_sources(shard_folder):
+    '''
+    Lists the shards of earlier jobs (removing temporary files of killed tasks) and the sources they hold.
+    Returns:
+        shard_paths (list): shard files in the order they were written.
+        done (set): stop ids.
+    '''
+    shard_paths, done = [], set()
+    for file_name in sorted(os.listdir(shard_folder)):
+        path = os.path.join(shard_folder, file_name)
+        if ".tmp" in file_name:
+            os.remove(path)
+        elif file_name.endswith(".tpstore"):
+            shard_paths.append(path)
+            done.update(open_pattern_store(path)["sources"].tolist())
+    return shard_paths, done
+
+
+def main():
+    from pyspark import SparkConf, SparkContext
+
+    parser = argparse.ArgumentParser(description="Transfer pattern preprocessing using One-To-Many rTBTR on Spark.")
+    parser.add_argument("--folder", default="./swiss", help="network folder, e.g. ./sweden or ./swiss")
+    parser.add_argument("--master", default="local[*]", help="Spark master, local[*] runs without a cluster")
+    parser.add_argument("--partitions", type=int, default=0, help="partitions of the first job, default 4 per core of the cluster")
+    parser.add_argument("--retries", type=int, default=2, help="times a failed source is retried in a partition of its own")
+    parser.add_argument("--keep-shards", action="store_true", help="keep the shards after they have been merged into the store")
+    parser.add_argument("--hubs", type=int, default=0, metavar="N", help="hub based run: select N hubs, search all other sources locally "
+                        "up to the first hub of a journey")
+    parser.add_argument("--hub-sample", type=int, default=100, help="number of sources searched on the driver to select the hubs")
+    args = parser.parse_args()
+
+    preprocessing_code.load_network(args.folder)
+    output_folder = f"./transferpattern/transfer_pattern/{args.folder}"
+    shard_folder = f"{output_folder}.shards"
+    store_path = f"{output_folder}.tpstore"
+    os.makedirs(shard_folder, exist_ok=True)
+    shard_paths, done = stored_sources(shard_folder)
+    hubs = load_store_hubs(store_path)
+    if hubs is None and args.hubs:
+        if shard_paths:
+            parser.error(f"the shards in {shard_folder} were computed without hubs, remove them for a hub based run")
+        hubs = preprocessing_code.select_hubs(args.hubs, args.hub_sample, os.cpu_count())
+        write_store_hubs(store_path, hubs)
+    if hubs is not None:
+        preprocessing_code.use_hubs(hubs)
+        print(f"    {len(hubs)} hubs from {store_path}.hubs, the other sources are searched locally")
+    network = dict(preprocessing_code.NETWORK)
+    network["output_folder"] = output_folder
+    source_LIST = [SOURCE for SOURCE in network["routes_by_stop_dict"].keys() if SOURCE not in done]
+    # Departures are what the search loops over, so they are the cost estimate used to balance partitions.
+    cost_dict = {SOURCE: network["departure_counts"].get(SOURCE, 0) + 1 for SOURCE in source_LIST}
+    print(f"    {len(source_LIST)} sources left, {len(done)} found in {len(shard_paths)} shards")
+
+    sc = SparkContext(conf=SparkConf().setMaster(args.master).setAppName("TransferPatternPreprocessing"))
+    network_bc = sc.broadcast(network)
+    NUM_PARTITIONS = args.partitions or 4 * sc.defaultParallelism
+    run_tag = strftime("%Y%m%d%H%M%S")
+    start = time()
+    failed, timings = [], []
+    for attempt in range(args.retries + 1):
+        if not source_LIST:
+            break
+        results = run_job(sc, network_bc, args.folder, source_LIST, cost_dict, NUM_PARTITIONS, f"{shard_folder}/{run_tag}-{attempt}")
+        timings.extend((seconds, SOURCE) for SOURCE, error, seconds in results if error is None)
+        failed = [(SOURCE, error) for SOURCE, error, _ in results if error is not None]
+        source_LIST = [SOURCE for SOURCE, _ in failed]
+        # Retried sources get a partition each, so one failing source cannot hold back the others.
+        NUM_PARTITIONS = len(source_LIST)
+    sc.stop()
+    print(f'    Time required: {round(time() - start)}')
+    print(f"    Slowest sources (seconds, stop id): {[(round(seconds, 1), SOURCE) for seconds, SOURCE in sorted(timings, reverse=True)[:5]]}")
+    if failed:
+        print(f"    {len(failed)} sources failed and will be retried on the next run, e.g. {failed[:5]}")
+        return
+    shard_paths, _ = stored_sources(shard_folder)
+    count = merge_pattern_stores(shard_paths, store_path)
+    print(f"    {count} sources written to {store_path}")
+    if not args.keep_shards:
+        for path in shard_paths:
+            os.remove(path)
+        os.rmdir(shard_folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Answers OD queries with Spark.
+The timetable is shipped once per executor as a broadcast variable and queries run in mapPartitions, so every Python worker
+builds the timetable index once and keeps its query graph cache between partitions. Queries are partitioned by origin and
+sorted within a partition, so all queries of a source reach the same worker together and are answered by multicriteria_batch:
+queries of an origin with the same departure time share one search.
+Usage (local mode): python spark_query.py --folder ./sweden --od sweden_randomOD.csv --master "local[4]"
+"""
+import argparse
+from itertools import groupby
+from time import time
+
+from query_func import build_timetable_index, multicriteria_batch
+
+# Per Python worker: FOLDER -> (footpath_dict, timetable_index). Spark reuses workers, so this outlives a single partition.
+_worker_network = {}
+
+
+def _worker_index(network_bc, FOLDER):
+    '''
+    Returns the footpath dict and the timetable index of this worker, building the index from the broadcast on first use.
+    '''
+    try:
+        return _worker_network[FOLDER]
+    except KeyError:
+        network = network_bc.value
+        _worker_network[FOLDER] = (network["footpath_dict"], build_timetable_index(network["stoptimes_dict"], network["routesindx_by_stop_dict"]))
+        return _worker_network[FOLDER]
+
+
+def query_partition(od_iter, network_bc, FOLDER, GOAL_DIRECTED):
+    '''
+    mapPartitions function answering the queries of one partition, one origin at a time.
+    Args:
+        od_iter (iterator): Format (SOURCE, (D_TIME, DESTINATION)), the queries of an origin one after the other.
+        network_bc (pyspark.Broadcast): broadcast of the dict returned by prepare_query_network.
+        FOLDER (str): network folder.
+        GOAL_DIRECTED (int): see multicriteria_dij.
+    Yields:
+        result (tuple): Format (SOURCE, D_TIME, DESTINATION, output of multicriteria_dij).
+    '''
+    footpath_dict, timetable_index = _worker_index(network_bc, FOLDER)
+    for SOURCE, od_group in groupby(od_iter, key=lambda od: od[0]):
+        query_list = [(SOURCE, D_TIME, DESTINATION) for _, (D_TIME, DESTINATION) in od_group]
+        for (_, D_TIME, DESTINATION), output in zip(query_list, multicriteria_batch(query_list, footpath_dict, FOLDER, timetable_index, GOAL_DIRECTED)):
+            yield SOURCE, D_TIME, DESTINATION, output
+
+
+def plan_queries(od_rdd, network_bc, FOLDER, NUM_PARTITIONS, GOAL_DIRECTED):
+    '''
+    Partitions an RDD of (SOURCE, D_TIME, DESTINATION) by origin and answers it with query_partition.
+    Only the broadcast handle and plain values are captured by the task closures.
+    Returns:
+        result_rdd (pyspark.RDD): see query_partition.
+    '''
+    return od_rdd.map(lambda od: (od[0], (od[1], od[2]))) \
+        .repartitionAndSortWithinPartitions(NUM_PARTITIONS) \
+        .mapPartitions(lambda od_iter: query_partition(od_iter, network_bc, FOLDER, GOAL_DIRECTED))
+
+
+def query_stream(ssc, od_list, network_bc, FOLDER, BATCH_SIZE, NUM_PARTITIONS, GOAL_DIRECTED):
+    '''
+    Streams OD pairs through Spark Streaming in micro-batches of BATCH_SIZE queries.
+    Args:
+        ssc (pyspark.streaming.StreamingContext): streaming context.
+        od_list (list): Format [(SOURCE, D_TIME, DESTINATION)].
+        network_bc (pyspark.Broadcast): broadcast of the dict returned by prepare_query_network.
+        FOLDER (str): network folder.
+        BATCH_SIZE (int): OD pairs per micro-batch.
+        NUM_PARTITIONS (int): partitions per micro-batch.
+        GOAL_DIRECTED (int): see multicriteria_dij.
+    Returns:
+        result_stream (pyspark.streaming.DStream): see query_partition.
+    '''
+    sc = ssc.sparkContext
+    batches = [sc.parallelize(od_list[x: x + BATCH_SIZE]) for x in range(0, len(od_list), BATCH_SIZE)]
+    return ssc.queueStream(batches).transform(lambda od_rdd: plan_queries(od_rdd, network_bc, FOLDER, NUM_PARTITIONS, GOAL_DIRECTED))
+
+
+def query_batch(sc, od_list, network_bc, FOLDER, NUM_PARTITIONS, GOAL_DIRECTED):
+    '''
+    Answers all OD pairs as one Spark job.
+    Returns:
+        results (list): see query_partition.
+    '''
+    return plan_queries(sc.parallelize(od_list), network_bc, FOLDER, NUM_PARTITIONS, GOAL_DIRECTED).collect()
+
+
+def main():
+    import pandas as pd
+    from pyspark import SparkContext
+    from network_snapshot import load_query_network
+
+    parser = argparse.ArgumentParser(description="Answer OD queries on transfer patterns with Spark.")
+    parser.add_argument("--folder", default="./sweden", help="network folder, e.g. ./sweden or ./swiss")
+    parser.add_argument("--od", default="sweden_randomOD.csv", help="csv file with SOURCE and DESTINATION columns")
+    parser.add_argument("--departure", default="2019-11-06 00:20:00", help="departure time of every query")
+    parser.add_argument("--master", default="local[*]", help="Spark master, local[*] runs without a cluster")
+    parser.add_argument("--partitions", type=int, default=4, help="partitions per batch")
+    parser.add_argument("--goal-directed", type=int, default=1, help="1 to use goal directed pruning")
+    args = parser.parse_args()
+
+    query_network = load_query_network(args.folder)
+    D_TIME = int((pd.to_datetime(args.departure) - query_network["day_start"]).total_seconds())
+    od_list = [(int(SOURCE), D_TIME, int(DESTINATION)) for SOURCE, DESTINATION in pd.read_csv(args.od)[["SOURCE", "DESTINATION"]].itertuples(index=False)]
+
+    sc = SparkContext(master=args.master, appName="TransferPatternQueries")
+    network_bc = sc.broadcast(query_network)
+    start = time()
+    results = query_batch(sc, od_list, network_bc, args.folder, args.partitions, args.goal_directed)
+    print(f"    {len(results)} queries answered in {round(time() - start, 2)} s")
+    for SOURCE, D_TIME, DESTINATION, output in results[:10]:
+        print(f"    {SOURCE} -> {DESTINATION}: {output}")
+    sc.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Checks the queries on a hub based pattern store (local patterns stitched to the global patterns of the hubs) against a store with
+full patterns from every source, on synthetic benchmark networks. Stitching can miss an optimal journey (see the README), so the hub
+based answers are only required to be real journeys, never earlier than the earliest arrival the timetable allows, and to cover at
+least MIN_COVERAGE of the optimal labels of the full patterns.
+Run from the repository root: python -m pytest tests
+"""
+import os
+import random
+from bisect import bisect_left
+from heapq import heappop, heappush
+
+import numpy as np
+import pytest
+
+import pattern_store
+import query_func
+from benchmark.synthetic_network import synthetic_network
+from function_file import INF_TIME, encode_network, initialize_from_desti_onemany, local_trip_transfers, onetomany_rtbtr, route_timetable, trip_transfer_table
+from pattern_store import pattern_edges, write_pattern_store, write_store_hubs
+from query_func import _format_arrivals, _label_search, build_query_graph, build_timetable_index, multicriteria_dij, pareto_onetomany, prepare_query_network
+from transfer_generation import generate_trip_transfers
+
+MAX_TRANSFER = 4
+NUM_HUBS = 30
+MIN_COVERAGE = 0.95
+
+
+@pytest.fixture(scope="module", params=[2, 5, 8], ids=lambda seed: f"seed{seed}")
+def stores(request, tmp_path_factory):
+    '''
+    Writes the store "full" with the patterns of full searches from every source and the store "hub" with global patterns for
+    the NUM_HUBS stops served by most routes and local patterns for all other sources.
+    Returns:
+        stores (dict): keys "path" (directory laid out like the one build_query_graph reads), "hubs", "stops", "footpath_dict",
+            "timetable_index" and "query_network" of the query network.
+    '''
+    stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict, _ = synthetic_network(300, seed=request.param)
+    trip_transfer_dict, _ = generate_trip_transfers(stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict, 2)
+    encoded_stoptimes_dict, encoded_footpath_dict, trip_transfer_dict, departures_dict, trip_route_idx, route_trip_offset, _ = \
+        encode_network(stoptimes_dict, footpath_dict, trip_transfer_dict)
+    stop_LIST = list(routes_by_stop_dict.keys())
+    L = initialize_from_desti_onemany(routes_by_stop_dict, stops_dict, stop_LIST, encoded_footpath_dict, idx_by_route_stop_dict)
+    route_times = route_timetable(encoded_stoptimes_dict)
+    trip_transfers = trip_transfer_table(trip_transfer_dict, trip_route_idx, stops_dict)
+    hubs = frozenset(sorted(stop_LIST, key=lambda stop: len(routes_by_stop_dict[stop]), reverse=True)[:NUM_HUBS])
+    hub_trip_transfers = local_trip_transfers(trip_transfers, trip_route_idx, stops_dict, hubs)
+    path = tmp_path_factory.mktemp("stores")
+    os.makedirs(path / "gdrive/MyDrive/transfer_pattern")
+    for FOLDER in ("full", "hub"):
+        source_edges = []
+        for SOURCE in sorted(stop_LIST):
+            transfers = hub_trip_transfers if FOLDER == "hub" and SOURCE not in hubs else trip_transfers
+            pattern_dag = onetomany_rtbtr(SOURCE, list(stop_LIST), departures_dict, MAX_TRANSFER, 0, 0, 1, routes_by_stop_dict, stops_dict,
+                                          encoded_stoptimes_dict, encoded_footpath_dict, idx_by_route_stop_dict, transfers, trip_route_idx,
+                                          route_trip_offset, L, route_times)
+            source_edges.append((SOURCE, pattern_edges(pattern_dag)))
+        write_pattern_store(f"{path}/gdrive/MyDrive/transfer_pattern/{FOLDER}.tpstore", source_edges)
+    write_store_hubs(f"{path}/gdrive/MyDrive/transfer_pattern/hub.tpstore", hubs)
+    query_network = prepare_query_network(stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict)
+    return {"path": path, "hubs": hubs, "stops": sorted(stop_LIST), "footpath_dict": query_network["footpath_dict"],
+            "timetable_index": build_timetable_index(query_network["stoptimes_dict"], query_network["routesindx_by_stop_dict"]),
+            "query_network": query_network}
+
+
+@pytest.fixture
+def queries(stores, monkeypatch):
+    '''
+    Runs in the directory of the stores with empty per-process caches.
+    Returns:
+        queries (list): Format [(SOURCE, D_TIME)] with sources that are not hubs.
+    '''
+    monkeypatch.chdir(stores["path"])
+    for cache in (query_func._query_graph_cache, query_func._footpath_edges, pattern_store._open_stores, pattern_store._open_hubs):
+        cache.clear()
+    rnd = random.Random(1)
+    return [(SOURCE, rnd.randint(5 * 3600, 10 * 3600)) for SOURCE in rnd.sample([stop for stop in stores["stops"] if stop not in stores["hubs"]], 12)]
+
+
+def earliest_arrivals(SOURCE, D_TIME, query_network):
+    '''
+    Earliest arrival at every stop with any number of trips and footpaths and no transfer time (time dependent Dijkstra on the
+    timetable), a lower bound on the arrival of every journey the queries can return.
+    Returns:
+        arrivals (dict): Format {stop_id: arrival seconds}.
+    '''
+    stoptimes_dict, footpath_dict = query_network["stoptimes_dict"], query_network["footpath_dict"]
+    arrivals, heap = {SOURCE: D_TIME}, [(D_TIME, SOURCE)]
+    while heap:
+        time, stop = heappop(heap)
+        if time > arrivals[stop]:
+            continue
+        reached = list(footpath_dict.get(stop, ()))
+        for route, stop_idx in query_network["routesindx_by_stop_dict"].get(stop, []):
+            trips = stoptimes_dict[route]
+            tid = bisect_left([trip[stop_idx][1] for trip in trips], time)
+            if tid < len(trips):
+                reached.extend((to_stop, arrival - time) for to_stop, arrival in trips[tid][stop_idx + 1:])
+        for to_stop, duration in reached:
+            if time + duration < arrivals.get(to_stop, time + duration + 1):
+                arrivals[to_stop] = time + duration
+                heappush(heap, (time + duration, to_stop))
+    return arrivals
+
+
+def check_labels(full_pareto, hub_pareto, earliest, query):
+    '''
+    Asserts that no hub based label arrives before earliest, the arrival at the destination given by earliest_arrivals.
+    The stitched journeys may take up to twice MAX_TRANSFER + 1 trips, the journeys of the full patterns are compared within the limit.
+    Returns:
+        covered (int): Pareto optimal labels of the full patterns within the limit that are matched or beaten by a hub based label.
+        total (int): Pareto optimal labels of the full patterns within the limit.
+    '''
+    assert all(hub_time >= earliest for hub_time, _ in hub_pareto), query
+    covered = total = 0
+    for time, trips in full_pareto:
+        if trips <= MAX_TRANSFER + 1:
+            total += 1
+            covered += any(hub_time <= time and hub_trips <= trips for hub_time, hub_trips in hub_pareto)
+    return covered, total
+
+
+def test_hub_patterns_cover_full_patterns(stores, queries):
+    covered = total = 0
+    for SOURCE, D_TIME in queries:
+        earliest = earliest_arrivals(SOURCE, D_TIME, stores["query_network"])
+        full_list, hub_list = (pareto_onetomany(SOURCE, D_TIME, stores["stops"], stores["footpath_dict"], FOLDER, stores["timetable_index"])
+                               for FOLDER in ("full", "hub"))
+        for DESTINATION, full_pareto, hub_pareto in zip(stores["stops"], full_list, hub_list):
+            assert all(time >= earliest.get(DESTINATION, INF_TIME) for time, _ in full_pareto), (SOURCE, D_TIME, DESTINATION)
+            counts = check_labels(full_pareto, hub_pareto, earliest.get(DESTINATION, INF_TIME), (SOURCE, D_TIME, DESTINATION))
+            covered, total = covered + counts[0], total + counts[1]
+    assert total and covered >= MIN_COVERAGE * total, (covered, total)
+
+
+def test_destination_graph_covers_full_patterns(stores, queries):
+    footpath_dict, timetable_index = stores["footpath_dict"], stores["timetable_index"]
+    covered = total = 0
+    for SOURCE, D_TIME in queries:
+        earliest = earliest_arrivals(SOURCE, D_TIME, stores["query_network"])
+        full_list = pareto_onetomany(SOURCE, D_TIME, stores["stops"], footpath_dict, "full", timetable_index)
+        for DESTINATION, full_pareto in list(zip(stores["stops"], full_list))[::3]:
+            adjacency = build_query_graph(SOURCE, "hub", DESTINATION, footpath_dict)
+            bags = _label_search(adjacency, SOURCE, D_TIME, DESTINATION, footpath_dict, timetable_index, dict.fromkeys(adjacency, (0, 0))) \
+                if SOURCE in adjacency else {}
+            hub_pareto = list(zip(*bags[DESTINATION])) if DESTINATION in bags else []
+            counts = check_labels(full_pareto, hub_pareto, earliest.get(DESTINATION, INF_TIME), (SOURCE, D_TIME, DESTINATION))
+            covered, total = covered + counts[0], total + counts[1]
+            for GOAL_DIRECTED in (0, 1):
+                assert multicriteria_dij(SOURCE, D_TIME, DESTINATION, footpath_dict, "hub", timetable_index, GOAL_DIRECTED) \
+                    == _format_arrivals([time for time, _ in hub_pareto]), (SOURCE, D_TIME, DESTINATION)
+    assert total and covered >= MIN_COVERAGE * total, (covered, total)
+
+
+def test_destination_graph_is_part_of_whole_graph(stores, queries):
+    for SOURCE, _ in queries:
+        adjacency = build_query_graph(SOURCE, "hub")
+        for DESTINATION in stores["stops"][::10]:
+            destination_adjacency = build_query_graph(SOURCE, "hub", DESTINATION, stores["footpath_dict"])
+            assert all(set(successors) <= set(adjacency[stop]) for stop, successors in destination_adjacency.items())
+            assert len(destination_adjacency) <= len(adjacency)
+
+
+def test_edges_toward_keeps_paths_to_targets():
+    # Stop ids far apart, like those of a large network.
+    edges = np.array([[7, 10 ** 9], [10 ** 9, 5], [7, 3], [3, 8], [8, 2 ** 31 - 2]], dtype=np.int32)
+    assert query_func.edges_toward(edges, [5]).tolist() == [[7, 10 ** 9], [10 ** 9, 5]]
+    assert query_func.edges_toward(edges, [5, 2 ** 31 - 2]).tolist() == edges.tolist()
+    assert query_func.edges_toward(edges, [4]).tolist() == []
+    # 4 is a walk away from 8, the end of 3 -> 8.
+    footpath_edges = np.array([[1, 4], [8, 4], [8, 9]], dtype=np.int64)
+    assert query_func.edges_toward(edges, [4], footpath_edges).tolist() == [[7, 3], [3, 8]]
@@ -0,0 +1,69 @@
+"""
+Checks which sources an incremental preprocessing run recomputes after a timetable update, on the synthetic benchmark network.
+Run from the repository root: python -m pytest tests
+"""
+import copy
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("miscellaneous_func")   # imported by preprocessing_code
+
+import preprocessing_code
+from benchmark.synthetic_network import synthetic_network
+from network_snapshot import snapshot_path
+from pattern_store import write_pattern_store
+from test_network_snapshot import write_snapshot
+
+FOLDER = "synthetic"
+
+
+@pytest.fixture
+def network(tmp_path, monkeypatch):
+    '''
+    Runs in an empty directory with the snapshot of the synthetic network compiled for FOLDER and an empty NETWORK.
+    '''
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(preprocessing_code, "NETWORK", {})
+    os.makedirs(os.path.dirname(snapshot_path(FOLDER)))
+    network = synthetic_network(200, seed=3)
+    write_snapshot(snapshot_path(FOLDER), network)
+    return network
+
+
+def test_pending_sources_skips_only_pattern_files(network, tmp_path):
+    preprocessing_code.load_network(FOLDER)
+    SOURCE_LIST = sorted(network[3])
+    for file_name in (f"{SOURCE_LIST[0]}", f"{SOURCE_LIST[0]}.stats.json", f"{SOURCE_LIST[1]}.stats.json",
+                      f"{SOURCE_LIST[2]}.w0-3600", f"{SOURCE_LIST[2]}.w0-3600.stats.json", f"{SOURCE_LIST[3]}.tmp123"):
+        open(f"{tmp_path}/{file_name}", "w").close()
+    source_LIST = preprocessing_code.pending_sources(str(tmp_path))
+    assert sorted(source_LIST) == SOURCE_LIST[1:]
+    assert not os.path.exists(f"{tmp_path}/{SOURCE_LIST[3]}.tmp123")
+
+
+def test_changed_route_recomputes_affected_sources(network, tmp_path):
+    stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict, trip_transfer_dict = network
+    os.replace(snapshot_path(FOLDER), f"{tmp_path}/previous")
+    route = sorted(stoptimes_dict)[5]
+    new_stoptimes_dict = copy.deepcopy(stoptimes_dict)
+    new_stoptimes_dict[route][-1] = [(stop, arrival + pd.Timedelta(minutes=2)) for stop, arrival in new_stoptimes_dict[route][-1]]
+    write_snapshot(snapshot_path(FOLDER), (stops_dict, new_stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict, trip_transfer_dict))
+    preprocessing_code.load_network(FOLDER)
+    # The store misses one source and still holds one that is no longer in the network.
+    missing = next(SOURCE for SOURCE in sorted(routes_by_stop_dict) if SOURCE not in stops_dict[route])
+    removed = max(routes_by_stop_dict) + 1
+    stored_sources = sorted(set(routes_by_stop_dict) - {missing} | {removed})
+    write_pattern_store(f"{tmp_path}/store.tpstore", [(SOURCE, np.empty((0, 2), dtype=np.int32)) for SOURCE in stored_sources])
+
+    full_LIST, source_LIST, removed_sources = preprocessing_code.incremental_plan(FOLDER, f"{tmp_path}/previous", f"{tmp_path}/store.tpstore")
+    assert sorted(full_LIST) == sorted(set(stops_dict[route]) | {missing})
+    assert sorted(source_LIST) == sorted(set(routes_by_stop_dict) - set(full_LIST))
+    assert removed_sources == [removed]
+    net = preprocessing_code.NETWORK
+    assert net["changed_stops"] == set(stops_dict[route])
+    stops = stops_dict[route]
+    assert net["retimed_pairs"] == {(from_stop, to_stop) for x, from_stop in enumerate(stops) for to_stop in stops[x + 1:]}
+    assert net["changed_pairs"] == net["retimed_pairs"]
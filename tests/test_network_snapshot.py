@@ -0,0 +1,103 @@
+"""
+Checks that a network snapshot reads back as the network it was written from, and what diff_network_snapshots reports, on the
+synthetic benchmark network.
+Run from the repository root: python -m pytest tests
+"""
+import copy
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmark.synthetic_network import synthetic_network
+from function_file import encode_network, initialize_from_desti_onemany, route_timetable, trip_transfer_table
+from network_snapshot import (diff_network_snapshots, load_query_network, open_network_snapshot, snapshot_path, snapshot_search_arrays,
+                              snapshot_to_network, write_network_snapshot)
+from query_func import prepare_query_network
+
+
+def write_snapshot(path, network):
+    '''
+    Encodes a network as returned by synthetic_network and writes its snapshot.
+    Returns:
+        encoded (tuple): output of encode_network.
+    '''
+    stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, _, trip_transfer_dict = network
+    encoded = encode_network(stoptimes_dict, footpath_dict, trip_transfer_dict)
+    write_network_snapshot(path, stops_dict, encoded[0], encoded[1], routes_by_stop_dict, encoded[2], encoded[6])
+    return encoded
+
+
+@pytest.fixture(scope="module")
+def network():
+    return synthetic_network(200, seed=3)
+
+
+def test_snapshot_reads_back_network(network, tmp_path):
+    stops_dict, _, _, routes_by_stop_dict, idx_by_route_stop_dict, _ = network
+    encoded_stoptimes_dict, encoded_footpath_dict, trip_transfer_dict, departures_dict, trip_route_idx, route_trip_offset, day_start = \
+        write_snapshot(f"{tmp_path}/snapshot", network)
+    snapshot = open_network_snapshot(f"{tmp_path}/snapshot")
+    (snapshot_stops_dict, snapshot_stoptimes_dict, snapshot_footpath_dict, snapshot_routes_by_stop_dict, snapshot_idx_by_route_stop_dict,
+     trip_transfers, snapshot_departures_dict, snapshot_trip_route_idx, snapshot_route_trip_offset, snapshot_day_start) = snapshot_to_network(snapshot)
+    assert dict(snapshot_stops_dict) == stops_dict
+    assert {route: [list(map(tuple, trip)) for trip in trips] for route, trips in snapshot_stoptimes_dict.items()} == encoded_stoptimes_dict
+    assert dict(snapshot_footpath_dict) == encoded_footpath_dict
+    assert list(snapshot_routes_by_stop_dict.items()) == list(routes_by_stop_dict.items())
+    assert dict(snapshot_idx_by_route_stop_dict) == idx_by_route_stop_dict
+    assert dict(snapshot_departures_dict) == departures_dict
+    assert list(snapshot_trip_route_idx) == trip_route_idx and snapshot_route_trip_offset == route_trip_offset
+    assert snapshot_day_start == day_start
+    expected_transfers = trip_transfer_table(trip_transfer_dict, trip_route_idx, stops_dict)
+    assert all(np.array_equal(trip_transfers[name], expected_transfers[name]) for name in expected_transfers)
+
+    L, route_times, departure_counts = snapshot_search_arrays(snapshot)
+    expected_L = initialize_from_desti_onemany(routes_by_stop_dict, stops_dict, list(routes_by_stop_dict), encoded_footpath_dict, idx_by_route_stop_dict)
+    assert L.keys() == expected_L.keys()
+    assert all(np.array_equal(column, expected_column) for route in L for column, expected_column in zip(L[route], expected_L[route]))
+    expected_route_times = route_timetable(encoded_stoptimes_dict)
+    assert route_times.keys() == expected_route_times.keys()
+    assert all(np.array_equal(route_times[route], expected_route_times[route]) for route in route_times)
+    assert departure_counts == {stop: len(departures) for stop, departures in departures_dict.items()}
+
+
+def test_query_network_matches_read_network(network, tmp_path, monkeypatch):
+    stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, _, _ = network
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.dirname(snapshot_path("synthetic")))
+    write_snapshot(snapshot_path("synthetic"), network)
+    query_network = load_query_network("synthetic")
+    expected = prepare_query_network(stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict)
+    assert {route: [list(map(tuple, trip)) for trip in trips] for route, trips in query_network["stoptimes_dict"].items()} == expected["stoptimes_dict"]
+    assert dict(query_network["footpath_dict"]) == expected["footpath_dict"]
+    assert dict(query_network["routesindx_by_stop_dict"]) == expected["routesindx_by_stop_dict"]
+    assert query_network["day_start"] == expected["day_start"]
+
+
+def test_diff_unchanged_network(network, tmp_path):
+    write_snapshot(f"{tmp_path}/old", network)
+    write_snapshot(f"{tmp_path}/new", network)
+    assert diff_network_snapshots(open_network_snapshot(f"{tmp_path}/old"), open_network_snapshot(f"{tmp_path}/new")) == ({}, set(), set())
+
+
+def test_diff_flags_retimed_route(network, tmp_path):
+    stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict, trip_transfer_dict = network
+    write_snapshot(f"{tmp_path}/old", network)
+    route = sorted(stoptimes_dict)[5]
+    new_stoptimes_dict = copy.deepcopy(stoptimes_dict)
+    new_stoptimes_dict[route][-1] = [(stop, arrival + pd.Timedelta(minutes=2)) for stop, arrival in new_stoptimes_dict[route][-1]]
+    write_snapshot(f"{tmp_path}/new", (stops_dict, new_stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict, trip_transfer_dict))
+    changed_routes, retimed_routes, changed_footpaths = diff_network_snapshots(open_network_snapshot(f"{tmp_path}/old"), open_network_snapshot(f"{tmp_path}/new"))
+    assert changed_routes == {route: stops_dict[route]}
+    assert retimed_routes == {route} and changed_footpaths == set()
+
+
+def test_diff_flags_changed_footpath(network, tmp_path):
+    stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict, trip_transfer_dict = network
+    write_snapshot(f"{tmp_path}/old", network)
+    from_stop = sorted(footpath_dict)[0]
+    (to_stop, walk), *others = footpath_dict[from_stop]
+    new_footpath_dict = {**footpath_dict, from_stop: [(to_stop, walk + pd.Timedelta(seconds=30))] + others}
+    write_snapshot(f"{tmp_path}/new", (stops_dict, stoptimes_dict, new_footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict, trip_transfer_dict))
+    assert diff_network_snapshots(open_network_snapshot(f"{tmp_path}/old"), open_network_snapshot(f"{tmp_path}/new")) == ({}, set(), {(from_stop, to_stop)})
@@ -0,0 +1,106 @@
+"""
+Checks the earliest arrivals onetomany_rtbtr finds for every number of trips against a round by round reference search on the
+synthetic benchmark network.
+Run from the repository root: python -m pytest tests
+"""
+import random
+from bisect import bisect_left
+
+import pytest
+
+import function_file
+from benchmark.synthetic_network import synthetic_network
+from function_file import INF_TIME, encode_network, initialize_from_desti_onemany, onetomany_rtbtr, route_timetable, trip_transfer_table
+from test_transfer_generation import close_footpaths
+from transfer_generation import generate_trip_transfers
+
+MAX_TRANSFER = 4
+
+
+def reference_labels(SOURCE, d_time, network):
+    '''
+    Earliest arrivals of the journeys boarding their first trip at SOURCE at d_time or later, computed round by round on the
+    timetable alone (like RAPTOR). Every trip may be followed by one footpath, as in the trip transfers and the last legs of L.
+    Returns:
+        labels (list): earliest arrival with at most n trips at labels[n]. Format {stop_id: arrival seconds}.
+    '''
+    stoptimes_dict, footpath_dict = network["stoptimes_dict"], network["footpath_dict"]
+    labels, best, reached = [{}], {}, {SOURCE: d_time}
+    for _ in range(MAX_TRANSFER):
+        arrivals = {}
+        for from_stop, from_time in reached.items():
+            for route in network["routes_by_stop_dict"].get(from_stop, []):
+                stop_idx = network["idx_by_route_stop_dict"][(route, from_stop)]
+                tid = bisect_left([trip[stop_idx][1] for trip in stoptimes_dict[route]], from_time)
+                if tid < len(stoptimes_dict[route]):
+                    for stop, arrival in stoptimes_dict[route][tid][stop_idx + 1:]:
+                        arrivals[stop] = min(arrivals.get(stop, INF_TIME), arrival)
+        reached = dict(arrivals)
+        for stop, arrival in arrivals.items():
+            for to_stop, walk in footpath_dict.get(stop, []):
+                reached[to_stop] = min(reached.get(to_stop, INF_TIME), arrival + walk)
+        for stop, arrival in reached.items():
+            best[stop] = min(best.get(stop, INF_TIME), arrival)
+        labels.append(dict(best))
+    return labels
+
+
+def rtbtr_labels(SOURCE, network, monkeypatch, d_time_window=None):
+    '''
+    Runs onetomany_rtbtr and reads its destination labels after the last (earliest) departure swept.
+    Returns:
+        labels (list): see reference_labels, without SOURCE.
+    '''
+    captured = {}
+    initialize = function_file.initialize_onemany
+
+    def capture(*args):
+        captured["J"], inf_time = initialize(*args)
+        return captured["J"], inf_time
+
+    monkeypatch.setattr(function_file, "initialize_onemany", capture)
+    onetomany_rtbtr(SOURCE, list(network["routes_by_stop_dict"]), network["departures_dict"], MAX_TRANSFER, 0, 0, 1,
+                    network["routes_by_stop_dict"], network["stops_dict"], network["stoptimes_dict"], network["footpath_dict"],
+                    network["idx_by_route_stop_dict"], network["trip_transfers"], network["trip_route_idx"], network["route_trip_offset"],
+                    network["L"], network["route_times"], d_time_window=d_time_window)
+    J = captured["J"]
+    return [{}] + [{desti: J[desti][n][0] for desti in J if J[desti][n][0] < INF_TIME} for n in range(1, MAX_TRANSFER + 1)]
+
+
+@pytest.fixture(scope="module", params=[(300, 2), (400, 1), (400, 5)], ids=lambda param: f"{param[0]}stops-seed{param[1]}")
+def network(request):
+    '''
+    Synthetic network with closed footpaths and all its trip transfers (without the reduction), encoded as by encode_network.
+    '''
+    num_stops, seed = request.param
+    stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict, _ = synthetic_network(num_stops, seed=seed)
+    footpath_dict = close_footpaths(footpath_dict)
+    trip_transfer_dict, _ = generate_trip_transfers(stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict, 2, False)
+    encoded_stoptimes_dict, encoded_footpath_dict, trip_transfer_dict, departures_dict, trip_route_idx, route_trip_offset, _ = \
+        encode_network(stoptimes_dict, footpath_dict, trip_transfer_dict)
+    network = {"stops_dict": stops_dict, "stoptimes_dict": encoded_stoptimes_dict, "footpath_dict": encoded_footpath_dict,
+               "routes_by_stop_dict": routes_by_stop_dict, "idx_by_route_stop_dict": idx_by_route_stop_dict, "departures_dict": departures_dict,
+               "trip_route_idx": trip_route_idx, "route_trip_offset": route_trip_offset,
+               "trip_transfers": trip_transfer_table(trip_transfer_dict, trip_route_idx, stops_dict),
+               "L": initialize_from_desti_onemany(routes_by_stop_dict, stops_dict, list(routes_by_stop_dict), encoded_footpath_dict, idx_by_route_stop_dict),
+               "route_times": route_timetable(encoded_stoptimes_dict)}
+    rnd = random.Random(seed)
+    network["sources"] = rnd.sample(sorted(departures_dict), 25)
+    return network
+
+
+def test_sweep_matches_reference(network, monkeypatch):
+    for SOURCE in network["sources"]:
+        d_time = min(d_time for _, d_time, _ in network["departures_dict"][SOURCE])
+        reference = reference_labels(SOURCE, d_time, network)
+        reference = [{stop: arrival for stop, arrival in labels.items() if stop != SOURCE} for labels in reference]
+        assert rtbtr_labels(SOURCE, network, monkeypatch) == reference, (SOURCE, d_time)
+
+
+def test_window_matches_reference(network, monkeypatch):
+    rnd = random.Random(0)
+    for SOURCE in network["sources"]:
+        d_time = rnd.choice([d_time for _, d_time, _ in network["departures_dict"][SOURCE]])
+        reference = reference_labels(SOURCE, d_time, network)
+        reference = [{stop: arrival for stop, arrival in labels.items() if stop != SOURCE} for labels in reference]
+        assert rtbtr_labels(SOURCE, network, monkeypatch, (d_time, d_time + 1)) == reference, (SOURCE, d_time)
@@ -0,0 +1,110 @@
+"""
+Checks the binary transfer pattern store of pattern_store.py: writing, mapping, updating and merging stores.
+Run from the repository root: python -m pytest tests
+"""
+import os
+import random
+
+import numpy as np
+import pytest
+
+from pattern_store import (HEADER_BYTES, STORE_MAGIC, build_pattern_dag, dag_patterns, get_pattern_edges, load_pattern_file,
+                           merge_pattern_stores, open_pattern_store, pattern_edges, update_pattern_store, write_pattern_store)
+
+
+def random_edges(SOURCE, rnd):
+    '''
+    Returns:
+        edges (numpy.ndarray): pattern_edges of a few random transfer patterns of SOURCE.
+    '''
+    TP_list = [[SOURCE] + rnd.sample(range(1000), rnd.randint(1, 5)) for _ in range(rnd.randint(1, 20))]
+    return pattern_edges(build_pattern_dag(SOURCE, TP_list))
+
+
+def read_store(store):
+    '''
+    Returns:
+        source_edges (dict): Format {SOURCE: [(from stop, to stop)]}.
+    '''
+    return {SOURCE: get_pattern_edges(store, SOURCE).tolist() for SOURCE in store["sources"].tolist()}
+
+
+@pytest.fixture
+def source_edges():
+    rnd = random.Random(0)
+    return {SOURCE: random_edges(SOURCE, rnd) for SOURCE in rnd.sample(range(1000), 30)}
+
+
+def test_round_trip(tmp_path, source_edges):
+    path = f"{tmp_path}/store.tpstore"
+    write_pattern_store(path, source_edges.items())     # not sorted by source
+    with open(path, "rb") as fp:
+        header = fp.read(HEADER_BYTES)
+    num_sources, index_offset = np.frombuffer(header, dtype=np.int64, offset=8).tolist()
+    assert header[:8] == STORE_MAGIC and num_sources == len(source_edges)
+    assert index_offset == HEADER_BYTES + 8 * sum(len(edges) for edges in source_edges.values())
+    store = open_pattern_store(path)
+    assert store["edges"].dtype == np.int32 and store["sources"].dtype == np.int64
+    assert store["sources"].tolist() == sorted(source_edges)
+    assert read_store(store) == {SOURCE: edges.tolist() for SOURCE, edges in source_edges.items()}
+    with pytest.raises(KeyError):
+        get_pattern_edges(store, 1000)
+
+
+def test_empty_store(tmp_path):
+    path = f"{tmp_path}/store.tpstore"
+    write_pattern_store(path, [(5, np.empty((0, 2), dtype=np.int32))])
+    assert get_pattern_edges(open_pattern_store(path), 5).shape == (0, 2)
+    write_pattern_store(path, [])
+    assert len(open_pattern_store(path)["sources"]) == 0
+
+
+def test_streamed_pattern_file(tmp_path):
+    rnd = random.Random(1)
+    TP_list = [[7] + rnd.sample(range(50), rnd.randint(1, 4)) for _ in range(300)]
+    path = f"{tmp_path}/7"
+    build_pattern_dag(7, TP_list, path)
+    pattern_dag = load_pattern_file(path, 7)
+    assert sorted(dag_patterns(pattern_dag)) == sorted(map(list, {tuple(pattern) for pattern in TP_list}))
+    assert pattern_edges(pattern_dag).tolist() == pattern_edges(build_pattern_dag(7, TP_list)).tolist()
+
+
+def test_update_replaces_adds_and_removes_sources(tmp_path, source_edges):
+    path = f"{tmp_path}/store.tpstore"
+    write_pattern_store(path, sorted(source_edges.items()))
+    old_store = open_pattern_store(path)
+    replaced, removed = sorted(source_edges)[3], sorted(source_edges)[10]
+    added = next(SOURCE for SOURCE in range(1000) if SOURCE not in source_edges)
+    new_edges = {replaced: np.array([[replaced, 1], [1, 2]], dtype=np.int32), added: np.array([[added, 3]], dtype=np.int32)}
+    update_pattern_store(path, sorted(new_edges.items()), removed_sources=[removed])
+    expected = {SOURCE: edges.tolist() for SOURCE, edges in {**source_edges, **new_edges}.items() if SOURCE != removed}
+    store = open_pattern_store(path)
+    assert store is not old_store
+    assert read_store(store) == expected
+
+
+def test_reopens_rewritten_store(tmp_path, source_edges):
+    path = f"{tmp_path}/store.tpstore"
+    write_pattern_store(path, source_edges.items())
+    assert open_pattern_store(path) is open_pattern_store(path)
+    write_pattern_store(path, [(1, np.array([[1, 2]], dtype=np.int32))])
+    assert read_store(open_pattern_store(path)) == {1: [[1, 2]]}
+    # Replaced by another process, which leaves the cache of this one as it was.
+    write_pattern_store(f"{tmp_path}/other.tpstore", [(3, np.array([[3, 4]], dtype=np.int32))])
+    os.replace(f"{tmp_path}/other.tpstore", path)
+    assert read_store(open_pattern_store(path)) == {3: [[3, 4]]}
+
+
+def test_merge_takes_last_shard(tmp_path, source_edges):
+    SOURCE_LIST = sorted(source_edges)
+    shard_paths = [f"{tmp_path}/shard{x}.tpstore" for x in range(3)]
+    for x, shard_path in enumerate(shard_paths):
+        write_pattern_store(shard_path, [(SOURCE, source_edges[SOURCE]) for SOURCE in SOURCE_LIST[x::3]])
+    # The last shard also holds a newer version of a source of the first one.
+    write_pattern_store(shard_paths[-1], [(SOURCE, source_edges[SOURCE]) for SOURCE in SOURCE_LIST[2::3]] +
+                        [(SOURCE_LIST[0], np.array([[SOURCE_LIST[0], 9]], dtype=np.int32))])
+    path = f"{tmp_path}/store.tpstore"
+    assert merge_pattern_stores(shard_paths, path) == len(source_edges)
+    expected = {SOURCE: edges.tolist() for SOURCE, edges in source_edges.items()}
+    expected[SOURCE_LIST[0]] = [[SOURCE_LIST[0], 9]]
+    assert read_store(open_pattern_store(path)) == expected
@@ -0,0 +1,147 @@
+"""
+Checks the trip transfers of transfer_generation.py by running earliest arrival TBTR queries over them on the synthetic benchmark network.
+Run from the repository root: python -m pytest tests
+"""
+import heapq
+import random
+from bisect import bisect_left
+
+import pytest
+
+from benchmark.synthetic_network import synthetic_network
+from function_file import INF_TIME, encode_network
+from transfer_generation import generate_trip_transfers
+
+MAX_TRANSFER = 4
+
+
+def initial_labels(SOURCE, d_time, footpath_dict):
+    '''
+    Returns:
+        labels (dict): the source and the stops reached from it by footpath. Format {stop_id: seconds}.
+    '''
+    return {SOURCE: d_time, **{to_stop: d_time + walk for to_stop, walk in footpath_dict.get(SOURCE, [])}}
+
+
+def tbtr_labels(SOURCE, d_time, network, trip_transfer_dict):
+    '''
+    Earliest arrival TBTR (Witt, 2015) without target pruning. A boarded trip is scanned to its last stop and only prunes boarding
+    the same trip at a later stop, so the labels depend on nothing but the trip transfers. As in Witt's queries the journeys may start
+    with a footpath from the source, so a journey coming back to the source (e.g. by a U-turn) improves nothing.
+    Args:
+        SOURCE (int): stop id of source stop.
+        d_time (int): departure seconds.
+        network (dict): see the network fixture.
+        trip_transfer_dict (nested dict): Format {trip: {stop index: [(trip, stop index)]}} with the integer trips of encode_network.
+    Returns:
+        labels (list): earliest arrival with at most n + 1 trips at labels[n]. Format {stop_id: arrival seconds}.
+    '''
+    stoptimes_dict, footpath_dict, trip_route_idx = network["stoptimes_dict"], network["footpath_dict"], network["trip_route_idx"]
+    R_t = {}
+
+    def enqueue(trip, stop_idx, Q):
+        if stop_idx < R_t.get(trip, INF_TIME):
+            Q.append((trip, stop_idx))
+            R_t[trip] = stop_idx
+
+    Q, best = [], initial_labels(SOURCE, d_time, footpath_dict)
+    for from_stop, from_time in best.items():
+        for route in network["routes_by_stop_dict"].get(from_stop, []):
+            stop_idx = network["idx_by_route_stop_dict"][(route, from_stop)]
+            tid = bisect_left([trip[stop_idx][1] for trip in stoptimes_dict[route]], from_time)
+            if tid < len(stoptimes_dict[route]):
+                enqueue(network["route_trip_offset"][route] + tid, stop_idx, Q)
+    labels = []
+    for _ in range(MAX_TRANSFER + 1):
+        next_Q = []
+        for trip, board_idx in Q:
+            route, tid = trip_route_idx[trip]
+            for stop_idx, (stop, arrival) in enumerate(stoptimes_dict[route][tid][board_idx + 1:], board_idx + 1):
+                for to_stop, walk in [(stop, 0)] + footpath_dict.get(stop, []):
+                    best[to_stop] = min(best.get(to_stop, INF_TIME), arrival + walk)
+                for to_trip, to_stop_idx in trip_transfer_dict.get(trip, {}).get(stop_idx, []):
+                    enqueue(to_trip, to_stop_idx, next_Q)
+        labels.append(dict(best))
+        Q = next_Q
+    return labels
+
+
+def scan_labels(SOURCE, d_time, network):
+    '''
+    The labels of tbtr_labels computed round by round on the timetable alone (like RAPTOR), i.e. as if every transfer to the earliest
+    catchable trip of every route was kept.
+    '''
+    stops_dict, stoptimes_dict, footpath_dict = network["stops_dict"], network["stoptimes_dict"], network["footpath_dict"]
+    labels, best = [], initial_labels(SOURCE, d_time, footpath_dict)
+    reached = dict(best)
+    for _ in range(MAX_TRANSFER + 1):
+        arrivals = {}
+        for from_stop, from_time in reached.items():
+            for route in network["routes_by_stop_dict"].get(from_stop, []):
+                stop_idx = network["idx_by_route_stop_dict"][(route, from_stop)]
+                tid = bisect_left([trip[stop_idx][1] for trip in stoptimes_dict[route]], from_time)
+                if tid < len(stoptimes_dict[route]):
+                    for stop, arrival in stoptimes_dict[route][tid][stop_idx + 1:]:
+                        arrivals[stop] = min(arrivals.get(stop, INF_TIME), arrival)
+        reached = dict(arrivals)
+        for stop, arrival in arrivals.items():
+            for to_stop, walk in footpath_dict.get(stop, []):
+                reached[to_stop] = min(reached.get(to_stop, INF_TIME), arrival + walk)
+        for stop, arrival in reached.items():
+            best[stop] = min(best.get(stop, INF_TIME), arrival)
+        labels.append(dict(best))
+    return labels
+
+
+def close_footpaths(footpath_dict):
+    '''
+    Transitive closure of the footpaths with the shortest walking times. The U-turn removal assumes it (Witt, 2015): with a stop
+    pair only reachable by walking twice, a U-turn can be the only way to arrive at the first stop by trip and walk on from there.
+    Args:
+        footpath_dict (dict): Format {from_stop_id: [(to_stop_id, footpath duration)]}.
+    Returns:
+        footpath_dict (dict): Format {from_stop_id: [(to_stop_id, footpath duration)]}.
+    '''
+    closed_dict = {}
+    for from_stop, connections in footpath_dict.items():
+        walk_dict, heap = {}, [(walk, to_stop) for to_stop, walk in connections]
+        heapq.heapify(heap)
+        while heap:
+            walk, stop = heapq.heappop(heap)
+            if stop == from_stop or stop in walk_dict:
+                continue
+            walk_dict[stop] = walk
+            for to_stop, to_walk in footpath_dict.get(stop, []):
+                heapq.heappush(heap, (walk + to_walk, to_stop))
+        closed_dict[from_stop] = list(walk_dict.items())
+    return closed_dict
+
+
+@pytest.fixture(scope="module")
+def network():
+    '''
+    Synthetic network with closed footpaths and the trip transfers generated with and without the transfer reduction, encoded as by encode_network.
+    '''
+    stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict, _ = synthetic_network(400, seed=1, trips_per_route=8)
+    footpath_dict = close_footpaths(footpath_dict)
+    network = {"stops_dict": stops_dict, "routes_by_stop_dict": routes_by_stop_dict, "idx_by_route_stop_dict": idx_by_route_stop_dict}
+    for REDUCE in (True, False):
+        trip_transfer_dict, _ = generate_trip_transfers(stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict, 2, REDUCE)
+        encoded_stoptimes_dict, encoded_footpath_dict, network[REDUCE], departures_dict, trip_route_idx, route_trip_offset, _ = \
+            encode_network(stoptimes_dict, footpath_dict, trip_transfer_dict)
+    network.update(stoptimes_dict=encoded_stoptimes_dict, footpath_dict=encoded_footpath_dict, trip_route_idx=trip_route_idx,
+                   route_trip_offset=route_trip_offset)
+    rnd = random.Random(0)
+    network["queries"] = [(SOURCE, d_time) for SOURCE in rnd.sample(sorted(departures_dict), 40)
+                          for d_time in rnd.sample(sorted({d_time for _, d_time, _ in departures_dict[SOURCE]}), 3)]
+    return network
+
+
+def test_reduction_keeps_earliest_arrivals(network):
+    for SOURCE, d_time in network["queries"]:
+        assert tbtr_labels(SOURCE, d_time, network, network[True]) == tbtr_labels(SOURCE, d_time, network, network[False]), (SOURCE, d_time)
+
+
+def test_transfers_reach_earliest_arrivals(network):
+    for SOURCE, d_time in network["queries"]:
+        assert tbtr_labels(SOURCE, d_time, network, network[False]) == scan_labels(SOURCE, d_time, network), (SOURCE, d_time)
@@ -0,0 +1,186 @@
+"""
+Generates the TBTR trip transfers GTFS/{folder}/TBTR_trip_transfer_dict.pkl read by preprocessing_code.py and network_snapshot.py
+(Witt, 2015). Every arrival of a trip gets a transfer to the earliest catchable trip of every route at the stops reachable by
+footpath, then U-turn transfers are removed and the transfer reduction drops every transfer that improves no arrival over staying
+seated or transferring later. Fewer transfers mean fewer segments enqueued by every rTBTR search. Routes are processed in parallel.
+Usage: python transfer_generation.py --folder ./sweden --cores 8
+Trips of a route must not overtake each other and changing at a stop takes no time, which rTBTR assumes as well.
+Like Witt, the U-turn removal assumes transitively closed footpaths. Otherwise it can drop a journey that needs two footpaths in a row.
+"""
+import argparse
+import gc
+import os
+import pickle
+from multiprocessing import get_context
+from time import time
+
+import numpy as np
+from tqdm import tqdm
+
+from function_file import INF_TIME, encode_network, route_timetable
+
+# Filled once by prepare_timetable in the parent. Workers are forked afterwards and read it without copying.
+TIMETABLE = {}
+
+
+def prepare_timetable(stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict):
+    '''
+    Builds the per route arrays the transfer generation works on into TIMETABLE. The targets of a route list, stop index by stop
+    index, the stop itself and the stops reachable from it by footpath, with the walking time.
+    Args:
+        stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict: as returned by read_testcase.
+    Returns: None
+    '''
+    stoptimes_dict, footpath_dict, _, _, _, _, _ = encode_network(stoptimes_dict, footpath_dict, {})
+    stop_ids = sorted(set(routes_by_stop_dict) | {to_stop for connections in footpath_dict.values() for to_stop, _ in connections})
+    stop_index = {stop: x for x, stop in enumerate(stop_ids)}
+    walk_dict = {stop: [(stop, 0)] + [(to_stop, walk) for to_stop, walk in footpath_dict.get(stop, []) if to_stop != stop] for stop in routes_by_stop_dict}
+    times, targets, stop_seq = route_timetable(stoptimes_dict), {}, {}
+    for route, route_stops in stops_dict.items():
+        stop_seq[route] = np.array([stop_index[stop] for stop in route_stops], dtype=np.int64)
+        tgt_start, tgt_pos, tgt_stop, tgt_walk = [0], [], [], []
+        for stop_idx, stop in enumerate(route_stops):
+            for to_stop, walk in walk_dict[stop]:
+                tgt_pos.append(stop_idx)
+                tgt_stop.append(stop_index[to_stop])
+                tgt_walk.append(walk)
+            tgt_start.append(len(tgt_pos))
+        targets[route] = (tgt_start, np.array(tgt_pos, dtype=np.int64), np.array(tgt_stop, dtype=np.int64), np.array(tgt_walk, dtype=np.int64))
+    # Routes that can be boarded at a stop, leaving out routes for which it is the last stop.
+    boarding_dict = {stop_index[stop]: [(route, idx_by_route_stop_dict[(route, stop)]) for route in routes
+                                        if idx_by_route_stop_dict[(route, stop)] < len(stops_dict[route]) - 1]
+                     for stop, routes in routes_by_stop_dict.items()}
+    TIMETABLE.update(times=times, targets=targets, stop_seq=stop_seq, boarding_dict=boarding_dict)
+
+
+def route_transfers(route, REDUCE=True):
+    '''
+    Trip transfers of all trips of a route. The candidates of a stop are found for all trips at once, and the transfer reduction runs
+    for all trips in lockstep: tau[t, stop] is the earliest arrival at stop seen so far starting in trip t, and a transfer is kept only
+    if it lowers tau somewhere.
+    Args:
+        route (int): route id.
+        REDUCE (bool): remove U-turn transfers and run the transfer reduction, otherwise every earliest catchable trip is kept.
+    Returns:
+        route (int): route id.
+        stop_transfers_list (list): one dict per trip of the route. Format {stop index: [(to_route, to_tid, to_stop_idx)]}.
+        counts (tuple): Format (candidates, U-turns removed, reduced away).
+    '''
+    net = TIMETABLE
+    times, stop_seq = net["times"][route], net["stop_seq"][route]
+    num_trips, num_stops = times.shape
+    tgt_start, tgt_pos, tgt_stop, tgt_walk = net["targets"][route]
+    trip_range = np.arange(num_trips)
+    candidates, uturns = 0, 0
+    group_dict = {}
+    for stop_idx in range(1, num_stops):
+        groups = []
+        for x in range(tgt_start[stop_idx], tgt_start[stop_idx + 1]):
+            for to_route, to_stop_idx in net["boarding_dict"].get(tgt_stop[x], []):
+                to_times = net["times"][to_route]
+                to_tid = np.searchsorted(to_times[:, to_stop_idx], times[:, stop_idx] + tgt_walk[x])
+                valid = to_tid < len(to_times)
+                if to_route == route and to_stop_idx >= stop_idx:
+                    # A transfer to the same route is kept if it goes back along the route or to an earlier trip (Witt: j < i or u before t).
+                    valid &= to_tid < trip_range
+                if not valid.any():
+                    continue
+                candidates += int(valid.sum())
+                if REDUCE and net["stop_seq"][to_route][to_stop_idx + 1] == stop_seq[stop_idx - 1]:
+                    # U-turn: the trip could have been left one stop earlier to board to_tid one stop later.
+                    uturn = times[:, stop_idx - 1] <= to_times[np.minimum(to_tid, len(to_times) - 1), to_stop_idx + 1]
+                    uturns += int((valid & uturn).sum())
+                    valid &= ~uturn
+                groups.append((to_route, to_stop_idx, to_tid, valid))
+        group_dict[stop_idx] = groups
+
+    stop_transfers_list = [{stop_idx: [] for stop_idx in range(num_stops)} for _ in range(num_trips)]
+    if REDUCE:
+        route_set = {route} | {to_route for groups in group_dict.values() for to_route, _, _, _ in groups}
+        local = np.unique(np.concatenate([net["targets"][x][2] for x in route_set]))
+        tau = np.full((num_trips, len(local)), INF_TIME, dtype=np.int64)
+        rows = trip_range[:, None]
+    kept = 0
+    for stop_idx in range(num_stops - 1, 0, -1):
+        if REDUCE:
+            # Staying seated reaches this stop and its footpaths.
+            cols = np.searchsorted(local, tgt_stop[tgt_start[stop_idx]: tgt_start[stop_idx + 1]])
+            np.minimum.at(tau, (rows, cols), times[:, tgt_pos[tgt_start[stop_idx]: tgt_start[stop_idx + 1]]] + tgt_walk[tgt_start[stop_idx]: tgt_start[stop_idx + 1]])
+        for to_route, to_stop_idx, to_tid, valid in group_dict[stop_idx]:
+            if REDUCE:
+                to_start, to_pos, to_stop, to_walk = net["targets"][to_route]
+                cols = np.searchsorted(local, to_stop[to_start[to_stop_idx + 1]:])
+                arrival = net["times"][to_route][np.minimum(to_tid, len(net["times"][to_route]) - 1)][:, to_pos[to_start[to_stop_idx + 1]:]] + to_walk[to_start[to_stop_idx + 1]:]
+                arrival[~valid] = INF_TIME
+                valid = valid & (arrival < tau[:, cols]).any(axis=1)
+                np.minimum.at(tau, (rows, cols), arrival)
+            for tid in np.flatnonzero(valid).tolist():
+                stop_transfers_list[tid][stop_idx].append((to_route, int(to_tid[tid]), to_stop_idx))
+                kept += 1
+    return route, stop_transfers_list, (candidates, uturns, candidates - uturns - kept)
+
+
+def _route_transfers_reduced(route):
+    return route_transfers(route, True)
+
+
+def _route_transfers_all(route):
+    return route_transfers(route, False)
+
+
+def generate_trip_transfers(stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict, cores, REDUCE=True):
+    '''
+    Generates the trip transfers of a network with a pool of forked processes, one route per task.
+    Args:
+        stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict: as returned by read_testcase.
+        cores (int): number of worker processes.
+        REDUCE (bool): see route_transfers.
+    Returns:
+        trip_transfer_dict (nested dict): keys: id of trip we are transferring from ("route_tid"), value: {stop number: list of tuples
+        of form (id of trip we are transferring to, stop number)}
+        counts (tuple): Format (candidates, U-turns removed, reduced away) over all routes.
+    '''
+    prepare_timetable(stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict)
+    # Largest routes first so they do not end up as the tail of the run.
+    route_LIST = sorted(stops_dict, key=lambda route: TIMETABLE["times"][route].size, reverse=True)
+    result_dict, counts = {}, np.zeros(3, dtype=np.int64)
+    gc.freeze()
+    with get_context("fork").Pool(cores) as pool:
+        for route, stop_transfers_list, route_counts in tqdm(pool.imap_unordered(_route_transfers_reduced if REDUCE else _route_transfers_all, route_LIST,
+                                                                                 chunksize=16), total=len(route_LIST)):
+            result_dict[route] = stop_transfers_list
+            counts += route_counts
+    gc.unfreeze()
+    trip_transfer_dict = {}
+    for route in stops_dict:
+        for tid, stop_transfers in enumerate(result_dict[route]):
+            trip_transfer_dict[f"{route}_{tid}"] = {stop_idx: [(f"{to_route}_{to_tid}", to_stop_idx) for to_route, to_tid, to_stop_idx in transfers]
+                                                     for stop_idx, transfers in stop_transfers.items()}
+    TIMETABLE.clear()
+    return trip_transfer_dict, tuple(counts.tolist())
+
+
+def main():
+    from miscellaneous_func import read_testcase
+
+    parser = argparse.ArgumentParser(description="Generate the TBTR trip transfers of a network.")
+    parser.add_argument("--folder", default="./swiss", help="network folder, e.g. ./sweden or ./swiss")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--no-reduction", action="store_true", help="keep U-turn transfers and skip the transfer reduction")
+    args = parser.parse_args()
+
+    stops_file, trips_file, stop_times_file, transfers_file, stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict, idx_by_route_stop_dict = read_testcase(args.folder)
+    start = time()
+    trip_transfer_dict, (candidates, uturns, reduced) = generate_trip_transfers(stops_dict, stoptimes_dict, footpath_dict, routes_by_stop_dict,
+                                                                                idx_by_route_stop_dict, args.cores, not args.no_reduction)
+    path = f'./GTFS/{args.folder}/TBTR_trip_transfer_dict.pkl'
+    with open(f"{path}.tmp{os.getpid()}", "wb") as file:
+        pickle.dump(trip_transfer_dict, file)
+    os.replace(f"{path}.tmp{os.getpid()}", path)
+    print(f'    Time required: {round(time() - start)}')
+    print(f"    {candidates} transfers to earliest catchable trips, {uturns} U-turns removed, {reduced} removed by the reduction, "
+          f"{candidates - uturns - reduced} written to {path}")
+
+
+if __name__ == "__main__":
+    main()